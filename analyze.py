@@ -10,14 +10,23 @@ from typing import List, Tuple
 
 
 from scrapers.generic import make_folder
+from scrapers.catalog import PaperCatalog
 
 np.random.seed(2189)
 
 
 def train_test_split(
-    dataset_path: str, n_train: int = 500, n_test: int = 2500, filter_term: str = "none"
+    dataset_path: str,
+    n_train: int = 500,
+    n_test: int = 2500,
+    filter_term: str = "none",
+    catalog: PaperCatalog | None = None,
 ) -> None:
     papers = listdir(f"{dataset_path}/papers")
+    if catalog is not None:
+        # only catalogued papers (their split is recorded in it), kept in listdir order so a seed gives the same split
+        catalogued = set(catalog.folders())
+        papers = [paper for paper in papers if paper in catalogued]
     n_papers = len(papers)
 
     indices = np.arange(0, n_papers)
@@ -51,6 +60,11 @@ def train_test_split(
         except FileExistsError:
             pass
 
+    if catalog is not None:
+        catalog.reset_splits()  # papers of an earlier split that weren't drawn this time
+        for split, inds in [("train", train_inds), ("test", test_inds)]:
+            catalog.set_split([papers[i] for i in inds if filter_term not in papers[i]], split)
+
 
 def evaluate_labels(train_folder, label_type):
     for doi_folder in os.listdir(train_folder):
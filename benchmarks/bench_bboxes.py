@@ -0,0 +1,75 @@
+from typing import List
+import numpy as np
+from skimage.measure import label
+
+from extract import (
+    binarize_img,
+    get_bbox,
+    check_area_from_bbox,
+    get_subimage_bboxes,
+    get_label_bboxes,
+    filter_bboxes_by_area,
+    WHITE_CUTOFF,
+    AREA_CUTOFF,
+    OFFSETS,
+)
+from benchmarks.common import load_greyscale_arrs, time_fn
+
+# Compare the single-pass bbox engine in `get_subimage_bboxes` to the previous per-label masking version.
+
+
+def get_subimage_bboxes_per_label(greyscale_figure_arr: np.ndarray) -> List[List[int]]:
+    """Reference implementation: one full-size mask + np.nonzero per connected component."""
+    binary_arr = binarize_img(greyscale_figure_arr, WHITE_CUTOFF)
+    labelled_arr, n_subimages = label(binary_arr, return_num=True)  # type: ignore
+    bboxes: List[List[int]] = []
+    for i in range(1, n_subimages + 1):
+        current_mask = np.where(labelled_arr == i, 1, 0)
+        bbox = get_bbox(current_mask, OFFSETS)
+        if check_area_from_bbox(bbox, AREA_CUTOFF):
+            bboxes.append(bbox)
+    return bboxes
+
+
+def bboxes_per_label(labelled_arr: np.ndarray) -> List[List[int]]:
+    bboxes = []
+    for i in range(1, int(labelled_arr.max()) + 1):
+        bbox = get_bbox(np.where(labelled_arr == i, 1, 0), OFFSETS)
+        if check_area_from_bbox(bbox, AREA_CUTOFF):
+            bboxes.append(bbox)
+    return bboxes
+
+
+def bboxes_single_pass(labelled_arr: np.ndarray) -> List[List[int]]:
+    return filter_bboxes_by_area(get_label_bboxes(labelled_arr, OFFSETS), AREA_CUTOFF).tolist()
+
+
+def report(name: str, t_ref: float, t_new: float, n: int) -> None:
+    print(
+        f"{name}: per-label {1000 * t_ref / n:.2f} ms/img, single-pass {1000 * t_new / n:.2f} ms/img, "
+        f"speedup {t_ref / t_new:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    arrs = load_greyscale_arrs()
+    labelled_arrs = [label(binarize_img(arr, WHITE_CUTOFF)) for arr in arrs]
+    n_labels = np.array([labelled.max() for labelled in labelled_arrs])
+    print(f"{len(arrs)} images, {np.mean(n_labels):.1f} components/image (max {n_labels.max()})")
+
+    t_ref, ref_bboxes = time_fn(get_subimage_bboxes_per_label, arrs)
+    t_new, new_bboxes = time_fn(get_subimage_bboxes, arrs)
+    assert ref_bboxes == new_bboxes, "bboxes differ from per-label reference"
+    print("bboxes identical to per-label reference")
+    report("get_subimage_bboxes (end to end)", t_ref, t_new, len(arrs))
+
+    # the binarize/open/label stages are shared, so isolate the bbox stage that changed
+    t_ref, _ = time_fn(bboxes_per_label, labelled_arrs)
+    t_new, _ = time_fn(bboxes_single_pass, labelled_arrs)
+    report("bbox stage only", t_ref, t_new, len(arrs))
+
+    noisy = [labelled for labelled, n in zip(labelled_arrs, n_labels) if n >= 10]
+    if len(noisy) > 0:
+        t_ref, _ = time_fn(bboxes_per_label, noisy)
+        t_new, _ = time_fn(bboxes_single_pass, noisy)
+        report(f"bbox stage only, {len(noisy)} images with >=10 components", t_ref, t_new, len(noisy))
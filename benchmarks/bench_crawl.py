@@ -0,0 +1,110 @@
+from os import makedirs
+from tempfile import TemporaryDirectory
+from time import perf_counter, process_time
+from typing import Callable, List
+import numpy as np
+
+from scrapers.arxiv import ArxivScraper
+from scrapers.chemrxiv import ChemrxivScraper
+from scrapers.generic import GenericScraper
+from scrapers.rate_limit import AdaptiveRateLimiter
+from scrapers.async_crawl import crawl_metadata, download_pdfs
+from scrapers.mock_server import MockPreprintServer
+
+# Papers/s, request latency percentiles and CPU use of the metadata (API paging) and download (pdf) paths of each
+# scraper, sequential vs `scrapers.async_crawl`, against a local `MockPreprintServer` so it runs offline and the
+# numbers don't depend on the archives' load. CPU % is process time / wall time (>100% = more than one core busy).
+N_PAPERS: int = 2000
+N_PDFS: int = 200
+PAGE_SIZE: int = 100
+LATENCY_S: float = 0.02  # added by the server to every response, a fast API
+ERROR_RATE: float = 0.01
+MAX_IN_FLIGHT: int = 4
+RATE_PER_S: float = 1000  # the limiter isn't what's measured
+
+
+class RecordingLimiter(AdaptiveRateLimiter):
+    """Keeps the latency of every response reported to it."""
+
+    def __init__(self) -> None:
+        super().__init__(RATE_PER_S, MAX_IN_FLIGHT, max_rate_per_s=RATE_PER_S)
+        self.latencies_s: List[float] = []
+
+    def record(self, url: str, status: int, latency_s: float, retry_after_s: float | None = None) -> None:
+        self.latencies_s.append(latency_s)
+        super().record(url, status, latency_s, retry_after_s)
+
+
+def measure(name: str, fn: Callable[[], int], limiter: RecordingLimiter) -> None:
+    limiter.latencies_s.clear()
+    wall, cpu = perf_counter(), process_time()
+    n_papers = fn()
+    wall, cpu = perf_counter() - wall, process_time() - cpu
+    p50, p90, p99 = 1000 * np.percentile(limiter.latencies_s, [50, 90, 99])
+    print(
+        f"{name:<24} {n_papers / wall:7.1f} papers/s, {len(limiter.latencies_s)} requests, latency "
+        f"p50/p90/p99 {p50:.1f}/{p90:.1f}/{p99:.1f} ms, CPU {100 * cpu / wall:.0f}%"
+    )
+
+
+def sequential_metadata(scraper: GenericScraper, dataset_path: str) -> int:
+    n_papers = 0
+    for start in range(0, N_PAPERS, PAGE_SIZE):
+        n_papers += scraper.handle_entries(scraper.make_api_request("microscopy", start, PAGE_SIZE), dataset_path)
+    return n_papers
+
+
+def sequential_download(scraper: GenericScraper, paper_ids: List[str], save_paths: List[str]) -> int:
+    n_pdfs = 0
+    for paper_id, save_path in zip(paper_ids, save_paths):
+        try:
+            scraper.download_pdf(paper_id, save_path)
+            n_pdfs += 1
+        except Exception as err:
+            print(f"Fail! {paper_id}: {err}")
+    return n_pdfs
+
+
+if __name__ == "__main__":
+    server = MockPreprintServer(N_PAPERS, LATENCY_S, ERROR_RATE)
+    print(
+        f"mock server: {N_PAPERS} papers, {1000 * LATENCY_S:.0f} ms latency, {100 * ERROR_RATE:.0f}% errors; "
+        f"{MAX_IN_FLIGHT} in flight for async"
+    )
+    paper_ids = [p["id"] for p in server.papers[:N_PDFS]]
+    try:
+        for scraper_class in [ArxivScraper, ChemrxivScraper]:
+            source = scraper_class.SOURCE
+            limiter = RecordingLimiter()
+            scraper = scraper_class(limiter, server_url=server.url)
+            with TemporaryDirectory() as tmp_dir:
+                for mode in ["seq", "async"]:
+                    dataset_path = f"{tmp_dir}/{mode}/papers/"
+                    makedirs(dataset_path)
+                    save_paths = [f"{tmp_dir}/{mode}/{i}.pdf" for i in range(N_PDFS)]
+                    if mode == "seq":
+                        measure(
+                            f"{source} metadata {mode}", lambda: sequential_metadata(scraper, dataset_path), limiter
+                        )
+                        measure(
+                            f"{source} download {mode}",
+                            lambda: sequential_download(scraper, paper_ids, save_paths),
+                            limiter,
+                        )
+                    else:
+                        measure(
+                            f"{source} metadata {mode}",
+                            lambda: crawl_metadata(
+                                scraper, "microscopy", N_PAPERS, PAGE_SIZE, MAX_IN_FLIGHT, dataset_path
+                            ),
+                            limiter,
+                        )
+                        measure(
+                            f"{source} download {mode}",
+                            lambda: sum(download_pdfs(scraper, paper_ids, save_paths, MAX_IN_FLIGHT)),
+                            limiter,
+                        )
+            scraper.close()
+        print(f"server: {server.counts}")
+    finally:
+        server.shutdown()
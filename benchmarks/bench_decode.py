@@ -0,0 +1,58 @@
+import tracemalloc
+from io import BytesIO
+from time import perf_counter
+from typing import Callable, List
+import numpy as np
+from PIL import Image
+
+from extract import split_composite_figure, img_to_arr, arr_to_img, WHITE_CUTOFF
+from benchmarks.common import load_figures, make_composite_figures
+
+# Time and peak (numpy/python) memory per figure of the split + encode stage, before and after decoding each
+# figure once in `split_composite_figure`. tracemalloc doesn't see PIL's own image buffers, so the peak
+# covers the numpy arrays (the RGB/greyscale copies and binarization temporaries).
+
+
+def split_composite_figure_before(figure: Image.Image) -> List[np.ndarray]:
+    """Previous version: two full PIL convert + np.array copies and an int64 binarization."""
+    from skimage.measure import label
+    from skimage.morphology import binary_opening
+    from extract import get_label_bboxes, filter_bboxes_by_area, OFFSETS, AREA_CUTOFF
+
+    rgb_arr = img_to_arr(figure)
+    greyscale_arr = img_to_arr(figure, "L")
+    binary_arr = binary_opening(np.where(greyscale_arr < WHITE_CUTOFF, 1, 0))
+    bboxes = filter_bboxes_by_area(get_label_bboxes(label(binary_arr), OFFSETS), AREA_CUTOFF)
+    return [rgb_arr[y0:y1, x0:x1, :] for x0, y0, x1, y1 in bboxes.tolist()]
+
+
+def split_and_encode(split_fn: Callable, png_bytes: bytes) -> None:
+    figure = Image.open(BytesIO(png_bytes))
+    for arr in split_fn(figure):
+        arr_to_img(arr, "RGB").save(BytesIO(), format="JPEG")
+
+
+def measure(split_fn: Callable, pngs: List[bytes]) -> tuple:
+    times, peaks = [], []
+    for png_bytes in pngs:
+        tracemalloc.start()
+        start = perf_counter()
+        split_and_encode(split_fn, png_bytes)
+        times.append(perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return 1000 * np.mean(times), np.mean(peaks) / 1e6, np.max(peaks) / 1e6
+
+
+if __name__ == "__main__":
+    figures = make_composite_figures(load_figures(), n_figures=30)
+    pngs = []
+    for figure in figures:
+        buffer = BytesIO()
+        figure.save(buffer, format="PNG")
+        pngs.append(buffer.getvalue())
+    mpx = np.mean([figure.width * figure.height for figure in figures]) / 1e6
+    print(f"{len(figures)} figures, {mpx:.2f} Mpx on average")
+    for name, split_fn in [("before", split_composite_figure_before), ("after", split_composite_figure)]:
+        ms, mean_peak, max_peak = measure(split_fn, pngs)
+        print(f"{name}: {ms:.1f} ms/figure, peak memory {mean_peak:.1f} MB mean, {max_peak:.1f} MB max")
@@ -0,0 +1,31 @@
+from typing import List
+import numpy as np
+
+from extract import get_subimage_bboxes, img_to_arr
+from benchmarks.common import load_figures, make_composite_figures, bbox_agreement, time_fn
+
+# Agreement and speed of downsampled subfigure detection (`get_subimage_bboxes(arr, scale)`) vs full resolution,
+# to choose a safe DETECTION_SCALE. Run on synthetic grid figures built from micrographs/ plus the micrographs
+# themselves (single panels, which should stay unsplit).
+
+SCALES: List[int] = [2, 3, 4, 6]
+
+
+def evaluate(name: str, arrs: List[np.ndarray]) -> None:
+    t_full, full_bboxes = time_fn(get_subimage_bboxes, arrs)
+    print(f"{name} ({len(arrs)} images), full resolution: {1000 * t_full / len(arrs):.1f} ms/img")
+    for scale in SCALES:
+        t_scaled, scaled_bboxes = time_fn(lambda arr: get_subimage_bboxes(arr, scale), arrs)
+        agreement = bbox_agreement(full_bboxes, scaled_bboxes)
+        print(
+            f"  scale {scale}: {1000 * t_scaled / len(arrs):.1f} ms/img ({t_full / t_scaled:.1f}x), "
+            f"same n_boxes {100 * agreement['same_count']:.1f}%, boxes matched {100 * agreement['matched']:.1f}%, "
+            f"mean IoU {agreement['mean_iou']:.4f}, max corner err {agreement['max_corner_err_px']}px"
+        )
+
+
+if __name__ == "__main__":
+    micrographs = load_figures()
+    composites = [img_to_arr(figure, "L") for figure in make_composite_figures(micrographs)]
+    evaluate("composite figures", composites)
+    evaluate("single micrographs", [img_to_arr(figure, "L") for figure in micrographs[:200]])
@@ -0,0 +1,32 @@
+from typing import List
+import numpy as np
+
+from extract import get_subimage_bboxes, get_subimage_bboxes_xycut, xycut, img_to_arr, WHITE_CUTOFF
+from extract import XYCUT_MIN_GAP, XYCUT_NOISE_TOL
+from benchmarks.common import load_figures, make_composite_figures, bbox_agreement, time_fn
+
+# Speed and box agreement of the xycut splitter engine vs the connected-component engine.
+
+
+def n_fallbacks(arrs: List[np.ndarray]) -> int:
+    return sum(
+        len(xycut(arr < WHITE_CUTOFF, 0, 0, XYCUT_MIN_GAP, XYCUT_NOISE_TOL)) <= 1 for arr in arrs
+    )
+
+
+def evaluate(name: str, arrs: List[np.ndarray]) -> None:
+    t_cc, cc_bboxes = time_fn(get_subimage_bboxes, arrs)
+    t_xy, xy_bboxes = time_fn(get_subimage_bboxes_xycut, arrs)
+    agreement = bbox_agreement(cc_bboxes, xy_bboxes)
+    print(f"{name} ({len(arrs)} images, {n_fallbacks(arrs)} fell back to cc):")
+    print(f"  cc: {1000 * t_cc / len(arrs):.1f} ms/img, xycut: {1000 * t_xy / len(arrs):.1f} ms/img ({t_cc / t_xy:.1f}x)")
+    print(
+        f"  same n_boxes {100 * agreement['same_count']:.1f}%, boxes matched {100 * agreement['matched']:.1f}%, "
+        f"mean IoU {agreement['mean_iou']:.4f}, max corner err {agreement['max_corner_err_px']}px"
+    )
+
+
+if __name__ == "__main__":
+    micrographs = load_figures()
+    evaluate("composite figures", [img_to_arr(fig, "L") for fig in make_composite_figures(micrographs)])
+    evaluate("single micrographs", [img_to_arr(fig, "L") for fig in micrographs[:200]])
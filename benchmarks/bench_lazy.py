@@ -0,0 +1,43 @@
+from os import listdir, makedirs
+from os.path import getsize
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import numpy as np
+
+from extract import split_and_save_figures, load_subfigure
+from benchmarks.common import load_figures, make_composite_figures
+
+# Time and bytes written per figure by the split + save stage with eagerly encoded subfigures vs lazy mode
+# (figure .png + bbox manifest), and the cost of cropping a subfigure back out of a lazy figure on demand.
+
+
+def save_stage(fig_paths: list, out_dir: str, lazy: bool) -> tuple:
+    makedirs(out_dir)
+    out_prefixes = [f"{out_dir}captions_fig_{n}" for n in range(len(fig_paths))]
+    start = perf_counter()
+    split_paths = split_and_save_figures(fig_paths, out_prefixes, True, lazy=lazy)
+    elapsed = perf_counter() - start
+    n_bytes = sum(getsize(f"{out_dir}{name}") for name in listdir(out_dir))
+    return elapsed, n_bytes, [p for paths in split_paths for p in paths]
+
+
+if __name__ == "__main__":
+    figures = make_composite_figures(load_figures(), n_figures=30)
+    with TemporaryDirectory() as tmp_dir:
+        fig_paths = []
+        for i, figure in enumerate(figures):
+            fig_paths.append(f"{tmp_dir}/p0-Figure{i + 1}-1.png")
+            figure.save(fig_paths[-1])
+        n_input = sum(getsize(p) for p in fig_paths)
+        print(f"{len(figures)} figures, {n_input / 1e6:.1f} MB of pdffigures2 .png")
+        for mode, lazy in [("eager", False), ("lazy", True)]:
+            elapsed, n_bytes, img_paths = save_stage(fig_paths, f"{tmp_dir}/{mode}/", lazy)
+            print(
+                f"{mode}: {1000 * elapsed / len(figures):.1f} ms/figure, {n_bytes / 1e6:.1f} MB written "
+                f"for {len(img_paths)} subfigures"
+            )
+        start = perf_counter()
+        for img_path in img_paths:
+            load_subfigure(img_path)
+        ms = 1000 * (perf_counter() - start) / len(img_paths)
+        print(f"lazy crop on demand: {ms:.1f} ms/subfigure")
@@ -0,0 +1,113 @@
+import csv
+import json
+import re
+from os import listdir
+from os.path import exists, isfile, join
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import openai
+
+from scrapers.catalog import load_paper_data
+import llm_operations.run_llm_with_abstract as llm
+from llm_operations.llm_cache import LLMCache
+from llm_operations.mock_openai import MockOpenAIServer, keyword_label
+
+# Requests and tokens of labelling a sample of papers one caption at a time (abstract sent with every caption) vs
+# paper-batched (`run_llm_with_abstract.label_paper`, abstract sent once), against a local `MockOpenAIServer`
+# (tokens estimated at 4 chars/token). A fraction of the paper-batched replies drop a figure, so the per-caption
+# fallbacks are counted too. The sample is the first papers of DATASET_PATH if it exists, else the papers in
+# micrographs/labels.csv: it has no abstracts, so a stand-in of typical length is used, and only has the figures
+# with micrographs, so papers have fewer figures (i.e. less to save) than the full dataset.
+DATASET_PATH: str = "micrograph_dataset_new/train/"
+LABELS_PATH: str = "micrographs/labels.csv"
+N_PAPERS: int = 50
+STAND_IN_ABSTRACT_CHARS: int = 1500  # ~250 words
+DROP_RATE: float = 0.1  # fraction of paper-batched replies missing a figure
+FIGURE_PATTERN = re.compile(r"^Figure (.+?): ", re.MULTILINE)
+
+Sample = List[Tuple[str, List[Dict]]]  # (abstract, captions.json contents) per paper
+
+
+def load_sample(n_papers: int = N_PAPERS) -> Sample:
+    sample: Sample = []
+    if exists(DATASET_PATH):
+        for folder in sorted(listdir(DATASET_PATH)):
+            if isfile(join(DATASET_PATH, folder, "captions.json")) and len(sample) < n_papers:
+                with open(join(DATASET_PATH, folder, "captions.json")) as f:
+                    captions_data = json.load(f)
+                sample.append((load_paper_data(folder, DATASET_PATH).get("abstract", ""), captions_data))
+        return sample
+
+    papers: Dict[str, Dict] = {}  # id: {"title", "captions": {figure: caption}}
+    with open(LABELS_PATH) as f:
+        for row in csv.reader(f, delimiter="|"):
+            paper_id, figure = row[1].rsplit("_f", 1)
+            paper = papers.setdefault(paper_id, {"title": row[6], "captions": {}})
+            paper["captions"][figure.split("_")[0]] = row[5]
+    for paper in list(papers.values())[:n_papers]:
+        abstract = (paper["title"] + ". ") * (STAND_IN_ABSTRACT_CHARS // max(len(paper["title"]) + 2, 1) + 1)
+        captions_data = [{"name": n, "figType": "Figure", "caption": c} for n, c in paper["captions"].items()]
+        sample.append((abstract[:STAND_IN_ABSTRACT_CHARS], captions_data))
+    return sample
+
+
+def make_responder(seed: int = 0):
+    random = Random(seed)
+
+    def respond(messages: List[Dict]) -> str:
+        if messages[0]["content"] != llm.PAPER_SYSTEM_MESSAGE:
+            return keyword_label(messages)
+        labels = []
+        for caption in FIGURE_PATTERN.split(messages[-1]["content"])[1:][1::2]:
+            labels.append(json.loads(keyword_label([{"content": caption}])))
+        names = FIGURE_PATTERN.findall(messages[-1]["content"])
+        entries = [{"figure": name, **label} for name, label in zip(names, labels)]
+        if random.random() < DROP_RATE:
+            entries.pop(random.randrange(len(entries)))
+        return json.dumps(entries)
+
+    return respond
+
+
+def run_mode(sample: Sample, paper_batched: bool) -> Dict:
+    server = MockOpenAIServer(respond=make_responder())
+    llm.client = openai.OpenAI(api_key="bench", base_url=server.url)
+    n_fallbacks = 0
+    try:
+        with TemporaryDirectory() as cache_dir:
+            cache = LLMCache(f"{cache_dir}/llm_cache.db")
+            start = perf_counter()
+            for abstract, captions_data in sample:
+                if paper_batched:
+                    n_fallbacks += llm.label_paper(abstract, captions_data, cache)[1]
+                else:
+                    for item in captions_data:
+                        if item["figType"] == "Figure":
+                            llm.extract_json_from_response(llm.assistant(abstract, item["caption"], cache))
+            elapsed = perf_counter() - start
+            cache.close()
+    finally:
+        server.shutdown()
+    return {**server.counts, "n_fallbacks": n_fallbacks, "elapsed_s": elapsed}
+
+
+if __name__ == "__main__":
+    sample = load_sample()
+    n_figures = sum(1 for _, captions_data in sample for item in captions_data if item["figType"] == "Figure")
+    print(f"{len(sample)} papers, {n_figures} figures ({n_figures / len(sample):.1f} per paper)")
+    results = {mode: run_mode(sample, mode == "paper") for mode in ["caption", "paper"]}
+    for mode, counts in results.items():
+        total = counts["prompt_tokens"] + counts["completion_tokens"]
+        print(
+            f"{mode:<8} {counts['n_requests']:5d} requests ({counts['n_fallbacks']} fallbacks), "
+            f"{counts['prompt_tokens']:8d} prompt + {counts['completion_tokens']:6d} completion = {total:8d} tokens"
+        )
+    caption, paper = results["caption"], results["paper"]
+    saved = 1 - paper["prompt_tokens"] / caption["prompt_tokens"]
+    saved_total = 1 - (paper["prompt_tokens"] + paper["completion_tokens"]) / (
+        caption["prompt_tokens"] + caption["completion_tokens"]
+    )
+    print(f"paper-batched saves {100 * saved:.0f}% of prompt tokens, {100 * saved_total:.0f}% of all tokens")
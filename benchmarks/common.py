@@ -0,0 +1,93 @@
+from os import listdir
+from time import perf_counter
+from typing import Callable, List, Tuple
+import numpy as np
+from PIL import Image
+
+from extract import img_to_arr
+
+# run benchmarks from the root directory as modules, i.e `python -m benchmarks.bench_bboxes`
+MICROGRAPH_PATH: str = "micrographs/"
+
+
+def load_figures(folder: str = MICROGRAPH_PATH, n_max: int = -1) -> List[Image.Image]:
+    fnames = sorted([f for f in listdir(folder) if f.endswith((".jpg", ".png"))])
+    if n_max > 0:
+        fnames = fnames[:n_max]
+    figures = []
+    for fname in fnames:
+        with Image.open(f"{folder}{fname}") as img:
+            img.load()
+            figures.append(img)
+    return figures
+
+
+def load_greyscale_arrs(folder: str = MICROGRAPH_PATH, n_max: int = -1) -> List[np.ndarray]:
+    return [img_to_arr(figure, "L") for figure in load_figures(folder, n_max)]
+
+
+def time_fn(fn: Callable, inputs: List, n_repeats: int = 3) -> Tuple[float, List]:
+    """Best-of-$n_repeats total time of calling $fn on every input, plus the outputs of the last run."""
+    best = float("inf")
+    outputs: List = []
+    for _ in range(n_repeats):
+        start = perf_counter()
+        outputs = [fn(x) for x in inputs]
+        best = min(best, perf_counter() - start)
+    return best, outputs
+
+
+def make_composite_figures(
+    micrographs: List[Image.Image], n_figures: int = 40, seed: int = 2189
+) -> List[Image.Image]:
+    """Tile random micrographs into grid-layout multi-panel figures with white gutters of random width, roughly
+    the size of a pdffigures2 figure at 200 DPI, to stand in for extracted composite figures."""
+    rng = np.random.default_rng(seed)
+    figures = []
+    for _ in range(n_figures):
+        n_rows, n_cols = rng.integers(1, 4), rng.integers(1, 5)
+        size, gutter = int(rng.integers(250, 450)), int(rng.integers(4, 30))
+        step = size + gutter
+        canvas = Image.new("RGB", (n_cols * step + gutter, n_rows * step + gutter), "white")
+        for row in range(n_rows):
+            for col in range(n_cols):
+                micrograph = micrographs[rng.integers(len(micrographs))]
+                canvas.paste(micrograph.convert("RGB").resize((size, size)), (gutter + col * step, gutter + row * step))
+        figures.append(canvas)
+    return figures
+
+
+def bbox_iou(a: List[int], b: List[int]) -> float:
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def bbox_agreement(
+    reference: List[List[List[int]]], candidate: List[List[List[int]]], iou_threshold: float = 0.9
+) -> dict:
+    """Compare per-image bbox lists to a reference: fraction of images with the same number of boxes, fraction
+    of reference boxes with a candidate box above $iou_threshold, the mean best IoU of reference boxes and the
+    worst corner error (px) of matched boxes."""
+    same_count, n_matched, n_ref, ious, max_err = 0, 0, 0, [], 0
+    for ref_bboxes, cand_bboxes in zip(reference, candidate):
+        same_count += len(ref_bboxes) == len(cand_bboxes)
+        for ref_bbox in ref_bboxes:
+            n_ref += 1
+            if len(cand_bboxes) == 0:
+                ious.append(0.0)
+                continue
+            best = max(cand_bboxes, key=lambda c: bbox_iou(ref_bbox, c))
+            iou = bbox_iou(ref_bbox, best)
+            ious.append(iou)
+            if iou >= iou_threshold:
+                n_matched += 1
+                max_err = max(max_err, max(abs(r - c) for r, c in zip(ref_bbox, best)))
+    return {
+        "same_count": same_count / max(len(reference), 1),
+        "matched": n_matched / max(n_ref, 1),
+        "mean_iou": float(np.mean(ious)) if len(ious) > 0 else 1.0,
+        "max_corner_err_px": max_err,
+    }
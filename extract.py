@@ -3,11 +3,22 @@ import numpy as np
 from PIL import Image
 from skimage.measure import label
 from skimage.morphology import binary_opening
-from os import getcwd, listdir, system
+from scipy.ndimage import find_objects
+from os import getcwd, listdir, system, makedirs, cpu_count
+from os.path import exists, basename, getmtime
+from shutil import copyfile, rmtree
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from functools import lru_cache
+from threading import Lock
 import json
-from typing import List, Tuple
+from typing import List, Tuple, TYPE_CHECKING
 import argparse
 
+if TYPE_CHECKING:
+    from extract_worker import ExtractionWorker
+    from extraction_cache import ExtractionCache
+
 # ==================================== EXTRACT FIGURES AND CAPTIONS ====================================
 
 CWD = getcwd()
@@ -18,6 +29,24 @@ TEST_IMG_PATH: str = f"{CWD}/outputs/imgs/"
 TEST_DATA_PATH: str = f"{CWD}/outputs/data/"
 
 
+def get_pdff2_args(
+    abs_read_path: str,
+    abs_img_save_path: str,
+    abs_caption_save_path: str,
+    DPI: int = 200,
+    continue_on_err: bool = True,
+    n_threads: int = 1,
+) -> List[str]:
+    """Command line arguments for FigureExtractorBatchCli (shared by one-off sbt runs and the warm worker)."""
+    args = [abs_read_path, "-m", abs_img_save_path, "-d", abs_caption_save_path, "-i", f"{DPI}"]
+    if continue_on_err is True:
+        args.append("-e")
+    if n_threads > 1:
+        # only used when abs_read_path is a directory: pdffigures2 processes the pdfs in parallel
+        args += ["-t", f"{n_threads}"]
+    return args
+
+
 def extract_figures_captions(
     abs_read_path: str,
     abs_img_save_path: str,
@@ -26,6 +55,7 @@ def extract_figures_captions(
     verbose: bool = False,
     continue_on_err: bool = True,
     use_jar: bool = False,
+    n_threads: int = 1,
 ) -> int:
     """Run pdffigures2 (https://github.com/allenai/pdffigures2) on pdf file/directory, saving output figures and captions to given directory.
 
@@ -47,15 +77,16 @@ def extract_figures_captions(
     :type DPI: int, optional
     :param continue_on_err: whether pdffigures2 will continue if encounters an error, defaults to True
     :type continue_on_err: bool, optional
+    :param n_threads: number of threads pdffigures2 uses when given a directory of pdfs, defaults to 1
+    :type n_threads: int, optional
     :return: exit code, 0 for success, 1 for failure
     :rtype: int
     """
-    run_str: str = (
-        f"{PDFF2_CMD} {abs_read_path} -m {abs_img_save_path} -d {abs_caption_save_path} -i {DPI} "
+    run_str: str = f"{PDFF2_CMD} " + " ".join(
+        get_pdff2_args(
+            abs_read_path, abs_img_save_path, abs_caption_save_path, DPI, continue_on_err, n_threads
+        )
     )
-    # close the quotation marks that form the sbt argument, either with command to ignore errors or just a quotation mark
-    if continue_on_err is True:
-        run_str += "-e "
     stdout = subprocess.STDOUT
     if verbose is False:
         stdout = subprocess.DEVNULL
@@ -74,6 +105,8 @@ def extract_figures_captions(
             "-i",
             f"{DPI}",
         ]
+        if n_threads > 1:
+            cmd_list += ["-t", f"{n_threads}"]
         cmd_str = f"cd {CWD}/pdffigures2;" + " ".join(cmd_list) + " > /dev/null"
         try:
             system(cmd_str)
@@ -106,6 +139,15 @@ def get_figure_number(fig_img_fname: str) -> int:
 WHITE_CUTOFF: int = 250  # pixel value to treat as white i.e bg
 AREA_CUTOFF: int = 200 * 200  # smallest figure size
 OFFSETS = [(3, 3), (-3, -3)]
+# detect subfigures on a copy downsampled by this factor (1 = full resolution), see `get_subimage_bboxes`
+DETECTION_SCALE: int = 1
+SPLIT_ENGINE: str = "cc"  # "cc" (connected components) or "xycut", see `split_composite_figure`
+XYCUT_MIN_GAP: int = 5  # narrowest white gutter (px) the xycut engine will cut along
+XYCUT_NOISE_TOL: int = 2  # dark pixels a row/column can have and still count as gutter
+# save only the parent figure (.png) + a bbox manifest (.json) and crop subfigures on demand, see `load_subfigure`
+LAZY_SUBFIGURES: bool = False
+# cap on the processes of the shared split pool, however many threads split at once, see `_get_split_pool`
+MAX_SPLIT_WORKERS: int = cpu_count() or 1
 
 
 def arr_to_img(arr: np.ndarray, mode="RGB") -> Image.Image:
@@ -116,6 +158,27 @@ def img_to_arr(img: Image.Image, mode="RGB") -> np.ndarray:
     return np.array(img.convert(mode))
 
 
+def figure_to_arrs(figure: Image.Image) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode a figure once into read-only RGB and greyscale arrays for splitting. Unlike two `img_to_arr` calls,
+    an RGB (or L) figure isn't converted to its own mode first, so there is one decode and one copy per plane
+    (`np.asarray` copies PIL's pixels). The greyscale plane is made from the decoded image by PIL's C converter
+    (`convert("L")`), which is faster than the equivalent (exact) integer maths in numpy. For L figures there
+    is only the greyscale copy and the RGB array is a broadcast view of it.
+
+    :param figure: figure image
+    :type figure: Image.Image
+    :return: RGB array shape (h, w, 3) and greyscale array shape (h, w), both read-only
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    if figure.mode == "L":
+        greyscale_arr = np.asarray(figure)
+        rgb_arr = np.broadcast_to(greyscale_arr[:, :, None], (*greyscale_arr.shape, 3))
+        return rgb_arr, greyscale_arr
+    if figure.mode != "RGB":
+        figure = figure.convert("RGB")
+    return np.asarray(figure), np.asarray(figure.convert("L"))
+
+
 def get_bbox(
     arr: np.ndarray, offsets: List[Tuple[int, int]] = [(0, 0), (0, 0)]
 ) -> List[int]:
@@ -140,7 +203,8 @@ def get_bbox(
 
 
 def binarize_img(greyscale_figure_arr: np.ndarray, cutoff_val: int) -> np.ndarray:
-    binary_arr = np.where(greyscale_figure_arr < cutoff_val, 1, 0)
+    # bool rather than np.where(..., 1, 0), which allocates an int64 array 8x the size of the figure
+    binary_arr = greyscale_figure_arr < cutoff_val
     opened = binary_opening(binary_arr)
     return opened
 
@@ -154,41 +218,226 @@ def check_area_from_bbox(bbox: List[int], area_cutoff: int) -> bool:
         return False
 
 
-def get_subimage_bboxes(greyscale_figure_arr: np.ndarray) -> List[List[int]]:
+def get_subimage_bboxes(greyscale_figure_arr: np.ndarray, scale: int = 1) -> List[List[int]]:
     """Binarize figure by setting all pixels above cutoff (i.e white pixels from borders) to 0.
     Next, morphologically open the image to get rid of pixel artefacts, then use skimage.label
     to assign labels to connected components. Finally find bboxes for each connected component
     and return.
 
+    If $scale > 1, the binarize/open/label steps run on a copy downsampled by $scale (see
+    `downsample_min`) and the bboxes are mapped back to full resolution before the offsets and
+    area cutoff are applied, so the output is in the same units as for $scale = 1.
+
     :param greyscale_figure_arr: a composite figure with white borders around each subfigure
     :type greyscale_figure_arr: np.ndarray
+    :param scale: integer downsampling factor for detection, defaults to 1 (full resolution)
+    :type scale: int, optional
     :return: list of bounding boxes of subfigures in the image
     :rtype: List[List[int]]
     """
-    binary_arr = binarize_img(greyscale_figure_arr, WHITE_CUTOFF)
-    labelled_arr, n_subimages = label(binary_arr, return_num=True)  # type: ignore
-    bboxes: List[List[int]] = []
-    for i in range(1, n_subimages + 1):
-        current_mask = np.where(labelled_arr == i, 1, 0)
-        bbox = get_bbox(current_mask, OFFSETS)
-        is_valid = check_area_from_bbox(bbox, AREA_CUTOFF)
-        if is_valid:
-            bboxes.append(bbox)
-    return bboxes
-
-
-def split_composite_figure(figure: Image.Image) -> List[np.ndarray]:
-    rgb_arr = img_to_arr(figure)
-    greyscale_arr = img_to_arr(figure, "L")
-    bboxes = get_subimage_bboxes(greyscale_arr)
+    if scale > 1:
+        detection_arr = downsample_min(greyscale_figure_arr, scale)
+    else:
+        detection_arr = greyscale_figure_arr
+    binary_arr = binarize_img(detection_arr, WHITE_CUTOFF)
+    labelled_arr = label(binary_arr)
+    if scale > 1:
+        h, w = greyscale_figure_arr.shape[:2]
+        bboxes = upscale_bboxes(get_label_bboxes(labelled_arr), scale, h, w)
+        ox0, oy0 = OFFSETS[0]
+        ox1, oy1 = OFFSETS[1]
+        bboxes += np.array([ox0, oy0, ox1, oy1], dtype=np.int64)
+    else:
+        bboxes = get_label_bboxes(labelled_arr, OFFSETS)
+    return filter_bboxes_by_area(bboxes, AREA_CUTOFF).tolist()
+
+
+def downsample_min(greyscale_arr: np.ndarray, scale: int) -> np.ndarray:
+    """Downsample by taking the darkest pixel of each $scale x $scale block. A block is only white if all of
+    its pixels are, so gutters stay white and thin dark content (lines, text) isn't averaged away, which
+    means WHITE_CUTOFF can be used unchanged. The edges are padded with white.
+
+    :param greyscale_arr: greyscale array shape (h, w)
+    :type greyscale_arr: np.ndarray
+    :param scale: integer downsampling factor
+    :type scale: int
+    :return: array shape (ceil(h / scale), ceil(w / scale))
+    :rtype: np.ndarray
+    """
+    h, w = greyscale_arr.shape
+    pad_h, pad_w = (-h) % scale, (-w) % scale
+    padded = np.pad(greyscale_arr, ((0, pad_h), (0, pad_w)), constant_values=255)
+    blocks = padded.reshape((h + pad_h) // scale, scale, (w + pad_w) // scale, scale)
+    return blocks.min(axis=(1, 3))
+
+
+def upscale_bboxes(bboxes: np.ndarray, scale: int, h: int, w: int) -> np.ndarray:
+    """Map inclusive x0 y0 x1 y1 bboxes found on a `downsample_min` copy back to the full resolution (h, w)
+    array: each low-res pixel covers a $scale x $scale block, so x1/y1 map to the end of their block."""
+    full_res = bboxes * scale
+    full_res[:, 2:] += scale - 1
+    full_res[:, 2] = np.minimum(full_res[:, 2], w - 1)
+    full_res[:, 3] = np.minimum(full_res[:, 3], h - 1)
+    return full_res
+
+
+def get_label_bboxes(
+    labelled_arr: np.ndarray, offsets: List[Tuple[int, int]] = [(0, 0), (0, 0)]
+) -> np.ndarray:
+    """Bboxes of every connected component in one pass over the labelled array (scipy's find_objects),
+    instead of masking the array once per label. Same convention as `get_bbox`, i.e inclusive max x/y.
+
+    :param labelled_arr: int array shape (h, w), 0 is background and components are labelled 1...n
+    :type labelled_arr: np.ndarray
+    :param offsets: bbox offsets (if img cropped), defaults to (0, 0)
+    :type offsets: List[Tuple[int, int]], optional
+    :return: int array shape (n, 4) of bboxes in form x0 y0 x1 y1, in label order
+    :rtype: np.ndarray
+    """
+    slices = [s for s in find_objects(labelled_arr) if s is not None]
+    if len(slices) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    # find_objects returns slices with exclusive stops: (ys, xs) -> x_min, y_min, x_max, y_max
+    bboxes = np.array(
+        [(xs.start, ys.start, xs.stop - 1, ys.stop - 1) for ys, xs in slices], dtype=np.int64
+    )
+    ox0, oy0 = offsets[0]
+    ox1, oy1 = offsets[1]
+    return bboxes + np.array([ox0, oy0, ox1, oy1], dtype=np.int64)
+
+
+def filter_bboxes_by_area(bboxes: np.ndarray, area_cutoff: int) -> np.ndarray:
+    """Vectorised `check_area_from_bbox` over an (n, 4) array of x0 y0 x1 y1 bboxes."""
+    areas = (bboxes[:, 3] - bboxes[:, 1]) * (bboxes[:, 2] - bboxes[:, 0])
+    return bboxes[areas > area_cutoff]
+
+
+def get_content_spans(dark_counts: np.ndarray, min_gap: int, noise_tol: int) -> List[Tuple[int, int]]:
+    """Given the number of dark pixels in each row (or column) of a region, return the (start, stop) spans of
+    content between white gutters at least $min_gap wide. Leading/trailing white is trimmed.
+
+    :param dark_counts: number of non-white pixels per row/column, shape (n,)
+    :type dark_counts: np.ndarray
+    :param min_gap: narrowest gutter to split on, narrower white runs are treated as part of the content
+    :type min_gap: int
+    :param noise_tol: rows/columns with at most this many dark pixels count as white
+    :type noise_tol: int
+    :return: list of [start, stop) spans
+    :rtype: List[Tuple[int, int]]
+    """
+    is_content = dark_counts > noise_tol
+    # +1 at content run starts, -1 at content run ends
+    edges = np.diff(is_content.astype(np.int8), prepend=0, append=0)
+    starts, stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    spans: List[Tuple[int, int]] = []
+    for start, stop in zip(starts, stops):
+        if len(spans) > 0 and start - spans[-1][1] < min_gap:
+            spans[-1] = (spans[-1][0], int(stop))
+        else:
+            spans.append((int(start), int(stop)))
+    return spans
+
+
+def xycut(
+    binary_arr: np.ndarray, x0: int, y0: int, min_gap: int, noise_tol: int
+) -> List[List[int]]:
+    """Recursive XY-cut: split the region along every horizontal gutter, or failing that every vertical one, and
+    recurse into the pieces. Regions with no gutters in either direction are leaves.
+
+    :return: leaf bboxes in form x0 y0 x1 y1 (inclusive max, like `get_bbox`) in full figure coordinates
+    :rtype: List[List[int]]
+    """
+    row_spans = get_content_spans(np.count_nonzero(binary_arr, axis=1), min_gap, noise_tol)
+    if len(row_spans) == 0:
+        return []
+    if len(row_spans) > 1:
+        leaves = []
+        for start, stop in row_spans:
+            leaves += xycut(binary_arr[start:stop], x0, y0 + start, min_gap, noise_tol)
+        return leaves
+
+    y_start, y_stop = row_spans[0]
+    band = binary_arr[y_start:y_stop]
+    col_spans = get_content_spans(np.count_nonzero(band, axis=0), min_gap, noise_tol)
+    if len(col_spans) > 1:
+        leaves = []
+        for start, stop in col_spans:
+            leaves += xycut(band[:, start:stop], x0 + start, y0 + y_start, min_gap, noise_tol)
+        return leaves
+    if len(col_spans) == 0:
+        return []
+    x_start, x_stop = col_spans[0]
+    return [[x0 + x_start, y0 + y_start, x0 + x_stop - 1, y0 + y_stop - 1]]
+
+
+def get_subimage_bboxes_xycut(
+    greyscale_figure_arr: np.ndarray,
+    scale: int = 1,
+    min_gap: int = XYCUT_MIN_GAP,
+    noise_tol: int = XYCUT_NOISE_TOL,
+) -> List[List[int]]:
+    """Find subfigure bboxes by recursively cutting the figure along white gutters found from row/column
+    whiteness profiles (XY-cut). This only needs a threshold and a couple of reductions per region, compared to
+    the opening + labelling of `get_subimage_bboxes`, and suits the common grid-layout figure.
+
+    If the cut tree is degenerate (no gutters found, or no leaf passes the area cutoff), e.g for non-grid
+    layouts where panels overlap in both projections, fall back to the connected-component engine.
+
+    :param greyscale_figure_arr: a composite figure with white borders around each subfigure
+    :type greyscale_figure_arr: np.ndarray
+    :param scale: downsampling factor of the connected-component fallback, defaults to 1
+    :type scale: int, optional
+    :param min_gap: narrowest gutter to split on, defaults to XYCUT_MIN_GAP
+    :type min_gap: int, optional
+    :param noise_tol: max dark pixels in a gutter row/column, defaults to XYCUT_NOISE_TOL
+    :type noise_tol: int, optional
+    :return: list of bounding boxes of subfigures in the image
+    :rtype: List[List[int]]
+    """
+    binary_arr = greyscale_figure_arr < WHITE_CUTOFF
+    leaves = xycut(binary_arr, 0, 0, min_gap, noise_tol)
+    if len(leaves) <= 1:
+        return get_subimage_bboxes(greyscale_figure_arr, scale)
+    ox0, oy0 = OFFSETS[0]
+    ox1, oy1 = OFFSETS[1]
+    bboxes = np.array(leaves, dtype=np.int64) + np.array([ox0, oy0, ox1, oy1], dtype=np.int64)
+    bboxes = filter_bboxes_by_area(bboxes, AREA_CUTOFF)
+    if len(bboxes) == 0:
+        return get_subimage_bboxes(greyscale_figure_arr, scale)
+    return bboxes.tolist()
+
+
+SPLIT_ENGINES = {"cc": get_subimage_bboxes, "xycut": get_subimage_bboxes_xycut}
+
+
+def split_composite_figure(
+    figure: Image.Image, scale: int = 1, engine: str = "cc"
+) -> List[np.ndarray]:
+    """Split a composite figure into its subfigures.
+
+    :param figure: composite figure
+    :type figure: Image.Image
+    :param scale: downsampling factor for subfigure detection, defaults to 1
+    :type scale: int, optional
+    :param engine: "cc" (`get_subimage_bboxes`) or "xycut" (`get_subimage_bboxes_xycut`), defaults to "cc"
+    :type engine: str, optional
+    :return: RGB arrays of each subfigure, as read-only views into the decoded figure
+    :rtype: List[np.ndarray]
+    """
+    rgb_arr, greyscale_arr = figure_to_arrs(figure)
+    bboxes = SPLIT_ENGINES[engine](greyscale_arr, scale)
     out_img_arrs = []
     for bbox in bboxes:
-        x0, y0, x1, y1 = bbox
-        current_subimg = rgb_arr[y0:y1, x0:x1, :]
+        current_subimg = crop_bbox(rgb_arr, bbox)
         out_img_arrs.append(current_subimg)
     return out_img_arrs
 
 
+def crop_bbox(rgb_arr: np.ndarray, bbox: List[int]) -> np.ndarray:
+    x0, y0, x1, y1 = bbox
+    return rgb_arr[y0:y1, x0:x1, :]
+
+
 # ==================================== FILE I/O ====================================
 
 
@@ -235,20 +484,266 @@ def get_caption(all_captions: List[dict], idx: int) -> str:
     return "not found"
 
 
+def split_and_save_figure(
+    fig_path: str,
+    out_prefix: str,
+    save_original_figure: bool = True,
+    scale: int = 1,
+    engine: str = "cc",
+    lazy: bool = False,
+) -> List[str]:
+    """Open a figure, split it into subfigures and save each as <out_prefix>_<i>.jpg (and the figure itself as
+    <out_prefix>.jpg). Module-level so it can be sent to worker processes.
+
+    If $lazy, only the figure (losslessly, as <out_prefix>.png) and the subfigure bboxes (<out_prefix>.json) are
+    saved. The returned paths are the same, and `load_subfigure` crops them from the figure when needed. The
+    .png doubles as the original figure, so $save_original_figure is ignored.
+
+    :param fig_path: path of the figure image
+    :type fig_path: str
+    :param out_prefix: path prefix of the saved (sub)figures
+    :type out_prefix: str
+    :param save_original_figure: save the unsplit figure as well, defaults to True
+    :type save_original_figure: bool, optional
+    :param scale: downsampling factor for subfigure detection, defaults to 1
+    :type scale: int, optional
+    :param engine: subfigure detection engine, see `split_composite_figure`, defaults to "cc"
+    :type engine: str, optional
+    :param lazy: save a bbox manifest instead of the subfigures, defaults to False
+    :type lazy: bool, optional
+    :return: paths of the saved subfigures, in split order
+    :rtype: List[str]
+    """
+    img = Image.open(fig_path)
+    if lazy:
+        return save_subfigure_manifest(img, fig_path, out_prefix, scale, engine)
+    # Alway split - if it's a single figure it (hopefully) won't split anyway
+    split_arrs = split_composite_figure(img, scale, engine)
+    if save_original_figure:
+        img.save(f"{out_prefix}.jpg")
+
+    img_paths: List[str] = []
+    for i, arr in enumerate(split_arrs):
+        arr_to_img(arr, "RGB").save(f"{out_prefix}_{i}.jpg")
+        img_paths.append(f"{out_prefix}_{i}.jpg")
+    return img_paths
+
+
+_split_pool: ProcessPoolExecutor | None = None
+_split_pool_workers: int = 0
+_split_pool_lock = Lock()
+
+
+def _get_split_pool(n_workers: int) -> ProcessPoolExecutor:
+    """Process pool shared by every `split_and_save_figures` call in this process, so workers are spawned (and
+    import numpy/skimage) once per run rather than once per paper, and threads splitting at once share them.
+    Made on first use, and replaced by a bigger one if a call asks for more workers (up to MAX_SPLIT_WORKERS).
+    Call with `_split_pool_lock` held. Shut it down with `shutdown_split_pool` at the end of a run."""
+    global _split_pool, _split_pool_workers
+    n_workers = min(n_workers, MAX_SPLIT_WORKERS)
+    if _split_pool is None or _split_pool_workers < n_workers:
+        if _split_pool is not None:
+            _split_pool.shutdown(wait=False)  # jobs already submitted to it still run
+        _split_pool = ProcessPoolExecutor(max_workers=n_workers)
+        _split_pool_workers = n_workers
+    return _split_pool
+
+
+def shutdown_split_pool() -> None:
+    global _split_pool
+    with _split_pool_lock:
+        if _split_pool is not None:
+            _split_pool.shutdown()
+            _split_pool = None
+
+
+def split_and_save_figures(
+    fig_paths: List[str],
+    out_prefixes: List[str],
+    save_original_figures: bool = True,
+    n_workers: int = 1,
+    scale: int | None = None,
+    engine: str | None = None,
+    lazy: bool | None = None,
+) -> List[List[str]]:
+    """Run `split_and_save_figure` over every figure, distributed over the shared split pool of $n_workers
+    processes (see `_get_split_pool`) if > 1. Results are returned in the order of $fig_paths regardless of which
+    worker finishes first.
+
+    :param n_workers: number of worker processes, defaults to 1 (split in this process)
+    :type n_workers: int, optional
+    :param scale: downsampling factor for subfigure detection, defaults to DETECTION_SCALE
+    :type scale: int | None, optional
+    :param engine: subfigure detection engine, defaults to SPLIT_ENGINE
+    :type engine: str | None, optional
+    :param lazy: save bbox manifests instead of the subfigures, defaults to LAZY_SUBFIGURES
+    :type lazy: bool | None, optional
+    :return: paths of the saved subfigures of each figure
+    :rtype: List[List[str]]
+    """
+    # resolve here rather than in the workers, which may not share this process' globals
+    if scale is None:
+        scale = DETECTION_SCALE
+    if engine is None:
+        engine = SPLIT_ENGINE
+    if lazy is None:
+        lazy = LAZY_SUBFIGURES
+    n = len(fig_paths)
+    if n_workers <= 1 or n <= 1:
+        return [
+            split_and_save_figure(fig_path, out_prefix, save_original_figures, scale, engine, lazy)
+            for fig_path, out_prefix in zip(fig_paths, out_prefixes)
+        ]
+    with _split_pool_lock:
+        pool = _get_split_pool(n_workers)
+        futures = [
+            pool.submit(split_and_save_figure, fig_path, out_prefix, save_original_figures, scale, engine, lazy)
+            for fig_path, out_prefix in zip(fig_paths, out_prefixes)
+        ]
+    return [future.result() for future in futures]
+
+
+# ==================================== LAZY SUBFIGURES ====================================
+
+# Most subfigures are rejected by the LLM/VLM labelling, so in lazy mode they aren't encoded at extraction time.
+# <prefix>.png is the figure as extracted by pdffigures2 and <prefix>.json lists the subfigure bboxes, where
+# <prefix> is e.g "dataset/papers/<paper>/imgs/captions_fig_3". Subfigure <prefix>_<i>.jpg is then cropped
+# from the .png on demand - the crop is identical to what eager splitting would have encoded.
+
+
+def save_subfigure_manifest(
+    figure: Image.Image, fig_path: str, out_prefix: str, scale: int = 1, engine: str = "cc"
+) -> List[str]:
+    """Save $figure as <out_prefix>.png and the bboxes of its subfigures as <out_prefix>.json.
+
+    :return: (virtual) paths of the subfigures, <out_prefix>_<i>.jpg
+    :rtype: List[str]
+    """
+    _, greyscale_arr = figure_to_arrs(figure)
+    bboxes = SPLIT_ENGINES[engine](greyscale_arr, scale)
+    if fig_path.endswith(".png"):
+        copyfile(fig_path, f"{out_prefix}.png")  # pdffigures2 output is already png, don't re-encode
+    else:
+        figure.save(f"{out_prefix}.png")
+    manifest = {"size": list(figure.size), "bboxes": bboxes}
+    with open(f"{out_prefix}.json", "w") as f:
+        json.dump(manifest, f)
+    return [f"{out_prefix}_{i}.jpg" for i in range(len(bboxes))]
+
+
+def split_subfigure_path(img_path: str) -> Tuple[str, int]:
+    """'<prefix>_<i>.jpg' -> ('<prefix>', i)"""
+    prefix, idx = img_path.rsplit(".", 1)[0].rsplit("_", 1)
+    return prefix, int(idx)
+
+
+@lru_cache(maxsize=4)
+def _load_figure_arr(fig_path: str, mtime: float) -> np.ndarray:
+    # subfigures of the same figure are usually loaded together, so keep the last few decoded figures around
+    rgb_arr, _ = figure_to_arrs(Image.open(fig_path))
+    return rgb_arr
+
+
+def load_subfigure_manifest(out_prefix: str) -> dict:
+    with open(f"{out_prefix}.json") as f:
+        return json.load(f)
+
+
+def load_subfigure(img_path: str, memoise: bool = False) -> np.ndarray:
+    """Get the RGB array of subfigure $img_path (as returned by `single_pdf_extract_process`), reading it if it
+    was saved eagerly (or memoised) and otherwise cropping it from its figure using the bbox manifest. The figure
+    itself, <prefix>.jpg, is read from <prefix>.png in lazy mode.
+
+    :param img_path: path of the subfigure, <prefix>_<i>.jpg (or of the figure, <prefix>.jpg)
+    :type img_path: str
+    :param memoise: save the cropped subfigure to $img_path so later loads (and other tools) can read it,
+        defaults to False
+    :type memoise: bool, optional
+    :return: RGB array shape (h, w, 3)
+    :rtype: np.ndarray
+    """
+    if exists(img_path):
+        return img_to_arr(Image.open(img_path), "RGB")
+    fig_path = f"{img_path.rsplit('.', 1)[0]}.png"
+    if exists(fig_path):  # <prefix>.jpg, the figure itself
+        return np.array(_load_figure_arr(fig_path, getmtime(fig_path)))
+    prefix, idx = split_subfigure_path(img_path)
+    bbox = load_subfigure_manifest(prefix)["bboxes"][idx]
+    rgb_arr = _load_figure_arr(f"{prefix}.png", getmtime(f"{prefix}.png"))
+    arr = np.array(crop_bbox(rgb_arr, bbox))
+    if memoise:
+        arr_to_img(arr, "RGB").save(img_path)
+    return arr
+
+
+def list_imgs(imgs_path: str) -> List[str]:
+    """Sorted file names of a paper's imgs folder as eager mode would have saved them: a lazily saved figure's
+    <prefix>.png and <prefix>.json are listed as <prefix>.jpg and its subfigures <prefix>_<i>.jpg, which
+    `load_subfigure` / `load_subfigure_bytes` read. Folders extracted eagerly are listed as they are.
+
+    :param imgs_path: path of the imgs folder
+    :type imgs_path: str
+    :return: file names, i.e for globbing in place of `listdir`
+    :rtype: List[str]
+    """
+    names = set(listdir(imgs_path))
+    for name in [name for name in names if name.endswith(".json")]:
+        prefix = name[: -len(".json")]
+        if f"{prefix}.png" not in names:
+            continue
+        n_subfigures = len(load_subfigure_manifest(f"{imgs_path}/{prefix}")["bboxes"])
+        names -= {name, f"{prefix}.png"}
+        names.update([f"{prefix}.jpg"] + [f"{prefix}_{i}.jpg" for i in range(n_subfigures)])
+    return sorted(names)
+
+
+def load_subfigure_bytes(img_path: str, memoise: bool = False, img_format: str = "JPEG") -> bytes:
+    """Encoded bytes of subfigure $img_path, i.e for sending to an API. An eagerly saved (or memoised) .jpg is
+    returned as-is rather than re-encoded.
+
+    :param img_path: path of the subfigure, <prefix>_<i>.jpg (or of the figure, <prefix>.jpg)
+    :type img_path: str
+    :param memoise: save the cropped subfigure to $img_path, defaults to False
+    :type memoise: bool, optional
+    :param img_format: PIL format to encode a cropped subfigure with, defaults to "JPEG"
+    :type img_format: str, optional
+    :return: encoded image
+    :rtype: bytes
+    """
+    if exists(img_path) and img_format == "JPEG":
+        with open(img_path, "rb") as f:
+            return f.read()
+    arr = load_subfigure(img_path)
+    buffer = BytesIO()
+    arr_to_img(arr, "RGB").save(buffer, format=img_format)
+    if memoise and img_format == "JPEG":
+        with open(img_path, "wb") as f:
+            f.write(buffer.getvalue())
+    return buffer.getvalue()
+
+
+def sort_figure_paths(fig_paths: List[str]) -> List[str]:
+    """Sort pdffigures2 output by (figure number, name) so outputs don't depend on listdir order."""
+    return sorted(fig_paths, key=lambda p: (get_figure_number(basename(p)), basename(p)))
+
+
 def batch_extract_and_process(
-    pdf_folder_path: str, out_img_path: str, out_data_path: str, out_processed_path: str
+    pdf_folder_path: str,
+    out_img_path: str,
+    out_data_path: str,
+    out_processed_path: str,
+    n_workers: int = 1,
 ) -> None:
     extract_figures_captions(pdf_folder_path, out_img_path, out_data_path)
 
-    for j, img_path in enumerate(listdir(out_img_path)):
+    fig_paths: List[str] = []
+    out_prefixes: List[str] = []
+    for j, img_path in enumerate(sort_figure_paths(listdir(out_img_path))):
         if "Table" in img_path:
             continue
-        img = Image.open(f"{out_img_path}{img_path}").convert("L")
-        arr = img_to_arr(img, "L")
-        split_arrs = split_composite_figure(img)
-        for i, arr in enumerate(split_arrs):
-            img = arr_to_img(arr, "RGB")
-            img.save(f"{out_processed_path}p{j}_{i}.jpg")
+        fig_paths.append(f"{out_img_path}{img_path}")
+        out_prefixes.append(f"{out_processed_path}p{j}")
+    split_and_save_figures(fig_paths, out_prefixes, False, n_workers)
 
 
 def single_pdf_extract_process(
@@ -258,6 +753,9 @@ def single_pdf_extract_process(
     out_processed_path: str,
     save_original_figures: bool = True,
     use_jar: bool = False,
+    worker: "ExtractionWorker | None" = None,
+    n_workers: int = 1,
+    cache: "ExtractionCache | None" = None,
 ) -> Tuple[List[str], List[str]]:
     """Given ABSOLUTE path to PDF and ABSOLUTE paths to where to dump the images and caption data (usually .../tmp/),
     call pdffigures2 to extract. Then loop through all extracted images, find which figure they belong to and th
@@ -270,36 +768,201 @@ def single_pdf_extract_process(
     :type out_data_path: str
     :param out_processed_path: _description_
     :type out_processed_path: str
+    :param worker: warm pdffigures2 worker to submit the pdf to instead of launching sbt/java, defaults to None
+    :type worker: ExtractionWorker | None, optional
+    :param n_workers: number of processes to split and save figures with, defaults to 1
+    :type n_workers: int, optional
+    :param cache: content-addressed cache to reuse pdffigures2 output/split results of identical pdfs from,
+        defaults to None
+    :type cache: ExtractionCache | None, optional
     :return: _description_
     :rtype: Tuple[List[str], List[str]]
     """
     # TODO: edit this to just return list of captions and figure they belong to (1-indexed) to work with new file strucutre
     filename = pdf_path.split("/")[-1].split(".")[0]
-    extract_figures_captions(pdf_path, out_img_path, out_data_path, use_jar=use_jar)
+    is_cached = False
+    if cache is not None:
+        pdf_key = cache.pdf_key(pdf_path)
+        split_key = cache.split_key(pdf_key, save_original_figures)
+        result = cache.get_split(pdf_key, split_key, out_data_path, out_processed_path, filename)
+        if result is not None:
+            return result
+        is_cached = cache.get_extraction(pdf_key, out_img_path, out_data_path, filename)
+
+    if is_cached is False:
+        if worker is not None:
+            worker.submit(pdf_path, out_img_path, out_data_path)
+        else:
+            extract_figures_captions(pdf_path, out_img_path, out_data_path, use_jar=use_jar)
     json = load_list_json(f"{out_data_path}{filename}.json")
+    fig_paths = [f"{out_img_path}{fig_path}" for fig_path in listdir(out_img_path)]
+    if cache is not None and is_cached is False:
+        cache.put_extraction(pdf_key, fig_paths, f"{out_data_path}{filename}.json", filename)
+
+    captions, img_paths = process_extracted_figures(
+        fig_paths, json, out_processed_path, filename, save_original_figures, n_workers
+    )
+    if cache is not None:
+        cache.put_split(pdf_key, split_key, captions, img_paths, out_processed_path, filename)
+    return captions, img_paths
+
+
+def process_extracted_figures(
+    fig_paths: List[str],
+    all_captions: List[dict],
+    out_processed_path: str,
+    filename: str,
+    save_original_figures: bool = True,
+    n_workers: int = 1,
+) -> Tuple[List[str], List[str]]:
+    """Split each figure pdffigures2 extracted from a paper into subfigures and save them (and optionally the
+    original figure) as <filename>_fig_<n>_<i>.jpg, pairing each subfigure with its figure's caption.
+
+    :param fig_paths: paths of the figure images pdffigures2 extracted from the paper
+    :type fig_paths: List[str]
+    :param all_captions: list of figure dicts from the paper's pdffigures2 .json
+    :type all_captions: List[dict]
+    :param out_processed_path: folder to save the (sub)figures to
+    :type out_processed_path: str
+    :param filename: prefix of the saved (sub)figures
+    :type filename: str
+    :param save_original_figures: save the unsplit figure as well, defaults to True
+    :type save_original_figures: bool, optional
+    :param n_workers: number of processes to split and save figures with, defaults to 1
+    :type n_workers: int, optional
+    :return: caption and saved path of every subfigure, ordered by figure number then subfigure
+    :rtype: Tuple[List[str], List[str]]
+    """
+    figure_captions: List[str] = []
+    figure_paths: List[str] = []
+    out_prefixes: List[str] = []
+    for fig_path in sort_figure_paths(fig_paths):
+        fig_name = basename(fig_path)
+        fig_idx = get_figure_number(fig_name)
+        if "Table" in fig_name:
+            continue
+        figure_captions.append(get_caption(all_captions, fig_idx))
+        figure_paths.append(fig_path)
+        out_prefixes.append(f"{out_processed_path}{filename}_fig_{fig_idx}")
+
+    split_paths = split_and_save_figures(
+        figure_paths, out_prefixes, save_original_figures, n_workers=n_workers
+    )
     captions: List[str] = []
     img_paths: List[str] = []
-    for fig_path in listdir(out_img_path):
-        fig_idx = get_figure_number(fig_path)
-        if "Table" in fig_path:
-            continue
-        caption = get_caption(json, fig_idx)
-        img = Image.open(f"{out_img_path}{fig_path}")
-        # Alway split - if it's a single figure it (hopefully) won't split anyway
-        split_arrs = split_composite_figure(img)
-        if save_original_figures:
-            img.save(f"{out_processed_path}{filename}_fig_{fig_idx}.jpg")
-
-        for i, arr in enumerate(split_arrs):
-            img = arr_to_img(arr, "RGB")
-            img.save(f"{out_processed_path}{filename}_fig_{fig_idx}_{i}.jpg")
-            captions.append(caption)
-            img_paths.append(f"{out_processed_path}{filename}_fig_{fig_idx}_{i}.jpg")
+    for caption, subfig_paths in zip(figure_captions, split_paths):
+        captions += [caption] * len(subfig_paths)
+        img_paths += subfig_paths
     return captions, img_paths
 
 
+def reset_folder(path: str) -> None:
+    try:
+        rmtree(path)
+    except FileNotFoundError:
+        pass
+    makedirs(path)
+
+
+def batch_pdf_extract_process(
+    pdf_paths: List[str],
+    out_data_paths: List[str],
+    out_processed_paths: List[str],
+    shard_path: str,
+    out_names: List[str] | None = None,
+    n_threads: int = 4,
+    save_original_figures: bool = True,
+    use_jar: bool = False,
+    worker: "ExtractionWorker | None" = None,
+    n_workers: int = 1,
+    cache: "ExtractionCache | None" = None,
+) -> List[Tuple[List[str], List[str]]]:
+    """Batch version of `single_pdf_extract_process`: copy a shard of pdfs into one folder as p<i>.pdf, run
+    pdffigures2 once over the folder with $n_threads threads, then fan the figures (p<i>-Figure3-1.png) and
+    captions (p<i>.json) back out to each paper's own folders. Renaming to p<i> also avoids the hyphen/dot
+    restrictions on pdf names.
+
+    :param pdf_paths: ABSOLUTE paths of the pdfs in the shard
+    :type pdf_paths: List[str]
+    :param out_data_paths: per-pdf folder to save the caption .json to
+    :type out_data_paths: List[str]
+    :param out_processed_paths: per-pdf folder to save the (sub)figures to
+    :type out_processed_paths: List[str]
+    :param shard_path: ABSOLUTE scratch folder for the shard, wiped before use
+    :type shard_path: str
+    :param out_names: per-pdf name for the saved .json and (sub)figures, defaults to each pdf's filename
+    :type out_names: List[str] | None, optional
+    :param n_threads: number of threads pdffigures2 uses, defaults to 4
+    :type n_threads: int, optional
+    :param cache: content-addressed cache, pdfs with cached pdffigures2 output are left out of the shard and
+        pdfs with cached split results aren't processed at all, defaults to None
+    :type cache: ExtractionCache | None, optional
+    :return: (captions, img_paths) for each pdf, in the order of $pdf_paths. Empty if extraction failed for it
+    :rtype: List[Tuple[List[str], List[str]]]
+    """
+    if out_names is None:
+        out_names = [pdf_path.split("/")[-1].split(".")[0] for pdf_path in pdf_paths]
+    shard_pdf_path, shard_img_path, shard_data_path = [
+        f"{shard_path}{folder}/" for folder in ["pdfs", "imgs", "data"]
+    ]
+    for folder in [shard_pdf_path, shard_img_path, shard_data_path]:
+        reset_folder(folder)
+
+    results: List[Tuple[List[str], List[str]] | None] = [None for _ in pdf_paths]
+    pdf_keys, split_keys, is_cached = [], [], [False for _ in pdf_paths]
+    for i, pdf_path in enumerate(pdf_paths):
+        if cache is not None:
+            pdf_keys.append(cache.pdf_key(pdf_path))
+            split_keys.append(cache.split_key(pdf_keys[i], save_original_figures))
+            results[i] = cache.get_split(
+                pdf_keys[i], split_keys[i], out_data_paths[i], out_processed_paths[i], out_names[i]
+            )
+            if results[i] is not None:
+                continue
+            # restore cached pdffigures2 output into the shard as if it had just been extracted
+            is_cached[i] = cache.get_extraction(pdf_keys[i], shard_img_path, shard_data_path, f"p{i}")
+        if is_cached[i] is False:
+            copyfile(pdf_path, f"{shard_pdf_path}p{i}.pdf")
+
+    if len(listdir(shard_pdf_path)) > 0:
+        if worker is not None:
+            worker.submit(shard_pdf_path, shard_img_path, shard_data_path, n_threads=n_threads)
+        else:
+            extract_figures_captions(
+                shard_pdf_path, shard_img_path, shard_data_path, use_jar=use_jar, n_threads=n_threads
+            )
+
+    all_fig_paths = listdir(shard_img_path)
+    for i, out_name in enumerate(out_names):
+        data_path = f"{shard_data_path}p{i}.json"
+        if results[i] is not None:
+            continue
+        if not exists(data_path):
+            results[i] = ([], [])
+            continue
+        copyfile(data_path, f"{out_data_paths[i]}{out_name}.json")
+        fig_paths = [f"{shard_img_path}{p}" for p in all_fig_paths if p.startswith(f"p{i}-")]
+        if cache is not None and is_cached[i] is False:
+            cache.put_extraction(pdf_keys[i], fig_paths, data_path, f"p{i}")
+        captions, img_paths = process_extracted_figures(
+            fig_paths,
+            load_list_json(data_path),
+            out_processed_paths[i],
+            out_name,
+            save_original_figures,
+            n_workers,
+        )
+        if cache is not None:
+            cache.put_split(
+                pdf_keys[i], split_keys[i], captions, img_paths, out_processed_paths[i], out_name
+            )
+        results[i] = (captions, img_paths)
+    return results  # type: ignore
+
+
 if __name__ == "__main__":
     batch_extract_and_process(
         TEST_PDF_PATH, TEST_IMG_PATH, TEST_DATA_PATH, "outputs/processed/"
     )
+    shutdown_split_pool()
     # print(extract_first_page("sample_data/sem_diamond.pdf"))
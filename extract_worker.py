@@ -0,0 +1,237 @@
+import subprocess
+from threading import Thread, Lock
+from queue import Queue, Empty
+from time import perf_counter
+from dataclasses import dataclass
+from typing import List, IO
+import numpy as np
+
+from extract import PDFF2_PATH, PDFF2_CMD, extract_figures_captions, get_pdff2_args
+
+# ==================================== PERSISTENT PDFFIGURES2 WORKER ====================================
+
+# sbt reads commands line by line from stdin when not attached to a terminal (see build_scripts/build.sh),
+# so we keep a single sbt shell alive and feed it one `runMain` per PDF. The JVM, the compiled classes and
+# the JIT state are reused between jobs, so only the first job pays for sbt resolution and warm-up.
+SBT_FLAGS: List[str] = ["-Dsbt.supershell=false", "-Dsbt.log.noformat=true", "-Dsbt.color=false"]
+JOB_DONE_MARKER: str = "Total time:"  # sbt prints '[success] Total time: ...' or '[error] Total time: ...'
+STARTUP_TIMEOUT_S: float = 600
+JOB_TIMEOUT_S: float = 600
+
+
+@dataclass
+class JobResult:
+    pdf_path: str
+    exit_code: int
+    latency_s: float
+
+
+def _enqueue_lines(stream: IO[str], line_queue: Queue) -> None:
+    for line in iter(stream.readline, ""):
+        line_queue.put(line)
+    line_queue.put(None)  # EOF i.e the sbt process died
+
+
+class ExtractionWorker:
+    def __init__(
+        self,
+        use_jar: bool = False,
+        verbose: bool = False,
+        max_restarts: int = 3,
+        job_timeout_s: float = JOB_TIMEOUT_S,
+        command: List[str] | None = None,
+        cwd: str = PDFF2_PATH,
+    ) -> None:
+        """Long-lived pdffigures2 worker. With sbt, a warm sbt shell is driven over stdin/stdout and restarted
+        if it crashes or hangs. The shell is started by `start`, or by the first job submitted, so a worker
+        that's never used (i.e every paper is an extraction cache hit) never launches sbt. The standalone .jar
+        has no command loop, so in jar mode each job falls back to a single `java -jar` call (latency is still
+        tracked).
+
+        :param use_jar: use the pdffigures2.jar instead of the sbt project, defaults to False
+        :type use_jar: bool, optional
+        :param verbose: echo the sbt output, defaults to False
+        :type verbose: bool, optional
+        :param max_restarts: number of times a single job can restart a crashed worker before failing, defaults to 3
+        :type max_restarts: int, optional
+        :param job_timeout_s: seconds before a job is treated as hung and the worker is restarted
+        :type job_timeout_s: float, optional
+        :param command: command starting the shell, defaults to None (sbt with SBT_FLAGS)
+        :type command: List[str] | None, optional
+        :param cwd: folder to start the shell in, defaults to PDFF2_PATH
+        :type cwd: str, optional
+        """
+        self.use_jar = use_jar
+        self.verbose = verbose
+        self.max_restarts = max_restarts
+        self.job_timeout_s = job_timeout_s
+        self.command = command if command is not None else ["sbt", *SBT_FLAGS]
+        self.cwd = cwd
+
+        self.process: subprocess.Popen | None = None
+        self.lines: Queue = Queue()
+        self.n_restarts: int = 0
+        self.startup_s: float = 0  # of the latest start
+        self.total_startup_s: float = 0
+        self.jobs: List[JobResult] = []
+        # the sbt shell runs one command at a time, so concurrent submits (i.e from pipeline threads) take turns
+        self.lock = Lock()
+
+    def __enter__(self) -> "ExtractionWorker":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        if self.use_jar or self.is_alive():
+            return
+        start_time = perf_counter()
+        self.process = subprocess.Popen(
+            self.command,
+            cwd=self.cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+        self.lines = Queue()
+        Thread(target=_enqueue_lines, args=(self.process.stdout, self.lines), daemon=True).start()
+        # force project load + compile now so the first real job doesn't pay for it
+        self._send("compile")
+        success = self._wait_for_job(STARTUP_TIMEOUT_S)
+        if not success:  # timed out or the compile failed
+            self._kill()
+            raise RuntimeError("sbt worker failed to start - check pdffigures2/ builds with `sbt compile`")
+        self.startup_s = perf_counter() - start_time
+        self.total_startup_s += self.startup_s
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        if self.is_alive():
+            try:
+                self._send("exit")
+                self.process.wait(timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+        self.process = None
+
+    def _kill(self) -> None:
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def restart(self) -> None:
+        self._kill()
+        self.n_restarts += 1
+        self.start()
+
+    def _send(self, command: str) -> None:
+        assert self.process is not None and self.process.stdin is not None
+        self.process.stdin.write(command + "\n")
+        self.process.stdin.flush()
+
+    def _wait_for_job(self, timeout_s: float) -> bool | None:
+        """Consume sbt output until the end of the current command.
+
+        :return: True if the command succeeded, False if it errored and None if sbt died or timed out
+        :rtype: bool | None
+        """
+        deadline = perf_counter() + timeout_s
+        while True:
+            remaining = deadline - perf_counter()
+            try:
+                line = self.lines.get(timeout=max(remaining, 0))
+            except Empty:
+                line = None
+            if line is None:
+                # stdout can hit EOF before the process is reaped, so don't rely on poll() - drop it now
+                self._kill()
+                return None
+            if self.verbose:
+                print(line, end="")
+            if JOB_DONE_MARKER in line:
+                return line.startswith("[success]")
+
+    def submit(
+        self,
+        abs_read_path: str,
+        abs_img_save_path: str,
+        abs_caption_save_path: str,
+        DPI: int = 200,
+        continue_on_err: bool = True,
+        n_threads: int = 1,
+    ) -> int:
+        """Extract figures and captions of a pdf file/directory with the warm worker, same arguments and exit
+        code as `extract.extract_figures_captions`. Latency of every job, excluding (re)starting the shell, is
+        stored in `self.jobs`.
+
+        :return: exit code, 0 for success, 1 for failure
+        :rtype: int
+        """
+        start_time = perf_counter()
+        total_startup_s = self.total_startup_s
+        if self.use_jar:
+            exit_code = extract_figures_captions(
+                abs_read_path,
+                abs_img_save_path,
+                abs_caption_save_path,
+                DPI,
+                self.verbose,
+                continue_on_err,
+                use_jar=True,
+                n_threads=n_threads,
+            )
+        else:
+            args = get_pdff2_args(
+                abs_read_path, abs_img_save_path, abs_caption_save_path, DPI, continue_on_err, n_threads
+            )
+            run_str = f"{PDFF2_CMD} " + " ".join(args)
+            with self.lock:
+                total_startup_s = self.total_startup_s
+                exit_code = self._run(run_str)
+        latency = perf_counter() - start_time - (self.total_startup_s - total_startup_s)
+        self.jobs.append(JobResult(abs_read_path, exit_code, latency))
+        return exit_code
+
+    def _run(self, run_str: str) -> int:
+        exit_code = 1
+        for attempt in range(self.max_restarts + 1):
+            try:
+                if attempt > 0:
+                    # crashed or hung mid-job: throw away the JVM and try again from a fresh one
+                    self.restart()
+                elif not self.is_alive():
+                    self.start()
+                self._send(run_str)
+            except (RuntimeError, OSError) as err:
+                print(err)
+                continue
+            success = self._wait_for_job(self.job_timeout_s)
+            if success is not None:
+                exit_code = 0 if success else 1
+                break
+        return exit_code
+
+    def stats(self) -> dict:
+        latencies = np.array([job.latency_s for job in self.jobs])
+        n_failed = sum(job.exit_code != 0 for job in self.jobs)
+        if len(latencies) == 0:
+            latencies = np.zeros(1)
+        return {
+            "n_jobs": len(self.jobs),
+            "n_failed": n_failed,
+            "n_restarts": self.n_restarts,
+            "startup_s": self.startup_s,
+            "mean_latency_s": float(np.mean(latencies)),
+            "p50_latency_s": float(np.percentile(latencies, 50)),
+            "p95_latency_s": float(np.percentile(latencies, 95)),
+            "max_latency_s": float(np.amax(latencies)),
+        }
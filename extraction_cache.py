@@ -0,0 +1,253 @@
+import json
+import hashlib
+from os import listdir, makedirs, walk, utime
+from os.path import exists, getsize, getmtime, join
+from shutil import copyfile, rmtree
+from threading import RLock
+from time import time
+from typing import List, Tuple
+
+import extract
+from extract import CWD, PDFF2_PATH, get_figure_number
+
+# ==================================== CONTENT-ADDRESSED EXTRACTION CACHE ====================================
+
+# Two levels, so tweaking the splitting doesn't throw away the (expensive) pdffigures2 output:
+# <cache_path>/<pdf_key>/            pdffigures2 output: data.json, figures/*.png, meta.json
+# <cache_path>/<pdf_key>/<split_key>/ split results: the saved (sub)figures + meta.json
+# pdf_key hashes the pdf bytes + DPI + pdffigures2 version, split_key adds the splitting parameters.
+# Saved files are stored without the paper's filename prefix (i.e "-Figure1-1.png", "_fig_1_0.jpg") and
+# renamed on restore, so the same pdf downloaded under a different name still hits.
+CACHE_PATH: str = f"{CWD}/extraction_cache/"
+MAX_CACHE_BYTES: int = 10 * 1024**3
+HASH_CHUNK_BYTES: int = 1024 * 1024
+
+
+def get_pdff2_version() -> str:
+    """Git revision of the pdffigures2 checkout (or 'unknown'), so rebuilding a different version invalidates
+    cached extractions."""
+    head_path = f"{PDFF2_PATH}.git/HEAD"
+    try:
+        with open(head_path) as f:
+            head = f.read().strip()
+        if head.startswith("ref: "):
+            with open(f"{PDFF2_PATH}.git/{head[5:]}") as f:
+                head = f.read().strip()
+        return head
+    except OSError:
+        return "unknown"
+
+
+def get_split_params(save_original_figures: bool = True) -> dict:
+    """Parameters that change the split results. Read at call time so changes to the module constants count."""
+    return {
+        "WHITE_CUTOFF": extract.WHITE_CUTOFF,
+        "AREA_CUTOFF": extract.AREA_CUTOFF,
+        "OFFSETS": extract.OFFSETS,
+        "DETECTION_SCALE": extract.DETECTION_SCALE,
+        "SPLIT_ENGINE": extract.SPLIT_ENGINE,
+        "XYCUT_MIN_GAP": extract.XYCUT_MIN_GAP,
+        "XYCUT_NOISE_TOL": extract.XYCUT_NOISE_TOL,
+        "LAZY_SUBFIGURES": extract.LAZY_SUBFIGURES,
+        "save_original_figures": save_original_figures,
+    }
+
+
+def hash_params(params: dict, *parts: str) -> str:
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(part.encode())
+    hasher.update(json.dumps(params, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_dir_size(path: str) -> int:
+    return sum(getsize(join(root, f)) for root, _, files in walk(path) for f in files)
+
+
+def strip_prefix(name: str, prefix: str) -> str:
+    return name[len(prefix) :] if name.startswith(prefix) else name
+
+
+class ExtractionCache:
+    def __init__(self, cache_path: str = CACHE_PATH, max_bytes: int = MAX_CACHE_BYTES) -> None:
+        """Local content-addressed cache of pdffigures2 output and split results, with LRU eviction once the
+        cache is bigger than $max_bytes. Recency is the mtime of each pdf entry's folder, which is touched on
+        every hit, so it survives restarts and is shared between processes using the same folder.
+
+        :param cache_path: folder to store the cache in, defaults to CACHE_PATH
+        :type cache_path: str, optional
+        :param max_bytes: max size of the cache on disk, defaults to MAX_CACHE_BYTES (10GB)
+        :type max_bytes: int, optional
+        """
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.lock = RLock()
+        makedirs(cache_path, exist_ok=True)
+
+        self.sizes: dict[str, int] = {}
+        for pdf_key in listdir(cache_path):
+            meta_path = f"{cache_path}{pdf_key}/meta.json"
+            if exists(meta_path):
+                self.sizes[pdf_key] = get_dir_size(f"{cache_path}{pdf_key}")
+            else:  # interrupted write
+                rmtree(f"{cache_path}{pdf_key}", ignore_errors=True)
+
+        self.hits = 0  # split results reused, nothing run
+        self.extraction_hits = 0  # pdffigures2 output reused, splitting re-run
+        self.misses = 0
+        self.evictions = 0
+
+    # ============ KEYS ============
+    def pdf_key(self, pdf_path: str, DPI: int = 200) -> str:
+        return hash_params({"DPI": DPI, "pdffigures2": get_pdff2_version()}, hash_file(pdf_path))
+
+    def split_key(self, pdf_key: str, save_original_figures: bool = True) -> str:
+        return hash_params(get_split_params(save_original_figures), pdf_key)
+
+    # ============ LOOKUP ============
+    def _touch(self, pdf_key: str) -> None:
+        now = time()
+        utime(f"{self.cache_path}{pdf_key}", (now, now))
+
+    def get_split(
+        self, pdf_key: str, split_key: str, out_data_path: str, out_processed_path: str, filename: str
+    ) -> Tuple[List[str], List[str]] | None:
+        """On a hit restore <filename>.json to $out_data_path and the (sub)figures to $out_processed_path and
+        return (captions, img_paths) as `extract.single_pdf_extract_process` would, else None."""
+        with self.lock:
+            split_path = f"{self.cache_path}{pdf_key}/{split_key}/"
+            if not exists(f"{split_path}meta.json"):
+                return None
+            with open(f"{split_path}meta.json") as f:
+                meta = json.load(f)
+            copyfile(f"{self.cache_path}{pdf_key}/data.json", f"{out_data_path}{filename}.json")
+            for name in meta["saved_names"]:
+                copyfile(f"{split_path}{name}", f"{out_processed_path}{filename}{name}")
+            self._touch(pdf_key)
+            self.hits += 1
+            img_paths = [f"{out_processed_path}{filename}{name}" for name in meta["img_names"]]
+            return meta["captions"], img_paths
+
+    def get_extraction(
+        self, pdf_key: str, out_img_path: str, out_data_path: str, filename: str
+    ) -> bool:
+        """On a hit restore the pdffigures2 figures to $out_img_path and <filename>.json to $out_data_path."""
+        with self.lock:
+            entry_path = f"{self.cache_path}{pdf_key}/"
+            if not exists(f"{entry_path}meta.json"):
+                self.misses += 1
+                return False
+            copyfile(f"{entry_path}data.json", f"{out_data_path}{filename}.json")
+            for name in listdir(f"{entry_path}figures"):
+                copyfile(f"{entry_path}figures/{name}", f"{out_img_path}{filename}{name}")
+            self._touch(pdf_key)
+            self.extraction_hits += 1
+            return True
+
+    # ============ STORE ============
+    def put_extraction(
+        self, pdf_key: str, fig_paths: List[str], data_path: str, filename: str
+    ) -> None:
+        """Store the pdffigures2 output (figure images + caption .json) of the pdf with $filename."""
+        with self.lock:
+            entry_path = f"{self.cache_path}{pdf_key}/"
+            rmtree(entry_path, ignore_errors=True)
+            makedirs(f"{entry_path}figures")
+            copyfile(data_path, f"{entry_path}data.json")
+            for fig_path in fig_paths:
+                name = strip_prefix(fig_path.split("/")[-1], filename)
+                copyfile(fig_path, f"{entry_path}figures/{name}")
+            with open(f"{entry_path}meta.json", "w") as f:
+                json.dump({"created": time()}, f)
+            self.sizes[pdf_key] = get_dir_size(entry_path)
+            self.evict()
+
+    def put_split(
+        self,
+        pdf_key: str,
+        split_key: str,
+        captions: List[str],
+        img_paths: List[str],
+        out_processed_path: str,
+        filename: str,
+    ) -> None:
+        """Store the split results of a pdf already stored with `put_extraction`: the subfigures in $img_paths
+        and the original figures / lazy subfigure manifests saved alongside them (if any)."""
+        with self.lock:
+            entry_path = f"{self.cache_path}{pdf_key}/"
+            if not exists(f"{entry_path}meta.json"):
+                return
+            split_path = f"{entry_path}{split_key}/"
+            rmtree(split_path, ignore_errors=True)
+            makedirs(split_path)
+            img_names = [strip_prefix(p.split("/")[-1], filename) for p in img_paths]
+            original_names = [
+                f"_fig_{get_figure_number(name)}{ext}"
+                for name in listdir(f"{entry_path}figures")
+                if "Table" not in name
+                for ext in [".jpg", ".png", ".json"]
+            ]
+            # lazy subfigures aren't on disk, they're restored from the figure .png + .json
+            saved_names = [
+                name
+                for name in img_names + sorted(set(original_names))
+                if exists(f"{out_processed_path}{filename}{name}")
+            ]
+            for name in saved_names:
+                copyfile(f"{out_processed_path}{filename}{name}", f"{split_path}{name}")
+            meta = {
+                "captions": captions,
+                "img_names": img_names,
+                "saved_names": saved_names,
+            }
+            with open(f"{split_path}meta.json", "w") as f:
+                json.dump(meta, f)
+            self.sizes[pdf_key] = get_dir_size(entry_path)
+            self.evict()
+
+    # ============ EVICTION + STATS ============
+    def size(self) -> int:
+        return sum(self.sizes.values())
+
+    def evict(self) -> None:
+        """Delete least recently used pdf entries (and their split results) until under $max_bytes."""
+        with self.lock:
+            if self.size() <= self.max_bytes:
+                return
+            by_last_use = sorted(self.sizes, key=lambda key: getmtime(f"{self.cache_path}{key}"))
+            # never evict the most recently used entry, i.e the one just written
+            for pdf_key in by_last_use[:-1]:
+                if self.size() <= self.max_bytes:
+                    break
+                rmtree(f"{self.cache_path}{pdf_key}", ignore_errors=True)
+                self.sizes.pop(pdf_key)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        n_lookups = self.hits + self.extraction_hits + self.misses
+        return {
+            "hits": self.hits,
+            "extraction_hits": self.extraction_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.extraction_hits) / max(n_lookups, 1),
+            "evictions": self.evictions,
+            "n_entries": len(self.sizes),
+            "size_mb": self.size() / 1024**2,
+        }
+
+    def report(self) -> str:
+        stats = self.stats()
+        return (
+            f"extraction cache: {stats['hits']} hits, {stats['extraction_hits']} pdffigures2-only hits, "
+            f"{stats['misses']} misses ({100 * stats['hit_rate']:.1f}% hit rate), {stats['evictions']} evictions, "
+            f"{stats['n_entries']} entries / {stats['size_mb']:.1f}MB"
+        )
@@ -12,6 +12,8 @@ from typing import Literal, Tuple, List
 
 import re
 
+from extract import list_imgs, load_subfigure, arr_to_img
+
 # problem - if it's not split model says not micrograph - need to relabel?
 
 FONT = ("", 14)
@@ -364,7 +366,7 @@ class App(ttk.Frame):
         self.abstract_text_var.set(self.metadata["abstract"])
 
         self.captions, self.figure_nums = self.load_captions(captions_path)
-        self.img_paths = get_only_figures(listdir(imgs_path), self.label_subfigs)
+        self.img_paths = get_only_figures(list_imgs(imgs_path), self.label_subfigs)
         if self.label_subfigs:
             # remap captions and figures to extend to number of subfigures
             self.remap_captions_fig_nums(
@@ -398,7 +400,7 @@ class App(ttk.Frame):
         return f"{self.dir}/{path}/imgs/{self.img_paths[n]}"
 
     def load_img(self, img_path: str) -> None:
-        img = Image.open(img_path)
+        img = arr_to_img(load_subfigure(img_path))  # cropped on demand if the paper was extracted lazily
         h, w = img.height, img.width
         m_d = max(h, w)
         sf = MAX_IMG_D / m_d
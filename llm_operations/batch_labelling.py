@@ -0,0 +1,292 @@
+import json
+import os
+from itertools import groupby
+from time import sleep
+from typing import Dict, Iterator, List, Set, Tuple
+
+import openai
+
+from scrapers.catalog import PaperCatalog, load_paper_data
+from .gpt_utils import extract_json_from_response
+from .run_llm_with_abstract import get_client, make_messages, MODEL, MAX_TOKENS, LABELS_FNAME
+
+# ==================================== BATCH API LABELLING ====================================
+
+# Bulk labelling has no latency requirement, so instead of one synchronous completion per caption the prompts of
+# every unlabelled paper are compiled into JSONL files for OpenAI's Batch API (https://platform.openai.com/docs/
+# guides/batch), which runs them within COMPLETION_WINDOW at a discount and outside the synchronous rate limits:
+#   1. compile_batches: one request per figure of each paper without a labels file, custom_id
+#      "<folder>/<index>/<figure>" (the index as figure names can repeat, and the API rejects repeated ids)
+#   2. submit_batch + wait_for_batch: upload a file, start the batch and poll until it's done
+#   3. ingest_results: write each paper's labels_gpt4_with_abstract.json (same format as `process_folder`) once
+#      every one of its figures has a valid reply. Papers with failed requests stay pending for the next batch.
+# `run_batch_labelling` does all three, recording submitted batches in $batch_dir so a restarted run resumes
+# polling instead of paying for the same requests twice. Papers pending but not in a submitted batch (new, or
+# with failed requests) are compiled into new batches, for up to MAX_ROUNDS rounds per run.
+BATCH_DIR: str = "llm_batches/"
+MAX_BATCH_REQUESTS: int = 50_000  # API limits per batch file
+MAX_BATCH_BYTES: int = 200 * 1024**2
+COMPLETION_WINDOW: str = "24h"
+ENDPOINT: str = "/v1/chat/completions"
+POLL_S: float = 60
+DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+SUBMITTED_FNAME: str = "submitted.json"  # {batch file name: batch id}
+MAX_ROUNDS: int = 2  # compile/submit/ingest rounds per run, i.e one retry of the papers with failed requests
+
+
+def make_custom_id(folder: str, index: int, figure: str) -> str:
+    return f"{folder}/{index}/{figure}"
+
+
+def split_custom_id(custom_id: str) -> Tuple[str, int, str]:
+    """(folder, index of the figure among the paper's figures, figure name) of a custom_id."""
+    folder, index, figure = custom_id.split("/", 2)  # folder names have no "/", figure names might
+    return folder, int(index), figure
+
+
+def paper_figures(folder_path: str) -> List[Dict]:
+    """Figures (not tables) of the captions.json in $folder_path, in order."""
+    with open(os.path.join(folder_path, "captions.json"), "r") as file:
+        return [item for item in json.load(file) if item["figType"] == "Figure"]
+
+
+def pending_folders(base_path: str) -> List[str]:
+    """Paper folders in $base_path with a captions.json but no labels file yet."""
+    folders = []
+    for folder in sorted(os.listdir(base_path)):
+        folder_path = os.path.join(base_path, folder)
+        has_captions = os.path.isfile(os.path.join(folder_path, "captions.json"))
+        if has_captions and not os.path.exists(os.path.join(folder_path, LABELS_FNAME)):
+            folders.append(folder)
+    return folders
+
+
+def batch_folders(path: str) -> Set[str]:
+    """Paper folders with requests in the batch file at $path."""
+    with open(path, "r") as file:
+        return {split_custom_id(json.loads(line)["custom_id"])[0] for line in file if line.strip() != ""}
+
+
+def pending_requests(
+    base_path: str,
+    catalog: PaperCatalog | None = None,
+    model: str = MODEL,
+    max_tokens: int = MAX_TOKENS,
+    exclude: Set[str] | None = None,
+) -> Iterator[Dict]:
+    """Batch API request lines for every figure of the papers in $base_path that aren't labelled yet (and
+    aren't in $exclude, i.e already in a submitted batch)."""
+    for folder in pending_folders(base_path):
+        if exclude is not None and folder in exclude:
+            continue
+        paper_data = load_paper_data(folder, os.path.join(base_path, ""), catalog)
+        abstract = paper_data.get("abstract", "")
+        for index, item in enumerate(paper_figures(os.path.join(base_path, folder))):
+            body = {
+                "model": model,
+                "messages": make_messages(abstract, item["caption"]),
+                "temperature": 0,
+                "max_tokens": max_tokens,
+            }
+            custom_id = make_custom_id(folder, index, item["name"])
+            yield {"custom_id": custom_id, "method": "POST", "url": ENDPOINT, "body": body}
+
+
+def compile_batches(
+    base_path: str,
+    batch_dir: str = BATCH_DIR,
+    catalog: PaperCatalog | None = None,
+    max_requests: int = MAX_BATCH_REQUESTS,
+    max_bytes: int = MAX_BATCH_BYTES,
+    exclude: Set[str] | None = None,
+) -> List[str]:
+    """Write the pending requests of $base_path to batch_<n>.jsonl files in $batch_dir, starting a new file before
+    one would pass $max_requests lines or $max_bytes. A paper's requests are never split across files.
+
+    :param base_path: folder of paper folders, i.e "micrograph_dataset_new/train"
+    :type base_path: str
+    :param batch_dir: folder to write the batch files to, defaults to BATCH_DIR
+    :type batch_dir: str, optional
+    :param catalog: catalog to look abstracts up in, defaults to None
+    :type catalog: PaperCatalog | None, optional
+    :param max_requests: max requests per file, defaults to MAX_BATCH_REQUESTS
+    :type max_requests: int, optional
+    :param max_bytes: max size of a file, defaults to MAX_BATCH_BYTES
+    :type max_bytes: int, optional
+    :param exclude: folders not to compile, i.e those in batches still running, defaults to None
+    :type exclude: Set[str] | None, optional
+    :return: paths of the batch files written
+    :rtype: List[str]
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    n_existing = len([f for f in os.listdir(batch_dir) if f.startswith("batch_") and f.endswith(".jsonl")])
+    paths: List[str] = []
+    lines: List[str] = []
+    n_bytes = 0
+
+    def flush() -> None:
+        nonlocal lines, n_bytes
+        if len(lines) == 0:
+            return
+        path = os.path.join(batch_dir, f"batch_{n_existing + len(paths):04d}.jsonl")
+        with open(path, "w") as file:
+            file.writelines(lines)
+        paths.append(path)
+        lines, n_bytes = [], 0
+
+    requests = pending_requests(base_path, catalog, exclude=exclude)
+    by_paper = groupby(requests, key=lambda r: split_custom_id(r["custom_id"])[0])
+    for _, paper_requests in by_paper:
+        paper_lines = [json.dumps(request) + "\n" for request in paper_requests]
+        paper_bytes = sum(len(line.encode()) for line in paper_lines)
+        if len(lines) + len(paper_lines) > max_requests or n_bytes + paper_bytes > max_bytes:
+            flush()
+        lines += paper_lines
+        n_bytes += paper_bytes
+    flush()
+    return paths
+
+
+# ============ SUBMIT + POLL ============
+def submit_batch(client: openai.OpenAI, path: str) -> str:
+    """Upload the batch file at $path and start a batch on it.
+
+    :return: the batch's id
+    :rtype: str
+    """
+    with open(path, "rb") as file:
+        input_file = client.files.create(file=file, purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=ENDPOINT, completion_window=COMPLETION_WINDOW)
+    return batch.id
+
+
+def wait_for_batch(client: openai.OpenAI, batch_id: str, poll_s: float = POLL_S):
+    """Poll the batch every $poll_s seconds until it's completed/failed/expired/cancelled.
+
+    :return: the finished batch
+    :rtype: openai.types.Batch
+    """
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in DONE_STATUSES:
+            return batch
+        counts = batch.request_counts
+        progress = f", {counts.completed + counts.failed}/{counts.total} done" if counts is not None else ""
+        print(f"Batch {batch_id}: {batch.status}{progress}")
+        sleep(poll_s)
+
+
+def download_results(client: openai.OpenAI, batch) -> List[Dict]:
+    """Result lines of a finished batch: its output file and, for requests that failed, its error file."""
+    results = []
+    for file_id in [batch.output_file_id, batch.error_file_id]:
+        if file_id is not None:
+            text = client.files.content(file_id).text
+            results += [json.loads(line) for line in text.splitlines() if line.strip() != ""]
+    return results
+
+
+# ============ INGEST ============
+def result_content(result: Dict) -> str | None:
+    """Reply content of a result line, None for a failed request."""
+    response = result.get("response")
+    if result.get("error") is not None or response is None or response.get("status_code") != 200:
+        return None
+    return response["body"]["choices"][0]["message"]["content"]
+
+
+def ingest_results(base_path: str, results: List[Dict]) -> Tuple[List[str], List[str]]:
+    """Write the labels of each paper in $results whose figures all have a reply that parses as JSON, in figure
+    order, to its labels_gpt4_with_abstract.json. Papers already labelled are left as they are.
+
+    :param base_path: folder of paper folders the batch was compiled from
+    :type base_path: str
+    :param results: Batch API result lines, i.e from `download_results` or read from a downloaded output file
+    :type results: List[Dict]
+    :return: folders labelled, and custom_ids of the figures that failed or didn't parse (their papers stay
+        pending)
+    :rtype: Tuple[List[str], List[str]]
+    """
+    replies: Dict[str, Dict[int, str | None]] = {}
+    for result in results:
+        folder, index, _ = split_custom_id(result["custom_id"])
+        replies.setdefault(folder, {})[index] = result_content(result)
+
+    labelled, failed = [], []
+    for folder, figure_replies in sorted(replies.items()):
+        folder_path = os.path.join(base_path, folder)
+        if os.path.exists(os.path.join(folder_path, LABELS_FNAME)):
+            continue
+        labels, paper_failed = [], []
+        for index, item in enumerate(paper_figures(folder_path)):
+            content = figure_replies.get(index)
+            response_data = extract_json_from_response(content) if content is not None else None
+            if not isinstance(response_data, dict):
+                paper_failed.append(make_custom_id(folder, index, item["name"]))
+                continue
+            response_data["figure"] = item["name"]
+            labels.append(response_data)
+        if len(paper_failed) > 0:
+            failed += paper_failed
+            continue
+        with open(os.path.join(folder_path, LABELS_FNAME), "w") as file:
+            json.dump(labels, file, indent=4)
+        labelled.append(folder)
+    return labelled, failed
+
+
+def run_batch_labelling(
+    base_path: str,
+    client: openai.OpenAI | None = None,
+    catalog: PaperCatalog | None = None,
+    batch_dir: str = BATCH_DIR,
+    poll_s: float = POLL_S,
+    max_rounds: int = MAX_ROUNDS,
+) -> Tuple[List[str], List[str]]:
+    """Label the pending papers of $base_path with the Batch API. Each round compiles and submits batches for
+    the pending papers not in a batch already submitted (recorded in $batch_dir, i.e by an interrupted run),
+    then waits for every submitted batch and ingests its results. Rounds stop once nothing is left to submit.
+
+    :param max_rounds: max rounds, later ones retrying the papers with failed requests, defaults to MAX_ROUNDS
+    :type max_rounds: int, optional
+    :return: folders labelled and custom_ids of the figures that failed in the last round (see
+        `ingest_results`)
+    :rtype: Tuple[List[str], List[str]]
+    """
+    client = client if client is not None else get_client()
+    os.makedirs(batch_dir, exist_ok=True)
+    submitted_path = os.path.join(batch_dir, SUBMITTED_FNAME)
+    submitted: Dict[str, str] = {}
+    if os.path.exists(submitted_path):
+        with open(submitted_path, "r") as file:
+            submitted = json.load(file)
+
+    labelled, failed = [], []
+    for _ in range(max_rounds):
+        in_flight: Set[str] = set()
+        for fname in submitted:
+            in_flight |= batch_folders(os.path.join(batch_dir, fname))
+        for path in compile_batches(base_path, batch_dir, catalog, exclude=in_flight):
+            submitted[os.path.basename(path)] = submit_batch(client, path)
+            with open(submitted_path, "w") as file:  # saved after each submit, so a crash doesn't resubmit
+                json.dump(submitted, file, indent=4)
+        if len(submitted) == 0:
+            break
+
+        failed = []
+        for fname, batch_id in list(submitted.items()):
+            batch = wait_for_batch(client, batch_id, poll_s)
+            if batch.status != "completed":
+                print(f"Batch {batch_id} ({fname}) {batch.status}, its papers stay pending")
+            batch_labelled, batch_failed = ingest_results(base_path, download_results(client, batch))
+            labelled += batch_labelled
+            failed += batch_failed
+            submitted.pop(fname)
+            with open(submitted_path, "w") as file:
+                json.dump(submitted, file, indent=4)
+    return labelled, failed
+
+
+if __name__ == "__main__":
+    labelled, failed = run_batch_labelling("./micrograph_dataset_new/train", catalog=PaperCatalog())
+    print(f"Labelled {len(labelled)} papers, {len(failed)} figures failed (their papers will be in the next run)")
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+from typing import Dict, List
+
+import openai
+
+from scrapers.rate_limit import TokenBucket, parse_retry_after
+from scrapers.catalog import PaperCatalog, load_paper_data
+from .gpt_utils import extract_json_from_response
+from .llm_cache import LLMCache, CacheMiss, get_cache, make_key
+from .run_llm_with_abstract import get_client, make_messages, MODEL, MAX_TOKENS, LABELS_FNAME
+
+# ==================================== CONCURRENT LABELLING ====================================
+
+# `run_llm_with_abstract.process_folder` waits on one completion at a time, so a run is bound by round-trip
+# latency. Here every caption of every paper is a coroutine: the blocking client call runs in a thread while
+# a semaphore caps the requests in flight, and two token buckets keep to the account's requests-per-minute and
+# tokens-per-minute limits. Retryable errors (429, 5xx, connection) back off exponentially with full jitter.
+MAX_CONCURRENCY: int = 8
+REQUESTS_PER_MIN: float = 500
+TOKENS_PER_MIN: float = 30_000
+BURST_S: float = 5  # seconds of budget that can be spent back to back
+N_RETRIES: int = 5
+BACKOFF_S: float = 1  # retries wait up to 1s, 2s, 4s... (uniformly random)
+MAX_BACKOFF_S: float = 60
+CHARS_PER_TOKEN: int = 4  # rough token count of English text, the API counts tokens before running the model
+RETRY_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+def estimate_tokens(messages: List[Dict], max_tokens: int = MAX_TOKENS) -> int:
+    """Tokens a request counts against the tokens-per-minute limit: its prompt plus $max_tokens."""
+    return sum(len(str(m["content"])) for m in messages) // CHARS_PER_TOKEN + max_tokens
+
+
+class LabellingEngine:
+    def __init__(
+        self,
+        client: openai.OpenAI | None = None,
+        max_concurrency: int = MAX_CONCURRENCY,
+        requests_per_min: float = REQUESTS_PER_MIN,
+        tokens_per_min: float = TOKENS_PER_MIN,
+        n_retries: int = N_RETRIES,
+        backoff_s: float = BACKOFF_S,
+        model: str = MODEL,
+        max_tokens: int = MAX_TOKENS,
+        cache: LLMCache | None = None,
+    ) -> None:
+        """Label figure captions with concurrent chat completions, within request and token budgets.
+
+        :param client: OpenAI client, defaults to None (`run_llm_with_abstract.get_client()`)
+        :type client: openai.OpenAI | None, optional
+        :param max_concurrency: max requests in flight, defaults to MAX_CONCURRENCY
+        :type max_concurrency: int, optional
+        :param requests_per_min: request budget, defaults to REQUESTS_PER_MIN
+        :type requests_per_min: float, optional
+        :param tokens_per_min: token (prompt + max_tokens) budget, defaults to TOKENS_PER_MIN
+        :type tokens_per_min: float, optional
+        :param n_retries: max retries of a request, defaults to N_RETRIES
+        :type n_retries: int, optional
+        :param backoff_s: base of the exponential backoff between retries, defaults to BACKOFF_S
+        :type backoff_s: float, optional
+        :param model: model to label with, defaults to MODEL
+        :type model: str, optional
+        :param max_tokens: max completion tokens, defaults to MAX_TOKENS
+        :type max_tokens: int, optional
+        :param cache: cache of completions, hits skip the request and the budgets, defaults to None
+            (`llm_cache.get_cache()`)
+        :type cache: LLMCache | None, optional
+        """
+        client = client if client is not None else get_client()
+        self.client = client.with_options(max_retries=0)  # retried here, with jitter and within the budgets
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(requests_per_min / 60, max(1, int(requests_per_min / 60 * BURST_S)))
+        self.tokens = TokenBucket(tokens_per_min / 60, max(1, int(tokens_per_min / 60 * BURST_S)))
+        self.n_retries = n_retries
+        self.backoff_s = backoff_s
+        self.model = model
+        self.max_tokens = max_tokens
+        self.cache = cache if cache is not None else get_cache()
+        self.stats: Dict[str, int] = {"n_requests": 0, "n_retries": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.semaphore: asyncio.Semaphore | None = None  # created on first use so it belongs to the running loop
+
+    def _create(self, messages: List[Dict]):
+        return self.client.chat.completions.create(
+            model=self.model, messages=messages, temperature=0, max_tokens=self.max_tokens
+        )
+
+    async def complete(self, messages: List[Dict]) -> str:
+        """Reply to $messages, waiting for a free slot and the budgets and retrying retryable errors.
+
+        :raises openai.OpenAIError: a non-retryable error, or a retryable one after $n_retries retries
+        :raises CacheMiss: the request isn't cached and the cache is in replay mode
+        :return: the completion's content
+        :rtype: str
+        """
+        key = make_key(self.model, messages, 0, self.max_tokens)
+        content = self.cache.get(key)
+        if content is not None:
+            return content
+        if self.cache.replay:
+            raise CacheMiss(f"no cached response for this {self.model} request in {self.cache.db_path} (replay mode)")
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                await self.requests.acquire_async()
+                await self.tokens.acquire_async(estimate_tokens(messages, self.max_tokens))
+                self.stats["n_requests"] += 1
+                try:
+                    completion = await asyncio.to_thread(self._create, messages)
+                    if completion.usage is not None:
+                        self.stats["prompt_tokens"] += completion.usage.prompt_tokens
+                        self.stats["completion_tokens"] += completion.usage.completion_tokens
+                    content = completion.choices[0].message.content
+                    self.cache.put(key, self.model, content)
+                    return content
+                except RETRY_ERRORS as err:
+                    if attempt == self.n_retries:
+                        raise
+                    response = getattr(err, "response", None)  # connection errors have none
+                    headers = response.headers if response is not None else {}
+                    retry_after_s = parse_retry_after(headers.get("retry-after"))
+            # back off outside the semaphore so other requests can use the slot
+            self.stats["n_retries"] += 1
+            wait_s = uniform(0, min(MAX_BACKOFF_S, self.backoff_s * 2**attempt))
+            if retry_after_s is not None:
+                self.requests.pause(retry_after_s)
+                wait_s = max(wait_s, retry_after_s)
+            await asyncio.sleep(wait_s)
+            attempt += 1
+
+    async def label_captions(self, abstract: str, captions_data: List[Dict]) -> List[Dict]:
+        """Labels of the figures (not tables) in $captions_data, in figure order."""
+        figures = [item for item in captions_data if item["figType"] == "Figure"]
+        responses = await asyncio.gather(*[self.complete(make_messages(abstract, f["caption"])) for f in figures])
+        labels = []
+        for item, response in zip(figures, responses):
+            response_data = extract_json_from_response(response)
+            response_data["figure"] = item["name"]
+            labels.append(response_data)
+        return labels
+
+    async def label_paper(self, folder_path: str, abstract: str) -> None:
+        """Label the captions.json of $folder_path and write its labels_gpt4_with_abstract.json."""
+        with open(os.path.join(folder_path, "captions.json"), "r") as file:
+            captions_data = json.load(file)
+        labels = await self.label_captions(abstract, captions_data)
+        with open(os.path.join(folder_path, LABELS_FNAME), "w") as file:
+            json.dump(labels, file, indent=4)
+
+    async def label_folder(self, base_path: str, catalog: PaperCatalog | None = None) -> int:
+        """Label every paper folder in $base_path concurrently, logging failed papers to its error_log.txt like
+        `run_llm_with_abstract.process_folder`.
+
+        :param base_path: folder of paper folders, i.e "micrograph_dataset_new/train"
+        :type base_path: str
+        :param catalog: catalog to look abstracts up in, defaults to None
+        :type catalog: PaperCatalog | None, optional
+        :return: number of papers labelled
+        :rtype: int
+        """
+        error_log_path = os.path.join(base_path, "error_log.txt")
+        folders = sorted(f for f in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, f)))
+        n_done = 0
+
+        async def label(folder: str) -> bool:
+            nonlocal n_done
+            try:
+                paper_data = load_paper_data(folder, os.path.join(base_path, ""), catalog)
+                await self.label_paper(os.path.join(base_path, folder), paper_data.get("abstract", ""))
+                ok = True
+            except Exception as e:
+                with open(error_log_path, "a") as error_file:
+                    error_file.write(f"Error processing folder {folder}: {e}\n")
+                print(f"An error occurred while processing the folder {folder}. Please check the error log.")
+                ok = False
+            n_done += 1
+            print(f"Processing... {n_done / len(folders) * 100:.2f}% complete")
+            return ok
+
+        return sum(await asyncio.gather(*[label(folder) for folder in folders]))
+
+
+def process_folder_concurrent(
+    base_path: str, catalog: PaperCatalog | None = None, engine: LabellingEngine | None = None
+) -> int:
+    """Blocking wrapper of `LabellingEngine.label_folder`, a concurrent `run_llm_with_abstract.process_folder`."""
+    engine = engine if engine is not None else LabellingEngine()
+
+    async def run() -> int:
+        # enough threads for every request in flight, the default executor can be smaller
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(engine.max_concurrency))
+        return await engine.label_folder(base_path, catalog)
+
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    catalog = PaperCatalog()
+    n_papers = process_folder_concurrent("./micrograph_dataset_new/train", catalog)
+    print(f"Labelled {n_papers} papers")
+    print(get_cache().report())
@@ -1,9 +1,10 @@
 import os
 import json
 import shutil
-import glob
 import re
 
+from extract import list_imgs, load_subfigure_bytes
+
 import os
 import shutil
 
@@ -74,12 +75,14 @@ def process_micrograph_images(llm_tpye,target_folder_base, train_folder, is_micr
                         figure_number = item.get("figure")
                         if figure_number:
                             pattern = os.path.join(imgs_folder, f"captions_fig_{figure_number}(_\\d+)?\\.jpg")
-                            figure_img_paths = [path for path in glob.glob(os.path.join(imgs_folder, "captions_fig_*.jpg")) if re.match(pattern, path)]
+                            figure_img_paths = [path for path in (os.path.join(imgs_folder, name) for name in list_imgs(imgs_folder)) if re.match(pattern, path)]
 
                             target_imgs_folder = os.path.join(target_folder_base, doi, "imgs")
                             os.makedirs(target_imgs_folder, exist_ok=True)
                             for img_path in figure_img_paths:
-                                shutil.copy(img_path, target_imgs_folder)
+                                # written as .jpg, so lazily extracted (sub)figures are cropped here
+                                with open(os.path.join(target_imgs_folder, os.path.basename(img_path)), "wb") as f:
+                                    f.write(load_subfigure_bytes(img_path))
                 
                 # only save json file if there is at least one item
                 if extracted_data:
@@ -1,8 +1,9 @@
 import os
 import json
-import glob
 import re
 
+from extract import list_imgs
+
 def process_folder(doi_folder):
     # Paths to the required files
     extraction_file = os.path.join(doi_folder, "gpt4_with_abstract_extract.json")
@@ -32,9 +33,9 @@ def process_folder(doi_folder):
         # Correctly formulating the regex pattern
         pattern = re.compile(f"captions_fig_{figure_number}(_\\d+)?\\.jpg")
 
-        # Gathering and sorting image paths
+        # Gathering and sorting image paths (list_imgs also lists the subfigures of lazily extracted figures)
         figure_img_paths = sorted(
-            [path for path in glob.glob(os.path.join(imgs_folder, f"captions_fig_{figure_number}*.jpg")) if pattern.match(os.path.basename(path))],
+            [os.path.join(imgs_folder, name) for name in list_imgs(imgs_folder) if pattern.match(name)],
             key=lambda x: (len(x), x)
         )
 
@@ -38,4 +38,21 @@ def extract_json_from_response(response):
         except json.JSONDecodeError as e:
             print(f"Error parsing JSON-like structure: {e}")
 
-    return None  # If no JSON data is found, return None
\ No newline at end of file
+    return None  # If no JSON data is found, return None
+
+
+def extract_json_array_from_response(response):
+    # Same as extract_json_from_response, for a reply that should be a JSON array
+    candidates = [response]
+    candidates += [match.strip() for match in re.findall(r'```json(.*?)```', response, re.DOTALL)]
+    candidates += [match.strip() for match in re.findall(r'\[.*\]', response, re.DOTALL)]
+
+    for candidate in candidates:
+        try:
+            json_data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(json_data, list):
+            return json_data
+
+    return None  # If no JSON array is found, return None
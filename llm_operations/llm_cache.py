@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Callable, Dict, List
+
+# ==================================== LLM RESPONSE CACHE ====================================
+
+# Completions are stored in SQLite keyed by a hash of everything that determines them: model, messages,
+# temperature and max_tokens. Images sent as base64 data urls are keyed by their digest, so the key doesn't depend
+# on how they were encoded into the request. Re-running a labelling script on unchanged inputs (or a new version
+# of a preprint with the same captions) then makes no API calls. Least recently used entries are evicted once the
+# stored responses are bigger than $max_bytes. In replay mode the cache is read-only and a miss raises instead of
+# calling the API, i.e to reproduce a run offline. Importable both as `llm_operations.llm_cache` and, for the
+# scripts run from this folder, as `llm_cache`, so it only depends on the standard library.
+CACHE_PATH: str = "llm_cache.db"
+MAX_CACHE_BYTES: int = 1024**3
+EVICT_BATCH: int = 64  # least recently used rows read per eviction query
+REPLAY: bool = os.getenv("LLM_CACHE_REPLAY", "0") == "1"
+DATA_URL_PATTERN = re.compile(r"^data:([\w/+.-]+);base64,(.*)$", re.DOTALL)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    n_hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+class CacheMiss(KeyError):
+    """A request that isn't cached, in replay mode."""
+
+
+def _digest_images(value):
+    # replace base64 data urls anywhere in the messages by the digest of their data
+    if isinstance(value, dict):
+        return {k: _digest_images(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_digest_images(v) for v in value]
+    if isinstance(value, str):
+        match = DATA_URL_PATTERN.match(value)
+        if match is not None:
+            return f"{match.group(1)};sha256,{hashlib.sha256(match.group(2).encode()).hexdigest()}"
+    return value
+
+
+def make_key(
+    model: str, messages: List[Dict], temperature: float | None = None, max_tokens: int | None = None
+) -> str:
+    """Hash of a chat completion request, with images (data urls) replaced by their digest."""
+    messages = _digest_images(messages)
+    request = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, db_path: str = CACHE_PATH, max_bytes: int = MAX_CACHE_BYTES, replay: bool = REPLAY) -> None:
+        """On-disk cache of LLM completions with LRU eviction. Safe to share between threads.
+
+        :param db_path: path of the database file, defaults to CACHE_PATH
+        :type db_path: str, optional
+        :param max_bytes: max total size of the stored responses, defaults to MAX_CACHE_BYTES (1GB)
+        :type max_bytes: int, optional
+        :param replay: read-only: never store, and raise `CacheMiss` on a miss instead of calling the API, defaults
+            to REPLAY (set with the LLM_CACHE_REPLAY=1 environment variable)
+        :type replay: bool, optional
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = Lock()
+        # kept up to date on every write, so checking the size limit doesn't scan the table
+        self.total_bytes: int = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def close(self) -> None:
+        self.conn.close()
+
+    # ============ LOOKUP + STORE ============
+    def get(self, key: str) -> str | None:
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.replay:
+                self.conn.execute(
+                    "UPDATE responses SET last_used = ?, n_hits = n_hits + 1 WHERE key = ?", (time(), key)
+                )
+            return row[0]
+
+    def put(self, key: str, model: str, response: str) -> None:
+        if self.replay or response == "":  # an empty reply is a failed request, not worth keeping
+            return
+        now = time()
+        size = len(response.encode())
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                """INSERT OR REPLACE INTO responses (key, model, response, size, created, last_used)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (key, model, response, size, now, now),
+            )
+            self.total_bytes += size - (row[0] if row is not None else 0)
+        self.evict(keep=key)
+
+    def completion(
+        self,
+        create: Callable[[], str],
+        model: str,
+        messages: List[Dict],
+        temperature: float | None = None,
+        max_tokens: int | None = None,
+    ) -> str:
+        """Cached reply to a chat completion request, else the reply of $create() (which makes the request).
+
+        :param create: makes the request, returning the reply's content
+        :type create: Callable[[], str]
+        :raises CacheMiss: on a miss in replay mode
+        :return: the reply's content
+        :rtype: str
+        """
+        key = make_key(model, messages, temperature, max_tokens)
+        response = self.get(key)
+        if response is not None:
+            return response
+        if self.replay:
+            raise CacheMiss(f"no cached response for this {model} request in {self.db_path} (replay mode)")
+        response = create()
+        self.put(key, model, response)
+        return response
+
+    # ============ EVICTION + STATS ============
+    def size(self) -> int:
+        with self.lock:
+            return self.total_bytes
+
+    def evict(self, keep: str | None = None) -> None:
+        """Delete least recently used responses, except $keep (i.e the one just written), until under $max_bytes.
+        Only the oldest rows are read, EVICT_BATCH at a time through the last_used index."""
+        with self.lock, self.conn:
+            while self.total_bytes > self.max_bytes:
+                rows = self.conn.execute(
+                    "SELECT key, size FROM responses WHERE key != ? ORDER BY last_used LIMIT ?",
+                    (keep if keep is not None else "", EVICT_BATCH),
+                ).fetchall()
+                if len(rows) == 0:
+                    return
+                for key, size in rows:
+                    if self.total_bytes <= self.max_bytes:
+                        return
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.total_bytes -= size
+                    self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            n_entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "evictions": self.evictions,
+            "n_entries": n_entries,
+            "size_mb": self.size() / 1024**2,
+        }
+
+    def report(self) -> str:
+        stats = self.stats()
+        return (
+            f"llm cache: {stats['hits']} hits, {stats['misses']} misses ({100 * stats['hit_rate']:.1f}% hit rate), "
+            f"{stats['evictions']} evictions, {stats['n_entries']} entries / {stats['size_mb']:.1f}MB"
+        )
+
+
+shared_cache: LLMCache | None = None  # opened on first use
+
+
+def get_cache() -> LLMCache:
+    """The cache at CACHE_PATH shared by the labelling scripts."""
+    global shared_cache
+    if shared_cache is None:
+        shared_cache = LLMCache()
+    return shared_cache
@@ -0,0 +1,256 @@
+import json
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from random import Random
+from threading import Thread, Lock
+from time import sleep, time
+from typing import Callable, Dict, List
+
+from scrapers.rate_limit import TokenBucket
+
+# ==================================== MOCK OPENAI SERVER ====================================
+
+# Local stand-in for the OpenAI API, so the labelling code can be tested and benchmarked offline. Point a client at
+# it with `openai.OpenAI(api_key="test", base_url=server.url)`. It serves:
+#   POST /v1/chat/completions               chat completions
+#   POST /v1/files, GET /v1/files/<id>/content  upload (multipart) and download of batch input/output files
+#   POST /v1/batches, GET /v1/batches/<id>  Batch API jobs on /v1/chat/completions, which advance one status
+#                                           (validating -> in_progress -> completed) each time they're retrieved
+# Replies come from $respond (by default a label guessed from keywords in the prompt) and token usage is estimated
+# at CHARS_PER_TOKEN, like `concurrent_labelling.estimate_tokens`.
+CHARS_PER_TOKEN: int = 4
+RETRY_AFTER_S: int = 1  # Retry-After sent with 429s
+BATCH_STATUSES = ["validating", "in_progress", "completed"]
+MICROGRAPH_WORDS = ["micrograph", "sem", "tem", "afm", "microscop"]
+
+
+def keyword_label(messages: List[Dict]) -> str:
+    """isMicrograph label of the last message of $messages, from whether it mentions microscopy."""
+    text = messages[-1]["content"].lower()
+    if any(word in text for word in MICROGRAPH_WORDS):
+        return json.dumps({"isMicrograph": "true", "instrument": "SEM", "material": "sample", "comments": []})
+    return json.dumps({"isMicrograph": "false"})
+
+
+def count_tokens(messages: List[Dict]) -> int:
+    return sum(len(str(m["content"])) for m in messages) // CHARS_PER_TOKEN
+
+
+class MockOpenAIServer:
+    def __init__(
+        self,
+        respond: Callable[[List[Dict]], str] = keyword_label,
+        latency_s: float = 0,
+        error_rate: float = 0,
+        rate_limit_per_s: float | None = None,
+        seed: int = 0,
+    ) -> None:
+        """Local HTTP server emulating OpenAI's chat completions API, with injectable faults.
+
+        :param respond: returns the reply content to a request's messages, defaults to keyword_label
+        :type respond: Callable[[List[Dict]], str], optional
+        :param latency_s: added before every response, defaults to 0
+        :type latency_s: float, optional
+        :param error_rate: fraction of requests answered with a 500, defaults to 0
+        :type error_rate: float, optional
+        :param rate_limit_per_s: requests/s above which requests get a 429 with a Retry-After, defaults to None
+            (no limit)
+        :type rate_limit_per_s: float | None, optional
+        :param seed: seed of the error injection, defaults to 0
+        :type seed: int, optional
+        """
+        self.respond = respond
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.bucket = TokenBucket(rate_limit_per_s, 1) if rate_limit_per_s is not None else None
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.counts: Dict[str, int] = {
+            "n_requests": 0,
+            "n_errors": 0,
+            "n_throttled": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        self.requests: List[Dict] = []  # body of every completed request
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0  # most requests being handled at once
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def reply(self, status: int, headers: Dict, reply: Dict | bytes) -> None:
+                if isinstance(reply, bytes):
+                    headers = {"Content-Type": "application/octet-stream", **headers}
+                else:
+                    reply = json.dumps(reply).encode()
+                    headers = {"Content-Type": "application/json", **headers}
+                self.send_response(status)
+                for key, value in {"Content-Length": str(len(reply)), **headers}.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+                    self.reply(*server.upload(self.headers["Content-Type"], body))
+                else:
+                    self.reply(*server.handle(self.path, json.loads(body) if body else {}))
+
+            def do_GET(self):
+                self.reply(*server.get(self.path))
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def shutdown(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self.lock:
+            self.counts[key] += n
+
+    def handle(self, path: str, body: Dict) -> tuple:
+        """(status, headers, json reply) of a POST of $body to $path."""
+        self._count("n_requests")
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency_s > 0:
+                sleep(self.latency_s)
+            if self.bucket is not None and not self.bucket.try_acquire():
+                self._count("n_throttled")
+                error = {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}
+                return 429, {"Retry-After": str(RETRY_AFTER_S)}, {"error": error}
+            with self.lock:
+                fail = self.random.random() < self.error_rate
+            if fail:
+                self._count("n_errors")
+                return 500, {}, {"error": {"message": "The server had an error", "type": "server_error"}}
+            if path.rstrip("/").endswith("/chat/completions"):
+                return 200, {}, self.chat_completion(body)
+            if path.rstrip("/").endswith("/batches"):
+                return 200, {}, self.create_batch(body)
+            return 404, {}, {"error": {"message": f"Unknown path {path}", "type": "invalid_request_error"}}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def chat_completion(self, body: Dict) -> Dict:
+        content = self.respond(body["messages"])
+        prompt_tokens = count_tokens(body["messages"])
+        completion_tokens = len(content) // CHARS_PER_TOKEN
+        self._count("prompt_tokens", prompt_tokens)
+        self._count("completion_tokens", completion_tokens)
+        with self.lock:
+            self.requests.append(body)
+        return {
+            "id": f"chatcmpl-{len(self.requests)}",
+            "object": "chat.completion",
+            "created": int(time()),
+            "model": body.get("model", ""),
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    # ============ FILES + BATCHES ============
+    def _file_object(self, file_id: str, filename: str) -> Dict:
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(self.files[file_id]),
+            "created_at": int(time()),
+            "filename": filename,
+            "purpose": "batch",
+            "status": "processed",
+        }
+
+    def upload(self, content_type: str, body: bytes) -> tuple:
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        for part in message.get_payload():
+            if part.get_param("name", header="content-disposition") == "file":
+                with self.lock:
+                    file_id = f"file-{len(self.files) + 1}"
+                    self.files[file_id] = part.get_payload(decode=True)
+                return 200, {}, self._file_object(file_id, part.get_filename() or "upload.jsonl")
+        return 400, {}, {"error": {"message": "No file in upload", "type": "invalid_request_error"}}
+
+    def get(self, path: str) -> tuple:
+        parts = path.strip("/").split("/")  # ["v1", "files", <id>, "content"] or ["v1", "batches", <id>]
+        if len(parts) == 4 and parts[1] == "files" and parts[3] == "content" and parts[2] in self.files:
+            return 200, {}, self.files[parts[2]]
+        if len(parts) == 3 and parts[1] == "batches" and parts[2] in self.batches:
+            return 200, {}, self.retrieve_batch(parts[2])
+        return 404, {}, {"error": {"message": f"Unknown path {path}", "type": "invalid_request_error"}}
+
+    def create_batch(self, body: Dict) -> Dict:
+        with self.lock:
+            batch_id = f"batch_{len(self.batches) + 1}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "status": BATCH_STATUSES[0],
+                "created_at": int(time()),
+                "output_file_id": None,
+                "error_file_id": None,
+                "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            }
+            return dict(self.batches[batch_id])
+
+    def retrieve_batch(self, batch_id: str) -> Dict:
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] != BATCH_STATUSES[-1]:
+                batch["status"] = BATCH_STATUSES[BATCH_STATUSES.index(batch["status"]) + 1]
+                run = batch["status"] == "completed"
+            else:
+                run = False
+        if run:
+            self.run_batch(batch)
+        return dict(batch)
+
+    def run_batch(self, batch: Dict) -> None:
+        """Answer every request of $batch's input file, writing its output (and error) file. Requests fail at
+        $error_rate, as a line in the error file."""
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]].decode().splitlines():
+            request = json.loads(line)
+            result = {"id": f"batch_req_{len(outputs) + len(errors)}", "custom_id": request["custom_id"]}
+            with self.lock:
+                fail = self.random.random() < self.error_rate
+            if fail:
+                error = {"code": "server_error", "message": "The server had an error"}
+                errors.append({**result, "response": None, "error": error})
+            else:
+                body = self.chat_completion(request["body"])
+                response = {"status_code": 200, "request_id": f"req_{len(outputs)}", "body": body}
+                outputs.append({**result, "response": response, "error": None})
+        with self.lock:
+            for key, lines in [("output_file_id", outputs), ("error_file_id", errors)]:
+                if len(lines) > 0:
+                    file_id = f"file-{len(self.files) + 1}"
+                    self.files[file_id] = "".join(json.dumps(line) + "\n" for line in lines).encode()
+                    batch[key] = file_id
+            counts = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+            batch["request_counts"] = counts
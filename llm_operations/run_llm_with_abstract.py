@@ -3,25 +3,36 @@ import openai
 import os
 import json
 from .gpt_utils import *
+from .llm_cache import LLMCache, get_cache
+from scrapers.catalog import PaperCatalog, load_paper_data
 
 # TODO: only accept "figType": "Figure", add "llm" field
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
-client = openai.OpenAI(api_key=openai.api_key)
-
-
-def assistant(abstract, captions):
-    """
-    Given an abstract and a caption, generate a JSON output with the following fields:
-    1. IsMicrographPresent: Whether a micrograph is present in the figure.
-    2. MicroscopyTechniqueUsed: The microscopy technique used to produce the micrograph.
-    3. MaterialShown: The material shown in the micrograph."""
-
-    def get_completion(
-        messages, model="gpt-4-0125-preview", temperature=0, max_tokens=500
-    ):
-
-        completion = client.chat.completions.create(
+client: openai.OpenAI | None = None  # made on first use, so importing doesn't need a key
+
+MODEL = "gpt-4-0125-preview"
+MAX_TOKENS = 500
+LABELS_FNAME = "labels_gpt4_with_abstract.json"
+# paper-batched mode: one prompt per paper (abstract sent once) with up to MAX_FIGURES_PER_PROMPT captions
+PAPER_BATCHED = False
+MAX_FIGURES_PER_PROMPT = 8
+MAX_OUTPUT_TOKENS = 4096  # completion limit of the model
+
+
+def get_client() -> openai.OpenAI:
+    global client
+    if client is None:
+        client = openai.OpenAI(api_key=openai.api_key)
+    return client
+
+
+def get_completion(
+    messages, model=MODEL, temperature=0, max_tokens=MAX_TOKENS, cache: LLMCache | None = None
+):
+    # answered from $cache (default the shared `llm_cache`) when the same request was made before
+    def create():
+        completion = get_client().chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
@@ -29,7 +40,11 @@ def assistant(abstract, captions):
         )
         return completion.choices[0].message.content
 
-    system_message = """
+    cache = cache if cache is not None else get_cache()
+    return cache.completion(create, model, messages, temperature, max_tokens)
+
+
+SYSTEM_MESSAGE = """
     You are an expert materials scientist. You study micrographs, which are images taken using a microscope. 
 
     Based on an academic paper's abstract and a specific figure's caption, provide answers in JSON format to the following questions:
@@ -57,20 +72,117 @@ def assistant(abstract, captions):
     IMPORTANT: The answer should only contain pure JSON data matching the fields provided in the examples.   
     """
 
+
+def make_messages(abstract, captions):
     abstract_escaped = repr(abstract)
     captions_escaped = repr(captions)
     user_message = f""" The abstract is: {abstract_escaped}, and the captions are: {captions_escaped}"""
 
-    messages = [
-        {"role": "system", "content": system_message},
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
         {"role": "user", "content": f"{user_message}"},
     ]
 
-    response = get_completion(messages)
-    return response
+
+def assistant(abstract, captions, cache: LLMCache | None = None):
+    """
+    Given an abstract and a caption, generate a JSON output with the following fields:
+    1. IsMicrographPresent: Whether a micrograph is present in the figure.
+    2. MicroscopyTechniqueUsed: The microscopy technique used to produce the micrograph.
+    3. MaterialShown: The material shown in the micrograph."""
+    return get_completion(make_messages(abstract, captions), cache=cache)
+
+
+PAPER_SYSTEM_MESSAGE = """
+    You are an expert materials scientist. You study micrographs, which are images taken using a microscope. 
+
+    Based on an academic paper's abstract and the captions of several of its figures, answer the following questions for each figure separately:
+    
+    1. Is there a micrograph in this specific figure? Answer with 'true' or 'false'.
+    2. If a micrograph is present, list the techniques used in this figure (e.g., SEM, TEM, Optical Microscopy). Note that techniques mentioned in the abstract or other captions might not be used in this figure.
+    3. If a micrograph is present, list the the full name of materials depicted in the micrographs e.g., 'Lithium Nickel-Manganese-Cobalt (NMC) 811 cathode' or 'Insulin aggregates'.
+    4. Are there any noteworthy details about the micrograph, such as unique processing conditions or observed anomalies, in a series of brief phrases (e.g., ['heat-treated', 'cracked', 'sintered'])?
+
+    Answer with a JSON array with one object per figure, in the order given, with the figure's name in "figure". Here's an example for a paper with figures 1 and 2, where only figure 2 has a micrograph:
+
+    [
+        {
+            "figure": "1",
+            "isMicrograph": "false"
+        },
+        {
+            "figure": "2",
+            "isMicrograph": "true",
+            "instrument": "Technique",
+            "material": "Description",
+            "comments": ["comment1", "comment2", "comment3"]
+        }
+    ]
+    
+    IMPORTANT: The answer should only contain a pure JSON array matching the fields provided in the example, with an entry for every figure.   
+    """
+
+
+def make_paper_messages(abstract, figures):
+    abstract_escaped = repr(abstract)
+    captions = "\n".join(f"Figure {item['name']}: {repr(item['caption'])}" for item in figures)
+    user_message = f""" The abstract is: {abstract_escaped}, and the captions are:\n{captions}"""
+
+    return [
+        {"role": "system", "content": PAPER_SYSTEM_MESSAGE},
+        {"role": "user", "content": user_message},
+    ]
+
+
+def parse_paper_response(response, figure_names):
+    """{figure name: label} of the entries of a paper-batched reply that are valid: an object for one of
+    $figure_names (the first one for that figure) with an "isMicrograph" field."""
+    entries = extract_json_array_from_response(response) or []
+    labels = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or "isMicrograph" not in entry:
+            continue
+        name = str(entry.get("figure", ""))
+        if name in figure_names and name not in labels:
+            labels[name] = entry
+    return labels
 
 
-def process_folder(base_path):
+def label_paper(abstract, captions_data, cache: LLMCache | None = None):
+    """
+    Label the figures in $captions_data with one prompt per MAX_FIGURES_PER_PROMPT figures, so the abstract is
+    sent once per paper rather than once per caption. Figures missing or malformed in the reply are labelled
+    with a per-caption `assistant` call instead.
+    Returns the labels (in figure order, as `process_folder` saves them) and the number of fallback calls."""
+    figures = [item for item in captions_data if item["figType"] == "Figure"]
+    labels = {}
+    batched_names = set()
+    for start in range(0, len(figures), MAX_FIGURES_PER_PROMPT):
+        chunk = figures[start : start + MAX_FIGURES_PER_PROMPT]
+        if len(chunk) == 1:  # nothing to share, labelled with a per-caption call below
+            continue
+        names = [item["name"] for item in chunk]
+        max_tokens = min(MAX_TOKENS * len(chunk), MAX_OUTPUT_TOKENS)
+        response = get_completion(make_paper_messages(abstract, chunk), max_tokens=max_tokens, cache=cache)
+        labels.update(parse_paper_response(response, names))
+        batched_names.update(names)
+
+    llm_label_data = []
+    n_fallbacks = 0
+    for item in figures:
+        response_data = labels.get(item["name"])
+        if response_data is None:
+            response_data = extract_json_from_response(assistant(abstract, item["caption"], cache))
+            n_fallbacks += item["name"] in batched_names
+        response_data = {key: value for key, value in response_data.items() if key != "figure"}
+        response_data["figure"] = item["name"]
+        llm_label_data.append(response_data)
+    return llm_label_data, n_fallbacks
+
+
+def process_folder(base_path, catalog: PaperCatalog | None = None, paper_batched=PAPER_BATCHED):
+    # abstracts of catalogued papers are looked up in $catalog instead of parsing each paper_data.json
+    # with $paper_batched each paper's captions are labelled together, see `label_paper`
     error_log_path = os.path.join(base_path, "error_log.txt")
     folders = [
         f for f in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, f))
@@ -86,26 +198,28 @@ def process_folder(base_path):
                 with open(os.path.join(folder_path, "captions.json"), "r") as file:
                     captions_data = json.load(file)
 
-                with open(os.path.join(folder_path, "paper_data.json"), "r") as file:
-                    paper_data = json.load(file)
+                paper_data = load_paper_data(folder, os.path.join(base_path, ""), catalog)
 
                 abstract = paper_data.get("abstract", "")
                 llm_label_data = []
 
-                for item in captions_data:
-                    caption = item["caption"]
-                    name = item["name"]
-                    figure_type = item["figType"]
-
-                    if figure_type == "Figure":
-                        response = assistant(abstract, caption)
-                        response_data = extract_json_from_response(response)
-                        response_data["figure"] = name
-                        llm_label_data.append(response_data)
-
-                with open(
-                    os.path.join(folder_path, "labels_gpt4_with_abstract.json"), "w"
-                ) as file:
+                if paper_batched:
+                    llm_label_data, n_fallbacks = label_paper(abstract, captions_data)
+                    if n_fallbacks > 0:
+                        print(f"{n_fallbacks} figures relabelled one by one")
+                else:
+                    for item in captions_data:
+                        caption = item["caption"]
+                        name = item["name"]
+                        figure_type = item["figType"]
+
+                        if figure_type == "Figure":
+                            response = assistant(abstract, caption)
+                            response_data = extract_json_from_response(response)
+                            response_data["figure"] = name
+                            llm_label_data.append(response_data)
+
+                with open(os.path.join(folder_path, LABELS_FNAME), "w") as file:
                     json.dump(llm_label_data, file, indent=4)
                 print(f"Finished processing the folder: {folder}")
 
@@ -126,4 +240,5 @@ def process_folder(base_path):
 # Process each DOI-named folder in the 'train' directory
 if __name__ == "__main__":
     train_directory_path = "./micrograph_dataset_new/train"
-    process_folder(train_directory_path)
+    process_folder(train_directory_path, PaperCatalog())
+    print(get_cache().report())
@@ -3,6 +3,7 @@ import openai
 import os
 import json
 from gpt_utils import *
+from llm_cache import get_cache
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 client = openai.OpenAI(api_key=openai.api_key)
@@ -17,13 +18,16 @@ def assistant(caption):
     def get_completion(messages, model="gpt-3.5-turbo-1106", 
                         temperature=0, max_tokens=500):
 
-            completion = client.chat.completions.create(
-                model= model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            return completion.choices[0].message.content
+            def create():
+                completion = client.chat.completions.create(
+                    model= model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                return completion.choices[0].message.content
+
+            return get_cache().completion(create, model, messages, temperature, max_tokens)
 
     system_message ="""
     You are an expert on micrographs, images captured using microscopes such as SEM, TEM, or AFM, etc.
@@ -100,6 +104,7 @@ def process_folder(base_path):
 # Process each DOI-named folder in the 'train' directory
 train_directory_path = './micrograph_dataset_new/train'
 process_folder(train_directory_path)
+print(get_cache().report())
                 
 
 
@@ -4,19 +4,21 @@ import base64
 import requests
 import json
 import re
-from gpt_utils import *
+from .gpt_utils import *
+from .llm_cache import get_cache
+from extract import load_subfigure_bytes
 import traceback
 
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
-client = openai.OpenAI(api_key=openai.api_key)
 
 
-def get_completion_single_image(image_path, user_message):
-    def encode_image(image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+def encode_image(image_path):
+    # via extract, so subfigures of lazily extracted papers (not saved as .jpg) are cropped on demand
+    return base64.b64encode(load_subfigure_bytes(image_path)).decode("utf-8")
+
 
+def get_completion_single_image(image_path, user_message):
     # Getting the base64 string
     base64_image = encode_image(image_path)
 
@@ -42,27 +44,24 @@ def get_completion_single_image(image_path, user_message):
         "max_tokens": 300,
     }
 
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+    def create():
+        response = requests.post(
+            "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+        )
+        return response.json()["choices"][0]["message"]["content"]
+
+    # cached by the image's digest, so re-runs on the same subfigures make no requests
+    content = get_cache().completion(
+        create, payload["model"], payload["messages"], max_tokens=payload["max_tokens"]
     )
     print(image_path)
-    print(response.json()["choices"][0]["message"]["content"])
-    return response.json()["choices"][0]["message"]["content"]
+    print(content)
+    return content
 
 
 def get_completion_multiple_images(image_paths, user_message):
-    # Function to encode images
-    def encode_images(image_paths):
-        base64_images = []
-        for path in image_paths:
-            with open(path, "rb") as image_file:
-                base64_images.append(
-                    base64.b64encode(image_file.read()).decode("utf-8")
-                )
-        return base64_images
-
     # Getting the base64 strings for all images
-    base64_images = encode_images(image_paths)
+    base64_images = [encode_image(path) for path in image_paths]
 
     # Preparing the payload with dynamic image content
     messages_content = [{"type": "text", "text": user_message}]
@@ -86,12 +85,18 @@ def get_completion_multiple_images(image_paths, user_message):
         "max_tokens": 1000,
     }
 
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+    def create():
+        response = requests.post(
+            "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+        )
+        return response.json().get("choices", [{}])[0].get("message", {}).get("content", "")
+
+    content = get_cache().completion(
+        create, payload["model"], payload["messages"], max_tokens=payload["max_tokens"]
     )
-    print(response.json().get("choices", [{}])[0].get("message", {}).get("content", ""))
+    print(content)
 
-    return response.json().get("choices", [{}])[0].get("message", {}).get("content", "")
+    return content
 
 
 def get_subfigure(img_path):
@@ -243,5 +248,7 @@ system_message_user2 = """
             IMPORTANT: The answer should only contain pure JSON data matching the fields provided in the examples.
             """
         
-train_folder = "./micrograph_interesting/train"  
-process_all_doi_folders(train_folder, user_message_1, system_message_user2)
+if __name__ == "__main__":
+    train_folder = "./micrograph_interesting/train"
+    process_all_doi_folders(train_folder, user_message_1, system_message_user2)
+    print(get_cache().report())
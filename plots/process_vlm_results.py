@@ -1,12 +1,14 @@
 from os import listdir, getcwd
-from json import load
+from json import load, JSONDecodeError
 import csv
 
+# run from the repo root with `python -m plots.process_vlm_results` so the paper catalog can be imported
+from scrapers.catalog import PaperCatalog, load_paper_data
+
 
 paper_data: list[list[str]] = []
 ds_path: str = "dataset/vlm_results"
 subfig_fname: str = "labels_gpt4_vision_subfigure.json"
-metadata_fname: str = "paper_data.json"
 
 
 def extract_data(path: str) -> dict | None:
@@ -18,6 +20,13 @@ def extract_data(path: str) -> dict | None:
         return None
 
 
+def extract_metadata(folder: str, catalog: PaperCatalog) -> dict | None:
+    try:
+        return load_paper_data(folder, f"{ds_path}/", catalog)
+    except (OSError, KeyError, JSONDecodeError):  # not catalogued and no (valid) paper_data.json
+        return None
+
+
 def get_figure_caption(idx: int, caption_data: dict) -> str:
     for fig in caption_data:
         if fig["name"] == str(idx) and fig["figType"] == "Figure":
@@ -34,11 +43,12 @@ def write_paper_data(paper_data: list[str]) -> None:
 
 # loop through all figures, get data and save to csv. Optionally generate MatSciBERT embeddings
 i = 0
+catalog = PaperCatalog()  # metadata of catalogued papers is looked up rather than parsed from json
 for folder in listdir(ds_path):
     if len(folder.split(".")) > 1:  # index spreadsheet
         continue
     subgfigure_data = extract_data(f"{ds_path}/{folder}/{subfig_fname}")
-    metadata = extract_data(f"{ds_path}/{folder}/{metadata_fname}")
+    metadata = extract_metadata(folder, catalog)
     captions = extract_data(f"{ds_path}/{folder}/captions.json")
     if subgfigure_data == None or metadata == None or captions == None:  # oopsies!
         continue
@@ -1,35 +1,119 @@
-from time import time
+from time import time, perf_counter
+from threading import Thread, Lock
+from queue import Queue
 from typing import Tuple, List
 from shutil import rmtree
-from json import load
 from os import mkdir, listdir
-from os.path import isfile
+from os.path import isfile, isabs, exists, basename, normpath
 import numpy as np
 
-from extract import single_pdf_extract_process, CWD
+from extract import single_pdf_extract_process, batch_pdf_extract_process, reset_folder, shutdown_split_pool, CWD
+from extract_worker import ExtractionWorker
+from extraction_cache import ExtractionCache
 from scrapers.generic import GenericScraper, make_folder
 from scrapers.arxiv import ArxivScraper
 from scrapers.chemrxiv import ChemrxivScraper
+from scrapers.async_crawl import crawl_metadata
+from scrapers.manifest import CrawlManifest
+from scrapers.catalog import PaperCatalog, load_paper_data, SPLITS
 
 np.random.seed(2189)
 
 MAX_RESULTS = 300
-# up to 4 requests per second with 1s sleep
-REQUEST_DELAY_S: float = 3
+# requests to each host are rate limited by the scrapers themselves, see scrapers/rate_limit.py
 N_RETRIES: int = 3
 
 
-def paper_info_loop(scraper: GenericScraper, query: str) -> None:
-    prev_time = time()
+def paper_info_loop(
+    scraper: GenericScraper,
+    query: str,
+    max_in_flight: int = 1,
+    incremental: bool = False,
+    catalog: PaperCatalog | None = None,
+) -> None:
     n_papers = 0
     max_papers = 14000
+    # saved papers are bulk-added to $catalog (if given) as well as written to json, for the later stages
+    scraper_catalog = scraper.catalog
+    if catalog is not None:
+        scraper.catalog = catalog
 
-    while n_papers < max_papers:
-        new_time = time()
-        if (new_time - prev_time) > REQUEST_DELAY_S:
-            new_paper_n = scraper.scrape(query, n_papers, 100)
+    try:
+        if incremental:
+            harvest_since_watermark(scraper, query, max_papers=max_papers)
+            return
+
+        if max_in_flight > 1:
+            # page concurrently, writing paper data as pages arrive, see scrapers/async_crawl.py
+            n_papers = crawl_metadata(scraper, query, max_papers, scraper.PAGE_SIZE, max_in_flight)
+            print(f"saved {n_papers} papers")
+            return
+
+        while n_papers < max_papers:
+            new_paper_n = scraper.scrape(query, n_papers, scraper.PAGE_SIZE)
+            if new_paper_n == 0:
+                break
             n_papers += new_paper_n
-            prev_time = new_time
+    finally:
+        scraper.catalog = scraper_catalog
+
+
+def harvest_since_watermark(
+    scraper: GenericScraper,
+    query: str,
+    dataset_path: str = "dataset/papers/",
+    max_papers: int = 14000,
+    manifest: CrawlManifest | None = None,
+    page_size: int | None = None,
+) -> List[str]:
+    """Save only the papers matching $query that are newer than the last harvest. The watermark (newest date
+    seen) of each scraper + query is kept in the crawl manifest, and the new papers are added to it so
+    `download_pdf_loop` picks them up. The first harvest of a query pages through up to $max_papers.
+
+    :param scraper: scraper to harvest with
+    :type scraper: GenericScraper
+    :param query: search query
+    :type query: str
+    :param dataset_path: folder to save the papers' folders to, defaults to "dataset/papers/"
+    :type dataset_path: str, optional
+    :param max_papers: max results to page through, defaults to 14000
+    :type max_papers: int, optional
+    :param manifest: crawl manifest holding the watermarks, defaults to None (open MANIFEST_PATH)
+    :type manifest: CrawlManifest | None, optional
+    :param page_size: results per request, defaults to None (the scraper's PAGE_SIZE)
+    :type page_size: int | None, optional
+    :return: folder names of the new papers
+    :rtype: List[str]
+    """
+    own_manifest = manifest is None
+    if manifest is None:
+        manifest = CrawlManifest()
+    key = f"{type(scraper).__name__}:{query}"
+    since = manifest.get_watermark(key)
+    page_size = page_size if page_size is not None else scraper.PAGE_SIZE
+    paper_paths, newest = scraper.scrape_since(query, since, page_size, max_papers, dataset_path)
+    manifest.add_papers(paper_paths)
+    if newest is not None:
+        manifest.set_watermark(key, newest)
+    print(f"{len(paper_paths)} papers since {since}, watermark now {newest}")
+    if own_manifest:
+        manifest.close()
+    return paper_paths
+
+
+def catalog_folders(catalog: PaperCatalog, folder_path: str) -> List[str]:
+    """Sorted folder names of the papers in $folder_path. Folders the catalog doesn't have yet are imported from
+    their paper_data.json first, and in a train/test folder made by `analyze.train_test_split` the ones the catalog
+    puts in the other split are left out."""
+    n_imported = catalog.import_folders(f"{normpath(folder_path)}/")
+    if n_imported > 0:
+        print(f"Catalogued {n_imported} papers of {folder_path} that weren't in the catalog")
+    folders = sorted(listdir(folder_path))
+    split = basename(normpath(folder_path))
+    if split not in SPLITS:
+        return folders
+    other = set(folder for other_split in SPLITS if other_split != split for folder in catalog.folders(other_split))
+    return [folder for folder in folders if folder not in other]
 
 
 def reset_tmp() -> None:
@@ -43,7 +127,13 @@ def reset_tmp() -> None:
 
 
 def download_extract(
-    scraper: GenericScraper, paper_path: str, dataset_path: str = "dataset/papers/"
+    scraper: GenericScraper,
+    paper_path: str,
+    dataset_path: str = "dataset/papers/",
+    worker: ExtractionWorker | None = None,
+    n_workers: int = 1,
+    cache: ExtractionCache | None = None,
+    manifest: CrawlManifest | None = None,
 ) -> None:
     """Given a scraper object and paper metadata at a given folder, download the pdf
     to tmp/, extract figures and save to the folder. Finally reset tmp/
@@ -54,25 +144,313 @@ def download_extract(
     :type paper_path: str
     :param dataset_path: path to the dataset - useful if needing to scrape test/train subsets
     :type dataset_path: str
+    :param worker: warm pdffigures2 worker to extract with, if None launch pdffigures2 for this paper only
+    :type worker: ExtractionWorker | None
+    :param n_workers: number of processes to split and save figures with
+    :type n_workers: int
+    :param cache: extraction cache to reuse pdffigures2/split results from, if None always extract
+    :type cache: ExtractionCache | None
+    :param manifest: crawl manifest to record the progress/failure of the paper in
+    :type manifest: CrawlManifest | None
     """
-    with open(f"{dataset_path}{paper_path}/paper_data.json", "r") as f:
-        data = load(f)
+    data = load_paper_data(paper_path, dataset_path, scraper.catalog)
     id = data["url"]
-    scraper.download_pdf(id, f"{CWD}/tmp/captions.pdf")
+    start = perf_counter()
+    try:
+        scraper.download_pdf(id, f"{CWD}/tmp/captions.pdf")
+    except Exception as err:
+        if manifest is not None:
+            manifest.mark_failed(paper_path, "download", err)
+        raise
+    if manifest is not None:
+        manifest.mark_downloaded(paper_path, f"{CWD}/tmp/captions.pdf", perf_counter() - start)
+
+    start = perf_counter()
     make_folder(f"{CWD}/{dataset_path}{paper_path}/imgs")
-    captions, img_paths = single_pdf_extract_process(
-        f"{CWD}/tmp/captions.pdf",
-        f"{CWD}/tmp/imgs/",
-        f"{CWD}/{dataset_path}{paper_path}/",
-        f"{CWD}/{dataset_path}{paper_path}/imgs/",
+    try:
+        captions, img_paths = single_pdf_extract_process(
+            f"{CWD}/tmp/captions.pdf",
+            f"{CWD}/tmp/imgs/",
+            f"{CWD}/{dataset_path}{paper_path}/",
+            f"{CWD}/{dataset_path}{paper_path}/imgs/",
+            worker=worker,
+            n_workers=n_workers,
+            cache=cache,
+        )
+    except Exception as err:
+        if manifest is not None:
+            manifest.mark_failed(paper_path, "extract", err)
+        raise
+    if manifest is not None:
+        manifest.mark_extracted(paper_path, img_paths, perf_counter() - start)
+
+
+def download_extract_batch(
+    scraper: GenericScraper,
+    paper_paths: List[str],
+    dataset_path: str = "dataset/papers/",
+    n_threads: int = 4,
+    worker: ExtractionWorker | None = None,
+    n_workers: int = 1,
+    cache: ExtractionCache | None = None,
+    manifest: CrawlManifest | None = None,
+) -> int:
+    """Batch version of `download_extract`: download a shard of papers to tmp/shard_pdfs/, run pdffigures2 once
+    over all of them with $n_threads threads and fan the figures/captions back out to each paper's folder.
+
+    :param scraper: scraper object that can download a pdf from an archive given metadata at $paper_path
+    :type scraper: GenericScraper
+    :param paper_paths: folders/paths the metadata of the papers in the shard are saved to
+    :type paper_paths: List[str]
+    :param dataset_path: path to the dataset - useful if needing to scrape test/train subsets
+    :type dataset_path: str
+    :param n_threads: number of threads pdffigures2 uses
+    :type n_threads: int
+    :param worker: warm pdffigures2 worker to extract with, if None launch pdffigures2 for this shard only
+    :type worker: ExtractionWorker | None
+    :param n_workers: number of processes to split and save figures with
+    :type n_workers: int
+    :param cache: extraction cache to reuse pdffigures2/split results from, if None always extract
+    :type cache: ExtractionCache | None
+    :param manifest: crawl manifest to record the progress/failure of each paper in
+    :type manifest: CrawlManifest | None
+    :return: number of papers in the shard that were downloaded
+    :rtype: int
+    """
+    reset_folder(f"{CWD}/tmp/shard_pdfs")
+    downloaded: List[str] = []
+    pdf_paths: List[str] = []
+    for i, paper_path in enumerate(paper_paths):
+        start = perf_counter()
+        try:
+            data = load_paper_data(paper_path, dataset_path, scraper.catalog)
+            scraper.download_pdf(data["url"], f"{CWD}/tmp/shard_pdfs/{i}.pdf")
+            make_folder(f"{CWD}/{dataset_path}{paper_path}/imgs")
+            downloaded.append(paper_path)
+            pdf_paths.append(f"{CWD}/tmp/shard_pdfs/{i}.pdf")
+        except Exception as err:
+            print(f"Fail! {paper_path}")
+            print(err)
+            if manifest is not None:
+                manifest.mark_failed(paper_path, "download", err)
+            continue
+        if manifest is not None:
+            manifest.mark_downloaded(paper_path, pdf_paths[-1], perf_counter() - start)
+
+    start = perf_counter()
+    results = batch_pdf_extract_process(
+        pdf_paths,
+        [f"{CWD}/{dataset_path}{p}/" for p in downloaded],
+        [f"{CWD}/{dataset_path}{p}/imgs/" for p in downloaded],
+        f"{CWD}/tmp/shard/",
+        out_names=["captions" for _ in downloaded],
+        n_threads=n_threads,
+        worker=worker,
+        n_workers=n_workers,
+        cache=cache,
     )
+    if manifest is not None:
+        # shard time split evenly between its papers
+        extract_s = (perf_counter() - start) / max(len(downloaded), 1)
+        for paper_path, (_, img_paths) in zip(downloaded, results):
+            if exists(f"{CWD}/{dataset_path}{paper_path}/captions.json"):
+                manifest.mark_extracted(paper_path, img_paths, extract_s)
+            else:
+                manifest.mark_failed(paper_path, "extract", "no pdffigures2 output")
+    return len(downloaded)
+
+
+# ==================================== PIPELINE ====================================
+
+# Download -> (bounded queue) -> N extraction threads. The download stage blocks once the queue is full, so it
+# never gets more than $queue_size papers ahead of extraction, and each extraction thread has its own scratch
+# folder (tmp/worker_<k>/) so pdffigures2 outputs don't mix. pdffigures2 itself runs one paper at a time on
+# the sbt worker (the jar can run concurrently), so the threads overlap download, pdffigures2 and splitting.
+PIPELINE_QUEUE_SIZE: int = 4
+
+
+class PipelineStats:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.n_downloaded = 0
+        self.n_extracted = 0
+        self.n_failed = 0
+        self.download_s: float = 0  # time spent in each stage, summed over threads
+        self.extract_s: float = 0
+
+    def add(self, **increments: float) -> None:
+        with self.lock:
+            for key, value in increments.items():
+                setattr(self, key, getattr(self, key) + value)
+
+
+def download_stage(
+    scraper: GenericScraper,
+    paper_paths: List[str],
+    dataset_path: str,
+    download_path: str,
+    jobs: Queue,
+    n_extractors: int,
+    stats: PipelineStats,
+    manifest: CrawlManifest | None = None,
+) -> None:
+    try:
+        for i, paper_path in enumerate(paper_paths):
+            start = perf_counter()
+            pdf_path = f"{download_path}{i}/captions.pdf"
+            try:
+                data = load_paper_data(paper_path, dataset_path, scraper.catalog)
+                reset_folder(f"{download_path}{i}")
+                scraper.download_pdf(data["url"], pdf_path)
+            except Exception as err:
+                print(f"Fail! {paper_path}")
+                print(err)
+                rmtree(f"{download_path}{i}", ignore_errors=True)
+                stats.add(n_failed=1)
+                if manifest is not None:
+                    manifest.mark_failed(paper_path, "download", err)
+                continue
+            stats.add(n_downloaded=1, download_s=perf_counter() - start)
+            if manifest is not None:
+                manifest.mark_downloaded(paper_path, pdf_path, perf_counter() - start)
+            jobs.put((paper_path, pdf_path))  # blocks while the queue is full
+    finally:
+        # however the loop ends (i.e the manifest raising), the extractors must be told to stop or they block
+        for _ in range(n_extractors):
+            jobs.put(None)
+
+
+def extract_stage(
+    k: int,
+    jobs: Queue,
+    dataset_path: str,
+    scratch_path: str,
+    stats: PipelineStats,
+    worker: ExtractionWorker | None = None,
+    n_workers: int = 1,
+    cache: ExtractionCache | None = None,
+    manifest: CrawlManifest | None = None,
+) -> None:
+    img_path = f"{scratch_path}worker_{k}/imgs/"
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        paper_path, pdf_path = job
+        start = perf_counter()
+        try:
+            reset_folder(img_path)
+            make_folder(f"{dataset_path}{paper_path}/imgs")
+            _, img_paths = single_pdf_extract_process(
+                pdf_path,
+                img_path,
+                f"{dataset_path}{paper_path}/",
+                f"{dataset_path}{paper_path}/imgs/",
+                worker=worker,
+                n_workers=n_workers,
+                cache=cache,
+            )
+            stats.add(n_extracted=1, extract_s=perf_counter() - start)
+            if manifest is not None:
+                manifest.mark_extracted(paper_path, img_paths, perf_counter() - start)
+        except Exception as err:
+            print(f"Fail! {paper_path}")
+            print(err)
+            stats.add(n_failed=1)
+            if manifest is not None:
+                manifest.mark_failed(paper_path, "extract", err)
+        finally:
+            rmtree(pdf_path.rsplit("/", 1)[0], ignore_errors=True)
+
+
+def download_extract_pipeline(
+    scraper: GenericScraper,
+    paper_paths: List[str],
+    dataset_path: str = "dataset/papers/",
+    n_extractors: int = 2,
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+    worker: ExtractionWorker | None = None,
+    n_workers: int = 1,
+    cache: ExtractionCache | None = None,
+    scratch_path: str = f"{CWD}/tmp/",
+    manifest: CrawlManifest | None = None,
+) -> PipelineStats:
+    """Download and extract papers with download and extraction overlapped: one thread downloads pdfs into a
+    queue of at most $queue_size papers and $n_extractors threads extract from it, each in its own scratch
+    folder. Throughput is set by the slowest stage rather than the sum of the stages.
+
+    :param scraper: scraper object that can download a pdf from an archive given metadata at $paper_path
+    :type scraper: GenericScraper
+    :param paper_paths: folders/paths the metadata of the papers are saved to
+    :type paper_paths: List[str]
+    :param dataset_path: path to the dataset - useful if needing to scrape test/train subsets
+    :type dataset_path: str
+    :param n_extractors: number of extraction threads, defaults to 2
+    :type n_extractors: int, optional
+    :param queue_size: max downloaded papers waiting to be extracted, defaults to PIPELINE_QUEUE_SIZE
+    :type queue_size: int, optional
+    :param worker: warm pdffigures2 worker shared by the extraction threads, defaults to None
+    :type worker: ExtractionWorker | None, optional
+    :param n_workers: number of processes each extraction thread splits and saves figures with, defaults to 1
+    :type n_workers: int, optional
+    :param cache: extraction cache to reuse pdffigures2/split results from, defaults to None
+    :type cache: ExtractionCache | None, optional
+    :param scratch_path: ABSOLUTE folder for the downloads and per-thread pdffigures2 output
+    :type scratch_path: str, optional
+    :param manifest: crawl manifest to record the progress/failure of each paper in, defaults to None
+    :type manifest: CrawlManifest | None, optional
+    :return: counts and time spent in each stage
+    :rtype: PipelineStats
+    """
+    if not isabs(dataset_path):
+        dataset_path = f"{CWD}/{dataset_path}"
+    jobs: Queue = Queue(maxsize=queue_size)
+    stats = PipelineStats()
+    threads = [
+        Thread(
+            target=download_stage,
+            args=(
+                scraper,
+                paper_paths,
+                dataset_path,
+                f"{scratch_path}downloads/",
+                jobs,
+                n_extractors,
+                stats,
+                manifest,
+            ),
+        )
+    ]
+    for k in range(n_extractors):
+        threads.append(
+            Thread(
+                target=extract_stage,
+                args=(k, jobs, dataset_path, scratch_path, stats, worker, n_workers, cache, manifest),
+            )
+        )
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats
 
 
 def download_pdf_loop(
-    n_samples: int = 100, folder_path: str = "dataset/papers"
+    n_samples: int = 100,
+    folder_path: str = "dataset/papers",
+    use_jar: bool = False,
+    batch_size: int = 1,
+    n_threads: int = 4,
+    n_workers: int = 1,
+    use_cache: bool = True,
+    n_extractors: int = 1,
+    use_manifest: bool = True,
+    use_catalog: bool = True,
 ) -> None:
     reset_tmp()
-    papers = listdir(folder_path)
+    # sorted so the seeded sample is the same on every run, which the manifest relies on to resume
+    catalog = PaperCatalog() if use_catalog else None
+    papers = catalog_folders(catalog, folder_path) if catalog is not None else sorted(listdir(folder_path))
     n_papers = len(papers)
 
     if n_samples == -1:
@@ -80,30 +458,81 @@ def download_pdf_loop(
 
     indices = np.arange(0, n_papers)
     chosen_indices = np.random.choice(indices, size=n_samples, replace=False)
+    paper_paths = [papers[idx] for idx in chosen_indices]
 
-    scraper = ChemrxivScraper()
+    manifest = CrawlManifest() if use_manifest else None
+    if manifest is not None:
+        manifest.add_papers(paper_paths)
+        paper_paths = manifest.pending(paper_paths)
+        print(f"{n_samples - len(paper_paths)}/{n_samples} papers already done or out of attempts")
+
+    scraper = ChemrxivScraper(catalog=catalog)
+    worker = ExtractionWorker(use_jar=use_jar)  # sbt is only started by the first paper that needs extracting
+    cache = ExtractionCache() if use_cache else None
 
     i = 0
-    stop = n_samples
+    stop = len(paper_paths)
+
+    if n_extractors > 1:
+        start = perf_counter()
+        stats = download_extract_pipeline(
+            scraper,
+            paper_paths,
+            folder_path,
+            n_extractors,
+            worker=worker,
+            n_workers=n_workers,
+            cache=cache,
+            manifest=manifest,
+        )
+        elapsed = perf_counter() - start
+        print(
+            f"{stats.n_extracted} extracted, {stats.n_failed} failed in {elapsed:.1f}s "
+            f"({stats.n_extracted / max(elapsed, 1e-9):.2f} papers/s). "
+            f"Stage time: {stats.download_s:.1f}s download, {stats.extract_s:.1f}s extract"
+        )
+        i = stop
 
-    prev_time = time()
     while i < stop:
+        # no need to wait here: the scraper's rate limiter sleeps until the next request is allowed
         new_time = time()
-        if (new_time - prev_time) > REQUEST_DELAY_S:
-            chosen_idx = chosen_indices[i]
-            chosen_paper_path = papers[chosen_idx]
-            print(chosen_paper_path)
-            print(f"{new_time} [{i}/{stop}]: scraping paper {chosen_idx}")
-            reset_tmp()
-            try:
-                print(chosen_paper_path)
-                download_extract(scraper, chosen_paper_path, folder_path)
-                i += 1
-            except Exception as err:
-                print("Fail!")
-                print(err)
-                i += 1
-            prev_time = new_time
+        if batch_size > 1:
+            batch_paths = paper_paths[i : i + batch_size]
+            print(f"{new_time} [{i}/{stop}]: scraping papers {batch_paths}")
+            download_extract_batch(
+                scraper, batch_paths, folder_path, n_threads, worker, n_workers, cache, manifest
+            )
+            i += len(batch_paths)
+            continue
+
+        chosen_paper_path = paper_paths[i]
+        print(f"{new_time} [{i}/{stop}]: scraping paper {chosen_paper_path}")
+        reset_tmp()
+        try:
+            n_jobs = len(worker.jobs)
+            download_extract(
+                scraper, chosen_paper_path, folder_path, worker, n_workers, cache, manifest
+            )
+            if len(worker.jobs) > n_jobs:
+                print(f"extracted in {worker.jobs[-1].latency_s:.2f}s")
+            else:
+                print("cache hit")
+            i += 1
+        except Exception as err:
+            print("Fail!")
+            print(err)
+            i += 1
+    worker.stop()
+    shutdown_split_pool()
+    print(worker.stats())
+    print(scraper.limiter.stats())
+    if cache is not None:
+        print(cache.report())
+    if manifest is not None:
+        print(manifest.stats())
+        manifest.close()
+    if catalog is not None:
+        catalog.close()
 
 
 if __name__ == "__main__":
@@ -112,4 +541,8 @@ if __name__ == "__main__":
     download_pdf_loop(-1, "dataset/train/")
 
     # scraper = ArxivScraper()
-    # paper_info_loop(scraper, "all:microscopy")
+    # catalog = PaperCatalog()
+    # try:
+    #     paper_info_loop(scraper, "all:microscopy", catalog=catalog)
+    # finally:
+    #     catalog.close()
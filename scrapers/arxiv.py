@@ -1,11 +1,43 @@
-import requests
+import re
 import xml.etree.ElementTree as ET
-from typing import Tuple, List
+from io import BytesIO
+from typing import Iterable, Iterator, Tuple, List
+import requests
+
+from .generic import GenericScraper, PaperEntry, make_folder, asdict, dump, stream_download
+
+ATOM_NS: str = "{http://www.w3.org/2005/Atom}"
+# the API returns at most 2000 results per request. Pages are parsed as they stream in (see `iter_entries`), so
+# memory doesn't grow with the page size
+MAX_PAGE_SIZE: int = 2000
+VERSION_PATTERN = re.compile(r"v\d+$")  # i.e the "v2" of 2401.00001v2
+
 
-from .generic import GenericScraper, PaperEntry, make_folder, asdict, dump
+def iter_entries(source, response: requests.Response | None = None) -> Iterator[ET.Element]:
+    """Yield each <entry> of an Atom feed read incrementally from file-like $source. An entry is cleared and
+    dropped from the tree once the caller asks for the next one, so only one entry is held at a time.
+    $response, if given, is closed when the generator finishes (or is closed/garbage collected early)."""
+    try:
+        root: ET.Element | None = None
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if root is None:
+                root = elem  # <feed>
+            elif event == "end" and elem.tag == f"{ATOM_NS}entry":
+                yield elem
+                elem.clear()
+                root.remove(elem)
+    finally:
+        if response is not None:
+            response.close()
 
 
 class ArxivScraper(GenericScraper):
+    # newest submissions first, so `handle_entry(...).date` (the published date) decreases down the pages
+    INCREMENTAL_SORT = ("submittedDate", "descending")
+    STREAM_PAGES = True
+    PAGE_SIZE = MAX_PAGE_SIZE
+    SOURCE = "arxiv"
+
     def scrape(
         self,
         query: str,
@@ -25,45 +57,57 @@ class ArxivScraper(GenericScraper):
         max_results: int = 100,
         sort_by: str = "lastUpdatedDate",
         sort_order="descending",
+    ) -> Iterator[ET.Element]:
+        url = self.get_api_url(query_term, start, max_results, sort_by, sort_order)
+        return self.parse_response(self.get_page(url))
+
+    def get_api_url(
+        self,
+        query_term: str,
+        start: int = 0,
+        max_results: int = 100,
+        sort_by: str = "lastUpdatedDate",
+        sort_order="descending",
     ) -> str:
-        url = f"http://export.arxiv.org/api/query?search_query={query_term}&start={start}&max_results={max_results}&sortBy={sort_by}&sortOrder={sort_order}"
-        result = requests.get(url)
-        return result.text
+        return self.route(
+            f"http://export.arxiv.org/api/query?search_query={query_term}&start={start}&max_results={max_results}&sortBy={sort_by}&sortOrder={sort_order}"
+        )
 
-    def handle_entries(  # type: ignore[override]
-        self, entries: str, dataset_path: str = "dataset/papers/"
-    ) -> int:
-        n_papers = 0
-        root = ET.fromstring(entries)
-        for child in root:
-            if "entry" in child.tag:
-                paper_entry = self.handle_entry(child)
-                folder_name = self.doi_to_folder_name(paper_entry.doi)
-                make_folder(dataset_path + folder_name)
-                self.save_paper_data(paper_entry, dataset_path + folder_name)
-                n_papers += 1
-        return n_papers
+    def parse_response(self, response: requests.Response) -> Iterator[ET.Element]:  # type: ignore[override]
+        # $response should be from `get_page` (streamed): the body is parsed straight from the socket
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return iter_entries(response.raw, response)
+
+    def get_entries(self, entries: str | bytes | Iterable[ET.Element]) -> Iterable[ET.Element]:  # type: ignore[override]
+        if isinstance(entries, str):
+            entries = entries.encode()
+        if isinstance(entries, bytes):
+            return iter_entries(BytesIO(entries))
+        return entries
 
     def handle_entry(self, entry_elem: ET.Element) -> PaperEntry:  # type: ignore[override]
         id, title, authors, abstract, date = "", "", [], "", ""
         for child in entry_elem:
-            if "id" in child.tag:
+            if child.tag == f"{ATOM_NS}id":
                 id = child.text
-            elif "title" in child.tag:
+            elif child.tag == f"{ATOM_NS}title":
                 title = child.text
-            elif "summary" in child.tag:
+            elif child.tag == f"{ATOM_NS}summary":
                 abstract = child.text
-            elif "published" in child.tag:
+            elif child.tag == f"{ATOM_NS}published":
                 date = child.text
-            elif "author" in child.tag:
-                authors.append(child[0].text)
+            elif child.tag == f"{ATOM_NS}author":
+                authors.append(child.findtext(f"{ATOM_NS}name"))
         doi = self.url_to_doi(id)
         values = [id, doi, title, authors, abstract, date]
         return PaperEntry(*values)  # type: ignore
 
     def url_to_doi(self, url: str) -> str:
+        # without the version, so every version of a paper (and its OAI-PMH record, whose id has none) gets the
+        # same doi and dataset folder. The url keeps it, so the pdf downloaded is the version that was listed.
         end = url.split("/")[-1]
-        return "arXiv:" + end
+        return "arXiv:" + VERSION_PATTERN.sub("", end)
 
     def doi_to_folder_name(self, doi: str):
         return doi.replace(":", "_").lower()
@@ -73,9 +117,9 @@ class ArxivScraper(GenericScraper):
         with open(path + "/paper_data.json", "w+") as f:
             dump(paper_dict, f, ensure_ascii=False, indent=4)
 
-    def download_pdf(self, paper_id: str, save_path: str) -> None:
+    def get_pdf_url(self, paper_id: str) -> str:
         id = paper_id.split("/")[-1]
-        pdf_url = f"http://export.arxiv.org/pdf/{id}.pdf"
-        result = requests.get(pdf_url)
-        with open(save_path, "wb+") as f:
-            f.write(result.content)
+        return self.route(f"http://export.arxiv.org/pdf/{id}.pdf")
+
+    def download_pdf(self, paper_id: str, save_path: str) -> None:
+        stream_download(self.get_pdf_url(paper_id), save_path, get=self.get)
@@ -0,0 +1,185 @@
+import xml.etree.ElementTree as ET
+from urllib.parse import urlencode
+from typing import TYPE_CHECKING, Iterator, List, Tuple
+
+from .generic import PaperEntry, RateLimiter, SAVE_BATCH
+from .arxiv import ArxivScraper
+
+if TYPE_CHECKING:
+    from .catalog import PaperCatalog
+
+# ==================================== ARXIV OAI-PMH HARVESTER ====================================
+
+# Bulk metadata through arXiv's OAI-PMH endpoint (https://info.arxiv.org/help/oa/index.html): ListRecords
+# returns ~1000 records per response with a resumption token for the next one, filtered by set (i.e
+# "physics:cond-mat") and datestamp rather than by search terms, so we filter for microscopy locally.
+# Responses are parsed from the byte stream, so a page never has to be held in memory as a string/tree.
+OAI_URL: str = "http://export.arxiv.org/oai2"
+OAI_NS: str = "{http://www.openarchives.org/OAI/2.0/}"
+ARXIV_NS: str = "{http://arxiv.org/OAI/arXiv/}"
+METADATA_PREFIX: str = "arXiv"
+# case-insensitive substrings of the title/abstract a paper needs one of to be saved
+MICROSCOPY_KEYWORDS: List[str] = ["microscop", "micrograph"]
+
+
+def _text(elem: ET.Element | None) -> str:
+    if elem is None or elem.text is None:
+        return ""
+    return " ".join(elem.text.split())  # titles/abstracts are hard-wrapped
+
+
+class OAIError(Exception):
+    pass
+
+
+class ArxivOAIHarvester(ArxivScraper):
+    def __init__(
+        self,
+        limiter: RateLimiter | None = None,
+        base_url: str = OAI_URL,
+        keywords: List[str] | None = None,
+        catalog: "PaperCatalog | None" = None,
+    ) -> None:
+        """Harvest arXiv metadata in bulk with OAI-PMH, emitting the same `PaperEntry` records (and saved
+        paper_data.json) as `ArxivScraper`, whose pdf download etc. it inherits.
+
+        :param limiter: per-host rate limiter, defaults to SHARED_LIMITER
+        :type limiter: RateLimiter | None, optional
+        :param base_url: OAI-PMH endpoint, defaults to OAI_URL
+        :type base_url: str, optional
+        :param keywords: keep papers whose title/abstract contain one of these, defaults to MICROSCOPY_KEYWORDS.
+            An empty list keeps every paper.
+        :type keywords: List[str] | None, optional
+        :param catalog: paper catalog to add saved papers to, defaults to None
+        :type catalog: PaperCatalog | None, optional
+        """
+        super().__init__(limiter, catalog=catalog)
+        self.base_url = base_url
+        self.keywords = [k.lower() for k in (keywords if keywords is not None else MICROSCOPY_KEYWORDS)]
+
+    def get_list_url(
+        self,
+        set_spec: str | None = None,
+        from_date: str | None = None,
+        until_date: str | None = None,
+        token: str | None = None,
+    ) -> str:
+        if token is not None:
+            # a resumption token replaces every other argument
+            return f"{self.base_url}?{urlencode({'verb': 'ListRecords', 'resumptionToken': token})}"
+        params = {"verb": "ListRecords", "metadataPrefix": METADATA_PREFIX}
+        for key, value in [("set", set_spec), ("from", from_date), ("until", until_date)]:
+            if value is not None:
+                params[key] = value
+        return f"{self.base_url}?{urlencode(params)}"
+
+    def record_to_entry(self, record: ET.Element) -> PaperEntry | None:
+        """Convert an OAI <record> to a PaperEntry, None if the record was deleted."""
+        header = record.find(f"{OAI_NS}header")
+        if header is not None and header.get("status") == "deleted":
+            return None
+        metadata = record.find(f"{OAI_NS}metadata/{ARXIV_NS}arXiv")
+        if metadata is None:
+            return None
+        url = f"http://arxiv.org/abs/{_text(metadata.find(f'{ARXIV_NS}id'))}"
+        authors = []
+        for author in metadata.iterfind(f"{ARXIV_NS}authors/{ARXIV_NS}author"):
+            name = f"{_text(author.find(f'{ARXIV_NS}forenames'))} {_text(author.find(f'{ARXIV_NS}keyname'))}"
+            authors.append(name.strip())
+        return PaperEntry(
+            url,
+            self.url_to_doi(url),  # same (versionless) doi and folder as the search API gives this paper
+            _text(metadata.find(f"{ARXIV_NS}title")),
+            authors,
+            _text(metadata.find(f"{ARXIV_NS}abstract")),
+            f"{_text(metadata.find(f'{ARXIV_NS}created'))}T00:00:00Z",  # same format as the search API
+        )
+
+    def is_match(self, paper_entry: PaperEntry) -> bool:
+        if len(self.keywords) == 0:
+            return True
+        text = f"{paper_entry.title} {paper_entry.abstract}".lower()
+        return any(keyword in text for keyword in self.keywords)
+
+    def iter_page(self, url: str) -> Iterator[PaperEntry | str | None]:
+        """Stream one ListRecords response, yielding a PaperEntry (or None for deleted records) per record and
+        finally the resumption token (None on the last page). Each record is cleared once converted."""
+        with self.get(url, stream=True) as response:
+            if response.status_code != 200:
+                raise OAIError(f"{url}: HTTP {response.status_code}")
+            response.raw.decode_content = True  # undo gzip
+            token: str | None = None
+            root: ET.Element | None = None
+            for event, elem in ET.iterparse(response.raw, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    continue
+                if elem.tag == f"{OAI_NS}record":
+                    yield self.record_to_entry(elem)
+                    elem.clear()
+                elif elem.tag == f"{OAI_NS}resumptionToken":
+                    token = elem.text.strip() if elem.text and elem.text.strip() else None
+                elif elem.tag == f"{OAI_NS}error":
+                    if elem.get("code") == "noRecordsMatch":
+                        break
+                    raise OAIError(f"{url}: {elem.get('code')} {_text(elem)}")
+                elif elem.tag == f"{OAI_NS}ListRecords" and root is not None:
+                    root.clear()
+            yield token
+
+    def iter_records(
+        self, set_spec: str | None = None, from_date: str | None = None, until_date: str | None = None
+    ) -> Iterator[PaperEntry]:
+        """Every (non-deleted) record in $set_spec with a datestamp in [$from_date, $until_date], following
+        resumption tokens until the last page. Dates are YYYY-MM-DD."""
+        url = self.get_list_url(set_spec, from_date, until_date)
+        while True:
+            token = None
+            for item in self.iter_page(url):
+                if isinstance(item, PaperEntry):
+                    yield item
+                elif isinstance(item, str):
+                    token = item
+            if token is None:
+                return
+            url = self.get_list_url(token=token)
+
+    def harvest(
+        self,
+        set_spec: str | None = "physics",
+        from_date: str | None = None,
+        until_date: str | None = None,
+        dataset_path: str = "dataset/papers/",
+        max_papers: int = -1,
+    ) -> Tuple[List[str], int]:
+        """Save paper_data.json of every record matching the keywords.
+
+        :param set_spec: OAI set to harvest, i.e "physics" or "physics:cond-mat", defaults to "physics"
+        :type set_spec: str | None, optional
+        :param from_date: earliest datestamp (YYYY-MM-DD), defaults to None
+        :type from_date: str | None, optional
+        :param until_date: latest datestamp (YYYY-MM-DD), defaults to None
+        :type until_date: str | None, optional
+        :param dataset_path: folder to save the papers' folders to, defaults to "dataset/papers/"
+        :type dataset_path: str, optional
+        :param max_papers: stop after saving this many papers, defaults to -1 (no limit)
+        :type max_papers: int, optional
+        :return: folder names of the saved papers and the number of records seen
+        :rtype: Tuple[List[str], int]
+        """
+        saved: List[str] = []
+        batch: List[PaperEntry] = []
+        n_seen = 0
+        for paper_entry in self.iter_records(set_spec, from_date, until_date):
+            n_seen += 1
+            if not self.is_match(paper_entry):
+                continue
+            batch.append(paper_entry)
+            if len(saved) + len(batch) == max_papers:
+                break
+            if len(batch) == SAVE_BATCH:
+                saved += self.save_entries(batch, dataset_path)
+                batch = []
+        saved += self.save_entries(batch, dataset_path)
+        return saved, n_seen
@@ -0,0 +1,172 @@
+import asyncio
+from urllib.parse import urlparse
+from typing import Callable, Dict, List
+
+import requests
+
+from .generic import GenericScraper, stream_download, N_RETRIES, RETRY_STATUSES, THROTTLE_STATUSES, DOWNLOAD_TIMEOUT_S
+
+# ==================================== ASYNC CRAWLER ====================================
+
+# requests is blocking, so each request runs in a thread with `asyncio.to_thread` while the event loop schedules
+# the next one. The scraper's (shared) rate limiter spaces out request starts and a per-host semaphore caps the
+# number in flight, so the crawl runs at the allowed rate instead of waiting on each response + file write.
+MAX_IN_FLIGHT: int = 4
+
+
+class AsyncCrawler:
+    def __init__(
+        self,
+        scraper: GenericScraper,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        dataset_path: str = "dataset/papers/",
+    ) -> None:
+        """Concurrent metadata paging and pdf downloads for a scraper (i.e `ArxivScraper`, `ChemrxivScraper`).
+
+        :param scraper: scraper to get urls, parse responses, save paper data and make requests with
+        :type scraper: GenericScraper
+        :param max_in_flight: max concurrent requests per host, defaults to MAX_IN_FLIGHT
+        :type max_in_flight: int, optional
+        :param dataset_path: folder to save the papers' folders (with their paper_data.json) to, defaults to
+            "dataset/papers/"
+        :type dataset_path: str, optional
+        """
+        self.scraper = scraper
+        self.max_in_flight = max_in_flight
+        self.dataset_path = dataset_path
+        # created on first use so they belong to the running event loop
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.max_in_flight)
+        return self.semaphores[host]
+
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        # rate limit already waited for in `fetch`
+        return self.scraper.send(url, **kwargs)
+
+    async def fetch(
+        self, url: str, skip: Callable[[], bool] = lambda: False, **kwargs
+    ) -> requests.Response | None:
+        """GET $url once there's a free slot for its host and the rate limit allows it, retrying $RETRY_STATUSES
+        and $THROTTLE_STATUSES responses like `GenericScraper.get`.
+
+        :param url: url to get
+        :type url: str
+        :param skip: checked once allowed to start, the request isn't made if it returns True
+        :type skip: Callable[[], bool], optional
+        :param kwargs: passed to `Session.get`, i.e stream=True
+        :return: the response, or None if skipped
+        :rtype: requests.Response | None
+        """
+        async with self._semaphore(url):
+            return await self._fetch(url, skip, **kwargs)
+
+    async def _fetch(self, url: str, skip: Callable[[], bool], **kwargs) -> requests.Response | None:
+        # `fetch` for a caller already holding the host's semaphore
+        for attempt in range(N_RETRIES + 1):
+            await self.scraper.limiter.acquire_async(url)
+            if skip():
+                return None
+            response = await asyncio.to_thread(self._get, url, **kwargs)
+            if response.status_code not in RETRY_STATUSES + THROTTLE_STATUSES or attempt == N_RETRIES:
+                break
+            response.close()  # the limiter has backed off, try again once it allows
+        return response
+
+    async def fetch_page(
+        self, query: str, start: int, page_size: int, skip: Callable[[], bool] = lambda: False
+    ) -> int:
+        """Request one page of results and save the paper data of its entries.
+
+        :return: number of papers on the page
+        :rtype: int
+        """
+        url = self.scraper.get_api_url(query, start, page_size)
+        # the slot is held until the page is parsed: a streamed body is read from the socket while parsing
+        async with self._semaphore(url):
+            response = await self._fetch(url, skip, stream=self.scraper.STREAM_PAGES)
+            if response is None:
+                return 0
+
+            def handle_page() -> int:
+                entries = self.scraper.parse_response(response)
+                return self.scraper.handle_entries(entries, self.dataset_path)  # type: ignore
+
+            return await asyncio.to_thread(handle_page)
+
+    async def crawl_metadata(
+        self, query: str, max_papers: int, page_size: int = 100, start: int = 0
+    ) -> int:
+        """Page through the results of $query concurrently, saving paper_data.json of each paper as the pages
+        arrive. Pages that haven't been requested yet are skipped once a page comes back empty.
+
+        :param query: search query
+        :type query: str
+        :param max_papers: number of results to page through
+        :type max_papers: int
+        :param page_size: results per request, defaults to 100
+        :type page_size: int, optional
+        :param start: offset of the first result, defaults to 0
+        :type start: int, optional
+        :return: number of papers saved
+        :rtype: int
+        """
+        exhausted = False
+
+        async def get_page(page_start: int) -> int:
+            nonlocal exhausted
+            try:
+                n_papers = await self.fetch_page(query, page_start, page_size, lambda: exhausted)
+            except Exception as err:
+                print(f"Fail! page at {page_start}: {err}")
+                return 0
+            if n_papers == 0:
+                exhausted = True
+            return n_papers
+
+        page_starts = range(start, start + max_papers, page_size)
+        return sum(await asyncio.gather(*[get_page(page_start) for page_start in page_starts]))
+
+    async def download(self, paper_id: str, save_path: str) -> bool:
+        pdf_url = self.scraper.get_pdf_url(paper_id)
+        async with self._semaphore(pdf_url):
+            try:
+                # retried like any other request, then handed to `stream_download` to validate and write
+                response = await self._fetch(pdf_url, lambda: False, stream=True, timeout=DOWNLOAD_TIMEOUT_S)
+                await asyncio.to_thread(stream_download, pdf_url, save_path, get=lambda url, **kwargs: response)
+                return True
+            except Exception as err:
+                print(f"Fail! {paper_id}: {err}")
+                return False
+
+    async def download_pdfs(self, paper_ids: List[str], save_paths: List[str]) -> List[bool]:
+        """Download the pdfs of $paper_ids to $save_paths concurrently.
+
+        :return: whether each download succeeded
+        :rtype: List[bool]
+        """
+        return list(await asyncio.gather(*[self.download(i, p) for i, p in zip(paper_ids, save_paths)]))
+
+
+def crawl_metadata(
+    scraper: GenericScraper,
+    query: str,
+    max_papers: int,
+    page_size: int = 100,
+    max_in_flight: int = MAX_IN_FLIGHT,
+    dataset_path: str = "dataset/papers/",
+) -> int:
+    """Blocking wrapper of `AsyncCrawler.crawl_metadata`."""
+    crawler = AsyncCrawler(scraper, max_in_flight, dataset_path)
+    return asyncio.run(crawler.crawl_metadata(query, max_papers, page_size))
+
+
+def download_pdfs(
+    scraper: GenericScraper, paper_ids: List[str], save_paths: List[str], max_in_flight: int = MAX_IN_FLIGHT
+) -> List[bool]:
+    """Blocking wrapper of `AsyncCrawler.download_pdfs`."""
+    crawler = AsyncCrawler(scraper, max_in_flight)
+    return asyncio.run(crawler.download_pdfs(paper_ids, save_paths))
@@ -0,0 +1,189 @@
+import sqlite3
+from json import dumps, loads, load
+from os import listdir
+from os.path import isfile
+from threading import Lock
+from time import time
+from typing import Dict, Iterator, List, Tuple
+
+from .generic import PaperEntry, asdict
+
+# ==================================== PAPER CATALOG ====================================
+
+# One row per scraped paper (keyed by its folder name in the dataset), written in bulk by the scrapers, so later
+# stages look papers up by folder/DOI/date/source with an indexed query instead of listing the dataset folder and
+# parsing thousands of paper_data.json files. The per-folder paper_data.json is still written as an export.
+CATALOG_PATH: str = "paper_catalog.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    folder TEXT PRIMARY KEY,
+    doi TEXT NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT,
+    authors TEXT,
+    abstract TEXT,
+    date TEXT,
+    source TEXT NOT NULL,
+    split TEXT,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS papers_doi ON papers (doi);
+CREATE INDEX IF NOT EXISTS papers_date ON papers (date);
+CREATE INDEX IF NOT EXISTS papers_source ON papers (source);
+CREATE INDEX IF NOT EXISTS papers_split ON papers (split);
+"""
+FIELDS = ["url", "doi", "title", "authors", "abstract", "date"]  # order of `PaperEntry`
+SPLITS = ("train", "test")  # dataset subfolders made by `analyze.train_test_split`
+
+
+class PaperCatalog:
+    def __init__(self, db_path: str = CATALOG_PATH) -> None:
+        """SQLite catalog of the `PaperEntry` of every scraped paper. Safe to share between threads.
+
+        :param db_path: path of the database file, defaults to CATALOG_PATH
+        :type db_path: str, optional
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = Lock()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # ============ UPDATES ============
+    def add_entries(self, folders: List[str], paper_entries: List[PaperEntry], source: str) -> None:
+        """Insert (or update the metadata of) papers in one transaction. A paper's split is kept on update.
+
+        :param folders: folder name of each paper in the dataset
+        :type folders: List[str]
+        :param paper_entries: metadata of each paper
+        :type paper_entries: List[PaperEntry]
+        :param source: archive the papers were scraped from, i.e "arxiv"
+        :type source: str
+        """
+        now = time()
+        rows = [
+            (folder, e.doi, e.url, e.title, dumps(e.authors), e.abstract, e.date, source, now)
+            for folder, e in zip(folders, paper_entries)
+        ]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO papers (folder, doi, url, title, authors, abstract, date, source, added_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(folder) DO UPDATE SET doi = excluded.doi,
+                url = excluded.url, title = excluded.title, authors = excluded.authors,
+                abstract = excluded.abstract, date = excluded.date, source = excluded.source""",
+                rows,
+            )
+
+    def set_split(self, folders: List[str], split: str | None) -> None:
+        """Record which split ("train", "test") $folders were put in."""
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE papers SET split = ? WHERE folder = ?", [(split, f) for f in folders])
+
+    def reset_splits(self) -> None:
+        """Clear the split of every paper, i.e before recording a new train/test split."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE papers SET split = NULL")
+
+    def import_folders(self, dataset_path: str = "dataset/papers/", source: str = "unknown") -> int:
+        """Add the paper_data.json of every folder in $dataset_path, i.e to catalog a dataset scraped before the
+        catalog existed. Papers already in the catalog keep their source.
+
+        :return: number of papers imported
+        :rtype: int
+        """
+        folders, paper_entries = [], []
+        known = set(self.folders())
+        for folder in sorted(listdir(dataset_path)):
+            path = f"{dataset_path}{folder}/paper_data.json"
+            if folder in known or not isfile(path):
+                continue
+            with open(path, "r") as f:
+                data = load(f)
+            folders.append(folder)
+            paper_entries.append(PaperEntry(*[data.get(field, "") for field in FIELDS]))
+        self.add_entries(folders, paper_entries, source)
+        return len(folders)
+
+    # ============ QUERIES ============
+    def _row_to_entry(self, row: tuple) -> PaperEntry:
+        url, doi, title, authors, abstract, date = row
+        return PaperEntry(url, doi, title, loads(authors), abstract, date)
+
+    def get(self, folder: str) -> PaperEntry | None:
+        rows = self._query(f"SELECT {', '.join(FIELDS)} FROM papers WHERE folder = ?", (folder,))
+        return self._row_to_entry(rows[0]) if len(rows) > 0 else None
+
+    def get_by_doi(self, doi: str) -> PaperEntry | None:
+        rows = self._query(f"SELECT {', '.join(FIELDS)} FROM papers WHERE doi = ?", (doi,))
+        return self._row_to_entry(rows[0]) if len(rows) > 0 else None
+
+    def folders(
+        self,
+        split: str | None = None,
+        source: str | None = None,
+        since: str | None = None,
+        until: str | None = None,
+    ) -> List[str]:
+        """Folder names of the papers matching every filter given, sorted.
+
+        :param split: only papers in this split, defaults to None
+        :type split: str | None, optional
+        :param source: only papers from this archive, defaults to None
+        :type source: str | None, optional
+        :param since: only papers dated on/after this (ISO 8601), defaults to None
+        :type since: str | None, optional
+        :param until: only papers dated before this (ISO 8601), defaults to None
+        :type until: str | None, optional
+        :return: folder names
+        :rtype: List[str]
+        """
+        conditions, params = [], []
+        filters = [("split = ?", split), ("source = ?", source), ("date >= ?", since), ("date < ?", until)]
+        for condition, value in filters:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+        return [row[0] for row in self._query(f"SELECT folder FROM papers {where} ORDER BY folder", tuple(params))]
+
+    def entries(self, folders: List[str] | None = None) -> Iterator[Tuple[str, PaperEntry]]:
+        """(folder, PaperEntry) of $folders (those in the catalog), or of every paper, in folder order."""
+        rows = self._query(f"SELECT folder, {', '.join(FIELDS)} FROM papers ORDER BY folder")
+        wanted = set(folders) if folders is not None else None
+        for row in rows:
+            if wanted is None or row[0] in wanted:
+                yield row[0], self._row_to_entry(row[1:])
+
+    def stats(self) -> Dict:
+        by_source = dict(self._query("SELECT source, COUNT(*) FROM papers GROUP BY source"))
+        by_split = dict(self._query("SELECT split, COUNT(*) FROM papers WHERE split IS NOT NULL GROUP BY split"))
+        return {"n_papers": sum(by_source.values()), "sources": by_source, "splits": by_split}
+
+
+def load_paper_data(folder: str, dataset_path: str, catalog: PaperCatalog | None = None) -> Dict:
+    """paper_data.json contents of $folder: from $catalog if it has the paper, else from the folder's json.
+
+    :param folder: folder name of the paper
+    :type folder: str
+    :param dataset_path: folder holding the paper's folder, i.e "dataset/papers/"
+    :type dataset_path: str
+    :param catalog: catalog to look the paper up in first, defaults to None
+    :type catalog: PaperCatalog | None, optional
+    :return: {"url", "doi", "title", "authors", "abstract", "date"}
+    :rtype: Dict
+    """
+    if catalog is not None:
+        paper_entry = catalog.get(folder)
+        if paper_entry is not None:
+            return asdict(paper_entry)
+    with open(f"{dataset_path}{folder}/paper_data.json", "r") as f:
+        return load(f)
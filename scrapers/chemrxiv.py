@@ -1,11 +1,14 @@
-import requests
 from typing import Tuple, List
+import requests
 
 
-from .generic import PaperEntry, GenericScraper, make_folder, asdict, dump
+from .generic import PaperEntry, GenericScraper, make_folder, asdict, dump, stream_download
 
 
 class ChemrxivScraper(GenericScraper):
+    INCREMENTAL_SORT = ("lastUpdatedDate", "PUBLISHED_DATE_DESC")
+    SOURCE = "chemrxiv"
+
     def scrape(
         self,
         query: str,
@@ -29,21 +32,32 @@ class ChemrxivScraper(GenericScraper):
         sort_by: str = "lastUpdatedDate",
         sort_order="PUBLISHED_DATE_DESC",
     ) -> str | dict:
-        url = f'https://chemrxiv.org/engage/chemrxiv/public-api/v1/items?term="{query_term}"&skip={start}&limit={max_results}&sort={sort_order}'
-        result = requests.get(url)
-        return result.json()
-
-    def handle_entries(self, entries: dict, dataset_path: str = "dataset/papers/") -> int:  # type: ignore[override]\
-        n_papers = 0
-        item_list = entries["itemHits"]
-        for _item in item_list:
-            item = _item["item"]
-            paper_entry = self.handle_entry(item)
-            folder_name = self.doi_to_folder_name(paper_entry.doi)
-            make_folder(dataset_path + folder_name)
-            self.save_paper_data(paper_entry, dataset_path + folder_name)
-            n_papers += 1
-        return n_papers
+        url = self.get_api_url(query_term, start, max_results, sort_by, sort_order)
+        return self.parse_response(self.get(url))
+
+    def get_api_url(
+        self,
+        query_term: str,
+        start: int = 0,
+        max_results: int = 100,
+        sort_by: str = "lastUpdatedDate",
+        sort_order="PUBLISHED_DATE_DESC",
+    ) -> str:
+        return self.route(
+            f'https://chemrxiv.org/engage/chemrxiv/public-api/v1/items?term="{query_term}"&skip={start}&limit={max_results}&sort={sort_order}'
+        )
+
+    def parse_response(self, response: requests.Response) -> dict:
+        # still throttled/failing after `get`'s retries: raise rather than look like an empty result
+        response.raise_for_status()
+        return response.json()
+
+    def get_entries(self, entries: dict) -> List[dict]:  # type: ignore[override]
+        return [item["item"] for item in entries["itemHits"]]
+
+    def get_sort_date(self, entry: dict, paper_entry: PaperEntry) -> str:  # type: ignore[override]
+        # results are sorted by publication (after moderation), which can be days after the saved submittedDate
+        return entry.get("publishedDate", paper_entry.date)
 
     def handle_entry(self, json_entry: dict) -> PaperEntry:  # type: ignore[override]
         values = []
@@ -85,8 +99,10 @@ class ChemrxivScraper(GenericScraper):
         with open(path + "/paper_data.json", "w+") as f:
             dump(paper_dict, f, ensure_ascii=False, indent=4)
 
+    def get_pdf_url(self, paper_id: str) -> str:
+        return self.route(
+            f"https://chemrxiv.org/engage/api-gateway/chemrxiv/assets/orp/resource/item/{paper_id}/original/paper.pdf"
+        )
+
     def download_pdf(self, paper_id: str, save_path: str) -> None:
-        pdf_url = f"https://chemrxiv.org/engage/api-gateway/chemrxiv/assets/orp/resource/item/{paper_id}/original/paper.pdf"
-        result = requests.get(pdf_url)
-        with open(save_path, "wb+") as f:
-            f.write(result.content)
+        stream_download(self.get_pdf_url(paper_id), save_path, get=self.get)
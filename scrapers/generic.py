@@ -1,11 +1,38 @@
-from typing import List, Tuple
+from typing import TYPE_CHECKING, Callable, Iterable, List, Tuple
 import xml.etree.ElementTree as ET
-from os import mkdir
+from os import mkdir, remove, replace
+from os.path import exists
+from time import perf_counter
+from urllib.parse import urlsplit, urlunsplit
 from dataclasses import dataclass, asdict
 from json import dump
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .rate_limit import RateLimiter, SHARED_LIMITER, parse_retry_after
+
+if TYPE_CHECKING:
+    from .catalog import PaperCatalog
 
 # TODO: add an open-access springer nature scraper?
 
+MAX_PDF_BYTES: int = 200 * 1024**2  # bigger than any paper + SI we want to run pdffigures2 on
+DOWNLOAD_CHUNK_BYTES: int = 256 * 1024
+DOWNLOAD_TIMEOUT_S: float = 60  # max wait for the connection/between chunks, not for the whole download
+PDF_MAGIC: bytes = b"%PDF-"
+
+POOL_SIZE: int = 10  # connections kept alive per host, should be >= the number of threads sharing a scraper
+TIMEOUT_S: Tuple[float, float] = (10, 60)  # (connect, read) timeout of API requests
+N_RETRIES: int = 3
+RETRY_BACKOFF_S: float = 1  # retries wait 1s, 2s, 4s...
+# server errors and "slow down" responses: retried by `GenericScraper.get` after reporting them to the rate
+# limiter, which backs off, so every attempt waits on (and counts against) the host's rate limit
+RETRY_STATUSES: Tuple[int, ...] = (500, 502, 504)
+THROTTLE_STATUSES: Tuple[int, ...] = (429, 503)
+SAVE_BATCH: int = 200  # papers added to the catalog per transaction, bounds the entries held while paging
+USER_AGENT: str = "micrograph_extractor (https://github.com/tldr-group/micrograph_extractor)"
+
 
 @dataclass
 class PaperEntry:
@@ -24,7 +51,191 @@ def make_folder(dir_name: str) -> None:
         pass
 
 
+def make_session(
+    pool_size: int = POOL_SIZE, n_retries: int = N_RETRIES, backoff_s: float = RETRY_BACKOFF_S
+) -> requests.Session:
+    """Session with a keep-alive connection pool per host (so repeat requests skip the TCP + TLS handshake),
+    gzip and retries with exponential backoff on connection errors. Bad statuses ($RETRY_STATUSES,
+    $THROTTLE_STATUSES) are returned as they are, for `GenericScraper.get` to retry through its rate limiter.
+
+    :param pool_size: max connections kept per host, defaults to POOL_SIZE
+    :type pool_size: int, optional
+    :param n_retries: max retries of a request, defaults to N_RETRIES
+    :type n_retries: int, optional
+    :param backoff_s: backoff factor between retries, defaults to RETRY_BACKOFF_S
+    :type backoff_s: float, optional
+    :return: the session
+    :rtype: requests.Session
+    """
+    retry = Retry(
+        total=n_retries,
+        backoff_factor=backoff_s,
+        status=0,  # no status retries: they would bypass the rate limiter and hide errors from it
+        allowed_methods=["GET", "HEAD"],
+        # otherwise urllib3 would also retry 429/503s with a Retry-After itself, hiding them from the rate limiter
+        respect_retry_after_header=False,
+        raise_on_status=False,  # return the last bad response rather than raising, callers check the status
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"})
+    return session
+
+
+class DownloadError(Exception):
+    pass
+
+
+def stream_download(
+    url: str,
+    save_path: str,
+    max_bytes: int = MAX_PDF_BYTES,
+    magic: bytes = PDF_MAGIC,
+    timeout_s: float = DOWNLOAD_TIMEOUT_S,
+    get: Callable[..., requests.Response] = requests.get,
+) -> int:
+    """Stream $url to $save_path in chunks rather than holding the whole file in memory. Data is written to
+    <save_path>.part and only renamed to $save_path once complete and valid, so a failed download never leaves a
+    partial file where pdffigures2 would read it.
+
+    :param url: url to download
+    :type url: str
+    :param save_path: path to save the file to
+    :type save_path: str
+    :param max_bytes: abort downloads bigger than this, defaults to MAX_PDF_BYTES
+    :type max_bytes: int, optional
+    :param magic: bytes the file must start with, defaults to PDF_MAGIC
+    :type magic: bytes, optional
+    :param timeout_s: connect/read timeout, defaults to DOWNLOAD_TIMEOUT_S
+    :type timeout_s: float, optional
+    :param get: function to make the request with, i.e a scraper's `get`, defaults to requests.get
+    :type get: Callable[..., requests.Response], optional
+    :raises DownloadError: on a non-200 response, network error, size over $max_bytes, download shorter than its
+        Content-Length or wrong magic bytes
+    :return: number of bytes downloaded
+    :rtype: int
+    """
+    part_path = f"{save_path}.part"
+    try:
+        with get(url, stream=True, timeout=timeout_s) as response:
+            if response.status_code != 200:
+                raise DownloadError(f"{url}: HTTP {response.status_code}")
+            # Content-Length is the encoded size, so only comparable to what we read if it wasn't compressed
+            content_length = response.headers.get("Content-Length", "")
+            encoding = response.headers.get("Content-Encoding", "identity")
+            expected_bytes = int(content_length) if content_length.isdigit() else None
+            if expected_bytes is not None and expected_bytes > max_bytes:
+                raise DownloadError(f"{url}: {expected_bytes} bytes is over the {max_bytes} byte limit")
+
+            n_bytes = 0
+            head = b""
+            with open(part_path, "wb") as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    if len(head) < len(magic):
+                        head += chunk[: len(magic) - len(head)]
+                        if not magic.startswith(head):
+                            raise DownloadError(f"{url}: not a pdf (starts with {head!r})")
+                    n_bytes += len(chunk)
+                    if n_bytes > max_bytes:
+                        raise DownloadError(f"{url}: over the {max_bytes} byte limit")
+                    f.write(chunk)
+            if len(head) < len(magic):
+                raise DownloadError(f"{url}: not a pdf (starts with {head!r})")
+            if encoding == "identity" and expected_bytes is not None and n_bytes != expected_bytes:
+                raise DownloadError(f"{url}: truncated, got {n_bytes} of {expected_bytes} bytes")
+    except requests.RequestException as err:
+        _remove_part(part_path)
+        raise DownloadError(f"{url}: {err}") from err
+    except BaseException:
+        _remove_part(part_path)
+        raise
+    replace(part_path, save_path)
+    return n_bytes
+
+
+def _remove_part(part_path: str) -> None:
+    if exists(part_path):
+        remove(part_path)
+
+
 class GenericScraper:
+    # (sort_by, sort_order) for `scrape_since`: must return the newest entries first
+    INCREMENTAL_SORT: Tuple[str, str] = ("lastUpdatedDate", "descending")
+    # whether `get_page` leaves the body on the socket for `parse_response` to stream
+    STREAM_PAGES: bool = False
+    # results requested per page when paging through a query
+    PAGE_SIZE: int = 100
+    # name of the archive in the catalog
+    SOURCE: str = "generic"
+
+    def __init__(
+        self,
+        limiter: RateLimiter | None = None,
+        pool_size: int = POOL_SIZE,
+        timeout_s: Tuple[float, float] = TIMEOUT_S,
+        catalog: "PaperCatalog | None" = None,
+        server_url: str | None = None,
+    ) -> None:
+        """Base scraper. Every request to the archive (API pages and pdfs) goes through `get`, which waits on
+        $limiter and reuses connections from a pooled session. Saved papers are added to $catalog (in bulk,
+        a page at a time) as well as written to their folder's paper_data.json.
+
+        :param limiter: per-host rate limiter, defaults to SHARED_LIMITER (shared by all scrapers)
+        :type limiter: RateLimiter | None, optional
+        :param pool_size: connections kept alive per host, defaults to POOL_SIZE
+        :type pool_size: int, optional
+        :param timeout_s: default (connect, read) timeout, defaults to TIMEOUT_S
+        :type timeout_s: Tuple[float, float], optional
+        :param catalog: paper catalog to add saved papers to, defaults to None
+        :type catalog: PaperCatalog | None, optional
+        :param server_url: 'scheme://host:port' to send API and pdf requests to instead of the archive's, i.e a
+            local `scrapers.mock_server.MockPreprintServer`, defaults to None
+        :type server_url: str | None, optional
+        """
+        self.limiter = limiter if limiter is not None else SHARED_LIMITER
+        self.session = make_session(pool_size)
+        self.timeout_s = timeout_s
+        self.catalog = catalog
+        self.server_url = server_url
+
+    def route(self, url: str) -> str:
+        """$url, moved to $server_url if set (path and query kept)."""
+        if self.server_url is None:
+            return url
+        scheme, netloc, _, _, _ = urlsplit(self.server_url)
+        return urlunsplit((scheme, netloc, *urlsplit(url)[2:]))
+
+    def send(self, url: str, **kwargs) -> requests.Response:
+        """GET with the scraper's session without waiting on the rate limiter, but reporting the response's status,
+        latency and Retry-After to it. Keyword arguments are passed to `Session.get`."""
+        kwargs.setdefault("timeout", self.timeout_s)
+        start = perf_counter()
+        response = self.session.get(url, **kwargs)
+        retry_after_s = parse_retry_after(response.headers.get("Retry-After"))
+        self.limiter.record(url, response.status_code, perf_counter() - start, retry_after_s)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Rate limited GET with the scraper's session. $RETRY_STATUSES and $THROTTLE_STATUSES responses are
+        retried (up to N_RETRIES times) once the limiter allows, which will have backed off/waited for
+        Retry-After. Keyword arguments are passed to `Session.get`."""
+        for attempt in range(N_RETRIES + 1):
+            self.limiter.acquire(url)
+            response = self.send(url, **kwargs)
+            if response.status_code not in RETRY_STATUSES + THROTTLE_STATUSES or attempt == N_RETRIES:
+                return response
+            response.close()
+        return response
+
+    def get_page(self, url: str) -> requests.Response:
+        """`get` a page of API results, streamed if $STREAM_PAGES."""
+        return self.get(url, stream=self.STREAM_PAGES)
+
+    def close(self) -> None:
+        self.session.close()
+
     def scrape(
         self,
         query: str,
@@ -45,6 +256,22 @@ class GenericScraper:
     ) -> str | dict:
         return "null"
 
+    def get_api_url(
+        self,
+        query_term: str,
+        start: int = 0,
+        max_results: int = 100,
+        sort_by: str = "lastUpdatedDate",
+        sort_order="descending",
+    ) -> str:
+        return "null"
+
+    def parse_response(self, response: requests.Response) -> str | dict:
+        return "null"
+
+    def get_pdf_url(self, paper_id: str) -> str:
+        return "null"
+
     def get_authors(self, author_list) -> List[str]:
         return []
 
@@ -58,8 +285,95 @@ class GenericScraper:
             "null",
         )
 
-    def handle_entries(self, entries: str | dict) -> int:
-        return 0
+    def get_entries(self, entries: str | dict) -> Iterable[dict | ET.Element]:
+        """Split a parsed API response into the entries of each paper (possibly lazily)."""
+        return []
+
+    def doi_to_folder_name(self, doi: str) -> str:
+        return doi
+
+    def save_paper_data(self, paper_entry: PaperEntry, path: str) -> None:
+        return
+
+    def get_sort_date(self, entry: dict | ET.Element, paper_entry: PaperEntry) -> str:
+        """Date $INCREMENTAL_SORT orders entries by, used as the watermark of `scrape_since`."""
+        return paper_entry.date
+
+    def save_entry(self, paper_entry: PaperEntry, dataset_path: str = "dataset/papers/") -> str:
+        """Save paper_data.json of $paper_entry in its own folder of $dataset_path and return the folder name."""
+        folder_name = self.doi_to_folder_name(paper_entry.doi)
+        make_folder(dataset_path + folder_name)
+        self.save_paper_data(paper_entry, dataset_path + folder_name)
+        return folder_name
+
+    def save_entries(self, paper_entries: List[PaperEntry], dataset_path: str = "dataset/papers/") -> List[str]:
+        """`save_entry` each of $paper_entries, then add them all to the catalog (if any) in one transaction."""
+        folders = [self.save_entry(paper_entry, dataset_path) for paper_entry in paper_entries]
+        if self.catalog is not None and len(folders) > 0:
+            self.catalog.add_entries(folders, paper_entries, self.SOURCE)
+        return folders
+
+    def handle_entries(self, entries: str | dict, dataset_path: str = "dataset/papers/") -> int:
+        n_papers = 0
+        batch: List[PaperEntry] = []
+        for entry in self.get_entries(entries):
+            batch.append(self.handle_entry(entry))
+            if len(batch) == SAVE_BATCH:
+                n_papers += len(self.save_entries(batch, dataset_path))
+                batch = []
+        return n_papers + len(self.save_entries(batch, dataset_path))
+
+    def scrape_since(
+        self,
+        query: str,
+        since: str | None = None,
+        page_size: int = 100,
+        max_papers: int = 14000,
+        dataset_path: str = "dataset/papers/",
+    ) -> Tuple[List[str], str | None]:
+        """Incremental scrape: page through $query newest first, saving papers until reaching one older than
+        $since (the newest date seen by the previous scrape). Papers dated exactly $since are saved again, so
+        ones sharing the timestamp of the last scrape aren't missed. Dates are compared as ISO 8601 strings.
+
+        :param query: search query
+        :type query: str
+        :param since: watermark of the previous scrape, if None scrape up to $max_papers
+        :type since: str | None, optional
+        :param page_size: results per request, defaults to 100
+        :type page_size: int, optional
+        :param max_papers: max results to page through, defaults to 14000
+        :type max_papers: int, optional
+        :param dataset_path: folder to save the papers' folders to, defaults to "dataset/papers/"
+        :type dataset_path: str, optional
+        :return: folder names of the papers saved and the new watermark (newest date seen)
+        :rtype: Tuple[List[str], str | None]
+        """
+        sort_by, sort_order = self.INCREMENTAL_SORT
+        newest = since
+        saved: List[str] = []
+        for start in range(0, max_papers, page_size):
+            url = self.get_api_url(query, start, page_size, sort_by, sort_order)
+            entries = self.get_entries(self.parse_response(self.get_page(url)))
+            reached_known = False
+            n_entries = 0
+            new_entries: List[PaperEntry] = []
+            for entry in entries:
+                n_entries += 1
+                paper_entry = self.handle_entry(entry)
+                date = self.get_sort_date(entry, paper_entry)
+                if since is not None and date < since:
+                    reached_known = True
+                    break
+                new_entries.append(paper_entry)
+                if newest is None or date > newest:
+                    newest = date
+                if len(new_entries) == SAVE_BATCH:
+                    saved += self.save_entries(new_entries, dataset_path)
+                    new_entries = []
+            saved += self.save_entries(new_entries, dataset_path)
+            if reached_known or n_entries < page_size:
+                break
+        return saved, newest
 
     def download_pdf(self, paper_id: str, save_path: str) -> None:
         return
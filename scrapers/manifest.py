@@ -0,0 +1,177 @@
+import sqlite3
+import hashlib
+from os.path import getsize
+from threading import Lock
+from time import time
+from typing import Dict, List
+
+# ==================================== CRAWL MANIFEST ====================================
+
+# One row per paper (keyed by its folder name in the dataset) tracking how far it got, so a restarted crawl
+# skips finished papers and retries failed ones a limited number of times. Progress is then a query, i.e
+# `sqlite3 crawl_manifest.db "SELECT state, COUNT(*) FROM papers GROUP BY state"`.
+MANIFEST_PATH: str = "crawl_manifest.db"
+MAX_ATTEMPTS: int = 3
+
+# states, in order
+METADATA = "metadata"  # paper_data.json saved
+DOWNLOADED = "downloaded"  # pdf downloaded, not (yet) extracted
+EXTRACTED = "extracted"  # figures + captions saved, done
+FAILED = "failed"  # last attempt failed, see error/failed_stage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    paper_path TEXT PRIMARY KEY,
+    url TEXT,
+    state TEXT NOT NULL,
+    failed_stage TEXT,
+    error TEXT,
+    n_attempts INTEGER NOT NULL DEFAULT 0,
+    pdf_hash TEXT,
+    pdf_bytes INTEGER,
+    n_figures INTEGER,
+    n_subfigures INTEGER,
+    download_s REAL,
+    extract_s REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS papers_state ON papers (state);
+CREATE TABLE IF NOT EXISTS watermarks (
+    key TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class CrawlManifest:
+    def __init__(self, db_path: str = MANIFEST_PATH) -> None:
+        """SQLite manifest of the crawl state of each paper. Safe to share between threads.
+
+        :param db_path: path of the database file, defaults to MANIFEST_PATH
+        :type db_path: str, optional
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # readers (i.e a progress query) don't block the crawl
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = Lock()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _execute(self, sql: str, params: tuple = ()) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(sql, params)
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # ============ UPDATES ============
+    def add_papers(self, paper_paths: List[str], urls: List[str] | None = None) -> None:
+        """Add papers whose metadata has been fetched, leaving ones already in the manifest alone."""
+        urls_or_none = urls if urls is not None else [None for _ in paper_paths]
+        now = time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO papers (paper_path, url, state, updated_at) VALUES (?, ?, ?, ?)",
+                [(path, url, METADATA, now) for path, url in zip(paper_paths, urls_or_none)],
+            )
+
+    def mark_downloaded(self, paper_path: str, pdf_path: str, download_s: float) -> None:
+        """Record the download of $paper_path's pdf (saved at $pdf_path) and its sha256."""
+        hasher = hashlib.sha256()
+        with open(pdf_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        pdf_hash, pdf_bytes = hasher.hexdigest(), getsize(pdf_path)
+        self._execute(
+            """UPDATE papers SET state = ?, pdf_hash = ?, pdf_bytes = ?, download_s = ?,
+            n_attempts = n_attempts + 1, updated_at = ? WHERE paper_path = ?""",
+            (DOWNLOADED, pdf_hash, pdf_bytes, download_s, time(), paper_path),
+        )
+
+    def mark_extracted(self, paper_path: str, img_paths: List[str], extract_s: float) -> None:
+        """Record the extraction of $paper_path given the subfigure paths ('.../<name>_fig_<n>_<i>.jpg') saved."""
+        n_figures = len(set(img_path.rsplit("_", 1)[0] for img_path in img_paths))
+        n_subfigures = len(img_paths)
+        self._execute(
+            """UPDATE papers SET state = ?, n_figures = ?, n_subfigures = ?, extract_s = ?,
+            failed_stage = NULL, error = NULL, updated_at = ? WHERE paper_path = ?""",
+            (EXTRACTED, n_figures, n_subfigures, extract_s, time(), paper_path),
+        )
+
+    def mark_failed(self, paper_path: str, stage: str, error: str | Exception) -> None:
+        """Record a failure at $stage ("download" or "extract"). Download failures count as an attempt here as
+        `mark_downloaded` was never reached."""
+        increment = 1 if stage == "download" else 0
+        self._execute(
+            """UPDATE papers SET state = ?, failed_stage = ?, error = ?, n_attempts = n_attempts + ?,
+            updated_at = ? WHERE paper_path = ?""",
+            (FAILED, stage, str(error)[:1000], increment, time(), paper_path),
+        )
+
+    def set_watermark(self, key: str, date: str) -> None:
+        """Record $date as the newest date harvested for $key (i.e '<scraper>:<query>'). Never moves back."""
+        self._execute(
+            """INSERT INTO watermarks (key, date, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET date = MAX(date, excluded.date), updated_at = excluded.updated_at""",
+            (key, date, time()),
+        )
+
+    # ============ QUERIES ============
+    def get_watermark(self, key: str) -> str | None:
+        rows = self._query("SELECT date FROM watermarks WHERE key = ?", (key,))
+        return rows[0][0] if len(rows) > 0 else None
+
+    def pending(self, paper_paths: List[str] | None = None, max_attempts: int = MAX_ATTEMPTS) -> List[str]:
+        """Papers not extracted yet and with attempts left, in the order of $paper_paths (or insertion order).
+
+        :param paper_paths: papers to filter, defaults to None (every paper in the manifest)
+        :type paper_paths: List[str] | None, optional
+        :param max_attempts: papers that failed this many times are skipped, defaults to MAX_ATTEMPTS
+        :type max_attempts: int, optional
+        :return: paper paths left to do
+        :rtype: List[str]
+        """
+        rows = self._query(
+            "SELECT paper_path FROM papers WHERE state != ? AND n_attempts < ? ORDER BY rowid",
+            (EXTRACTED, max_attempts),
+        )
+        todo = [row[0] for row in rows]
+        if paper_paths is None:
+            return todo
+        todo_set = set(todo)
+        return [path for path in paper_paths if path in todo_set]
+
+    def get(self, paper_path: str) -> Dict | None:
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM papers WHERE paper_path = ?", (paper_path,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([col[0] for col in cursor.description], row))
+
+    def stats(self) -> Dict:
+        counts = dict(self._query("SELECT state, COUNT(*) FROM papers GROUP BY state"))
+        n_done = counts.get(EXTRACTED, 0)
+        n_failed = counts.get(FAILED, 0)
+        failures = self._query(
+            "SELECT failed_stage, COUNT(*) FROM papers WHERE state = ? GROUP BY failed_stage", (FAILED,)
+        )
+        (n_figures, n_subfigures, download_s, extract_s) = self._query(
+            "SELECT SUM(n_figures), SUM(n_subfigures), AVG(download_s), AVG(extract_s) FROM papers WHERE state = ?",
+            (EXTRACTED,),
+        )[0]
+        return {
+            "n_papers": sum(counts.values()),
+            "states": counts,
+            "failure_rate": n_failed / max(n_done + n_failed, 1),
+            "failures_by_stage": dict(failures),
+            "n_figures": n_figures or 0,
+            "n_subfigures": n_subfigures or 0,
+            "mean_download_s": download_s or 0,
+            "mean_extract_s": extract_s or 0,
+        }
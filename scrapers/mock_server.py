@@ -0,0 +1,160 @@
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from random import Random
+from threading import Thread, Lock
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+from typing import Dict, List
+
+from .rate_limit import TokenBucket
+
+# ==================================== MOCK PREPRINT SERVER ====================================
+
+# Local stand-in for the archives, so the scrapers can be tested and benchmarked offline. Point a scraper at it
+# with `ArxivScraper(server_url=server.url)` (or `ChemrxivScraper`). It serves:
+#   /api/query                                            arXiv API Atom pages (start, max_results)
+#   /pdf/<id>.pdf                                         arXiv pdfs
+#   /engage/chemrxiv/public-api/v1/items                  ChemRxiv API json pages (skip, limit)
+#   /engage/api-gateway/chemrxiv/assets/.../<id>/...pdf   ChemRxiv pdfs
+# with the same $n_papers in both archives (newest first) and the same pdf for every paper.
+PDF_PATH: str = "test_data/tmp.pdf"
+RETRY_AFTER_S: int = 1  # Retry-After sent with 429s
+
+
+def make_papers(n_papers: int) -> List[Dict]:
+    """Fake metadata, newest first, with microscopy-ish titles/abstracts."""
+    papers = []
+    for i in range(n_papers):
+        day = n_papers - i  # seconds since the first paper, so dates strictly decrease
+        date = f"2024-01-{1 + day // 86400:02d}T{day // 3600 % 24:02d}:{day // 60 % 60:02d}:{day % 60:02d}Z"
+        papers.append(
+            {
+                "id": f"2401.{i:05d}v1",
+                "title": f"SEM micrographs of sample {i}",
+                "abstract": f"We image sample {i} with scanning electron microscopy. " * 10,
+                "authors": [("A.", "Author"), ("B.", "Writer")],
+                "date": date,
+            }
+        )
+    return papers
+
+
+def atom_feed(papers: List[Dict]) -> bytes:
+    entries = "".join(
+        f"""<entry><id>http://arxiv.org/abs/{p["id"]}</id><published>{p["date"]}</published>
+<title>{escape(p["title"])}</title><summary>{escape(p["abstract"])}</summary>
+{"".join(f"<author><name>{first} {last}</name></author>" for first, last in p["authors"])}</entry>"""
+        for p in papers
+    )
+    return f'<feed xmlns="http://www.w3.org/2005/Atom">{entries}</feed>'.encode()
+
+
+def chemrxiv_items(papers: List[Dict]) -> bytes:
+    items = [
+        {
+            "item": {
+                "id": p["id"],
+                "doi": f"10.26434/chemrxiv-{p['id']}",
+                "title": p["title"],
+                "authors": [{"firstName": first, "lastName": last} for first, last in p["authors"]],
+                "abstract": p["abstract"],
+                "submittedDate": p["date"],
+                "publishedDate": p["date"],
+            }
+        }
+        for p in papers
+    ]
+    return json.dumps({"totalCount": len(items), "itemHits": items}).encode()
+
+
+class MockPreprintServer:
+    def __init__(
+        self,
+        n_papers: int = 1000,
+        latency_s: float = 0,
+        error_rate: float = 0,
+        rate_limit_per_s: float | None = None,
+        pdf_path: str = PDF_PATH,
+        seed: int = 0,
+    ) -> None:
+        """Local HTTP server emulating the arXiv and ChemRxiv APIs and pdf urls, with injectable faults.
+
+        :param n_papers: papers in each archive, defaults to 1000
+        :type n_papers: int, optional
+        :param latency_s: added before every response, defaults to 0
+        :type latency_s: float, optional
+        :param error_rate: fraction of requests answered with a 500, defaults to 0
+        :type error_rate: float, optional
+        :param rate_limit_per_s: requests/s above which requests get a 429 with a Retry-After, defaults to None
+            (no limit)
+        :type rate_limit_per_s: float | None, optional
+        :param pdf_path: pdf served for every paper, defaults to PDF_PATH
+        :type pdf_path: str, optional
+        :param seed: seed of the error injection, defaults to 0
+        :type seed: int, optional
+        """
+        self.papers = make_papers(n_papers)
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.bucket = TokenBucket(rate_limit_per_s, 1) if rate_limit_per_s is not None else None
+        with open(pdf_path, "rb") as f:
+            self.pdf = f.read()
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.counts: Dict[str, int] = {"n_requests": 0, "n_errors": 0, "n_throttled": 0}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, headers, body = server.respond(self.path)
+                self.send_response(status)
+                for key, value in {"Content-Length": str(len(body)), **headers}.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def shutdown(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] += 1
+
+    def respond(self, path: str) -> tuple:
+        """(status, headers, body) of a GET of $path."""
+        self._count("n_requests")
+        if self.latency_s > 0:
+            sleep(self.latency_s)
+        if self.bucket is not None and not self.bucket.try_acquire():
+            self._count("n_throttled")
+            return 429, {"Retry-After": str(RETRY_AFTER_S)}, b"rate limit exceeded"
+        with self.lock:
+            fail = self.random.random() < self.error_rate
+        if fail:
+            self._count("n_errors")
+            return 500, {}, b"internal server error"
+
+        parts = urlsplit(path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        if parts.path == "/api/query":
+            start, n = int(query.get("start", 0)), int(query.get("max_results", 10))
+            return 200, {"Content-Type": "application/atom+xml"}, atom_feed(self.papers[start : start + n])
+        elif parts.path == "/engage/chemrxiv/public-api/v1/items":
+            start, n = int(query.get("skip", 0)), int(query.get("limit", 10))
+            return 200, {"Content-Type": "application/json"}, chemrxiv_items(self.papers[start : start + n])
+        elif parts.path.endswith(".pdf"):
+            return 200, {"Content-Type": "application/pdf"}, self.pdf
+        return 404, {}, b"not found"
@@ -0,0 +1,279 @@
+import asyncio
+from threading import Lock
+from time import monotonic, sleep, time
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Tuple
+
+# arXiv asks for no more than 1 request every 3 seconds, which we use for every host unless told otherwise
+DEFAULT_RATE_PER_S: float = 1 / 3
+DEFAULT_BURST: int = 1
+
+# AIMD (additive increase, multiplicative decrease) control of the rate of `AdaptiveRateLimiter`
+MIN_RATE_PER_S: float = 1 / 60
+MAX_RATE_PER_S: float = 2
+RATE_INCREASE_PER_S: float = 0.02  # added to the rate after each healthy response
+RATE_DECREASE: float = 0.5  # rate multiplied by this after a 429/5xx or slow response
+SLOW_RESPONSE_S: float = 10  # time to the response headers above which the server is treated as overloaded
+# hosts with a documented limit never go above it, only back off from it
+HOST_MAX_RATES: Dict[str, float] = {"export.arxiv.org": 1 / 3}
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate_per_s: float = DEFAULT_RATE_PER_S,
+        burst: int = DEFAULT_BURST,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        """Token bucket: refills at $rate_per_s tokens/s up to $burst tokens and each request takes one. Callers
+        reserve their token under a lock and then sleep until it's due, so waiting threads/coroutines are served
+        in the order they asked and never spin.
+
+        :param rate_per_s: sustained requests per second, defaults to DEFAULT_RATE_PER_S
+        :type rate_per_s: float, optional
+        :param burst: max requests that can be made back to back after being idle, defaults to DEFAULT_BURST
+        :type burst: int, optional
+        :param clock: seconds since any fixed point, i.e a fake clock in tests, defaults to time.monotonic
+        :type clock: Callable[[], float], optional
+        """
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.clock = clock
+        self.tokens: float = burst
+        self.last_refill = clock()
+        self.lock = Lock()
+        self.waited_s: float = 0  # total time callers were made to wait
+        self.paused_until: float = 0  # no tokens are handed out before this ($clock) time, see `pause`
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_per_s)
+        self.last_refill = now
+
+    def reserve(self, n: int = 1) -> float:
+        """Take $n tokens, going into debt if there aren't enough.
+
+        :return: seconds to wait before the request can be made
+        :rtype: float
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= n
+            wait_s = max(0.0, -self.tokens / self.rate_per_s, self.paused_until - now)
+            self.waited_s += wait_s
+            return wait_s
+
+    def try_acquire(self, n: int = 1) -> bool:
+        """Take $n tokens only if they are available now."""
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            if self.tokens < n or now < self.paused_until:
+                return False
+            self.tokens -= n
+            return True
+
+    def pause(self, wait_s: float) -> None:
+        """Hand out no tokens for the next $wait_s seconds, i.e when told to by a Retry-After header. Requests
+        already waiting on a reservation aren't delayed."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + wait_s)
+            self.tokens = min(self.tokens, 0)  # no burst straight after the pause
+
+    def record(self, status: int, latency_s: float, retry_after_s: float | None = None) -> None:
+        """Feedback from a response: a fixed rate bucket only honours Retry-After."""
+        if retry_after_s is not None:
+            self.pause(retry_after_s)
+
+    def acquire(self, n: int = 1) -> None:
+        """Block (sleeping) until $n tokens are available."""
+        wait_s = self.reserve(n)
+        if wait_s > 0:
+            sleep(wait_s)
+
+    async def acquire_async(self, n: int = 1) -> None:
+        """Like `acquire`, but yields to the event loop while waiting."""
+        wait_s = self.reserve(n)
+        if wait_s > 0:
+            await asyncio.sleep(wait_s)
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        rate_per_s: float = DEFAULT_RATE_PER_S,
+        burst: int = DEFAULT_BURST,
+        host_limits: Dict[str, Tuple[float, int]] | None = None,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        """One `TokenBucket` per host, created on first use, so scraping metadata from one archive doesn't slow
+        down pdf downloads from another.
+
+        :param rate_per_s: requests per second for hosts not in $host_limits, defaults to DEFAULT_RATE_PER_S
+        :type rate_per_s: float, optional
+        :param burst: burst for hosts not in $host_limits, defaults to DEFAULT_BURST
+        :type burst: int, optional
+        :param host_limits: {host: (rate_per_s, burst)} overrides, i.e {"export.arxiv.org": (1 / 3, 1)}
+        :type host_limits: Dict[str, Tuple[float, int]] | None, optional
+        :param clock: clock of the buckets, defaults to time.monotonic
+        :type clock: Callable[[], float], optional
+        """
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.host_limits = host_limits if host_limits is not None else {}
+        self.clock = clock
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = Lock()
+
+    def make_bucket(self, host: str) -> TokenBucket:
+        rate_per_s, burst = self.host_limits.get(host, (self.rate_per_s, self.burst))
+        return TokenBucket(rate_per_s, burst, self.clock)
+
+    def bucket(self, url: str) -> TokenBucket:
+        """Bucket for the host of $url (or $url itself if it's just a host)."""
+        host = urlparse(url).netloc or url
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = self.make_bucket(host)
+            return self.buckets[host]
+
+    def acquire(self, url: str) -> None:
+        self.bucket(url).acquire()
+
+    async def acquire_async(self, url: str) -> None:
+        await self.bucket(url).acquire_async()
+
+    def record(self, url: str, status: int, latency_s: float, retry_after_s: float | None = None) -> None:
+        """Report the outcome of a request to $url (status, seconds to the response, Retry-After if sent)."""
+        self.bucket(url).record(status, latency_s, retry_after_s)
+
+    def stats(self) -> Dict[str, Dict]:
+        """{host: current rate and counters} of every host requested so far."""
+        with self.lock:
+            buckets = dict(self.buckets)
+        return {host: bucket_stats(bucket) for host, bucket in buckets.items()}
+
+
+def bucket_stats(bucket: TokenBucket) -> Dict:
+    stats = {"rate_per_s": bucket.rate_per_s, "waited_s": bucket.waited_s}
+    if isinstance(bucket, AdaptiveBucket):
+        stats.update(bucket.counts)
+    return stats
+
+
+class AdaptiveBucket(TokenBucket):
+    def __init__(
+        self,
+        rate_per_s: float = DEFAULT_RATE_PER_S,
+        burst: int = DEFAULT_BURST,
+        min_rate_per_s: float = MIN_RATE_PER_S,
+        max_rate_per_s: float = MAX_RATE_PER_S,
+        increase_per_s: float = RATE_INCREASE_PER_S,
+        decrease: float = RATE_DECREASE,
+        slow_s: float = SLOW_RESPONSE_S,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        """Token bucket whose rate follows the server (AIMD, like TCP congestion control): each healthy response
+        adds $increase_per_s to the rate, up to $max_rate_per_s, and each 429/5xx or response slower than
+        $slow_s multiplies it by $decrease, down to $min_rate_per_s. A Retry-After header also pauses the
+        bucket for that long. The rate settles just under the fastest the server sustains.
+
+        :param rate_per_s: starting rate, defaults to DEFAULT_RATE_PER_S
+        :type rate_per_s: float, optional
+        :param burst: max requests back to back after being idle, defaults to DEFAULT_BURST
+        :type burst: int, optional
+        :param min_rate_per_s: lowest rate to back off to, defaults to MIN_RATE_PER_S
+        :type min_rate_per_s: float, optional
+        :param max_rate_per_s: highest rate to increase to, defaults to MAX_RATE_PER_S
+        :type max_rate_per_s: float, optional
+        :param increase_per_s: additive increase per healthy response, defaults to RATE_INCREASE_PER_S
+        :type increase_per_s: float, optional
+        :param decrease: multiplicative decrease on an unhealthy response, defaults to RATE_DECREASE
+        :type decrease: float, optional
+        :param slow_s: responses slower than this count as unhealthy, defaults to SLOW_RESPONSE_S
+        :type slow_s: float, optional
+        :param clock: seconds since any fixed point, defaults to time.monotonic
+        :type clock: Callable[[], float], optional
+        """
+        super().__init__(min(rate_per_s, max_rate_per_s), burst, clock)
+        self.min_rate_per_s = min_rate_per_s
+        self.max_rate_per_s = max_rate_per_s
+        self.increase_per_s = increase_per_s
+        self.decrease = decrease
+        self.slow_s = slow_s
+        self.counts: Dict[str, int] = {"n_ok": 0, "n_throttled": 0, "n_server_errors": 0, "n_slow": 0}
+
+    def _set_rate(self, rate_per_s: float) -> None:
+        # tokens accrued so far count at the old rate
+        self._refill(self.clock())
+        self.rate_per_s = min(self.max_rate_per_s, max(self.min_rate_per_s, rate_per_s))
+
+    def record(self, status: int, latency_s: float, retry_after_s: float | None = None) -> None:
+        with self.lock:
+            if status == 429:
+                self.counts["n_throttled"] += 1
+            elif status >= 500:
+                self.counts["n_server_errors"] += 1
+            elif latency_s > self.slow_s:
+                self.counts["n_slow"] += 1
+            else:
+                self.counts["n_ok"] += 1
+                self._set_rate(self.rate_per_s + self.increase_per_s)
+                return
+            self._set_rate(self.rate_per_s * self.decrease)
+        if retry_after_s is not None:
+            self.pause(retry_after_s)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    def __init__(
+        self,
+        rate_per_s: float = DEFAULT_RATE_PER_S,
+        burst: int = DEFAULT_BURST,
+        host_limits: Dict[str, Tuple[float, int]] | None = None,
+        max_rate_per_s: float = MAX_RATE_PER_S,
+        host_max_rates: Dict[str, float] | None = None,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        """`RateLimiter` with an `AdaptiveBucket` per host, so each host runs at the fastest rate it sustains.
+        Report each response with `record` (the scrapers' `get` does).
+
+        :param rate_per_s: starting rate for hosts not in $host_limits, defaults to DEFAULT_RATE_PER_S
+        :type rate_per_s: float, optional
+        :param burst: burst for hosts not in $host_limits, defaults to DEFAULT_BURST
+        :type burst: int, optional
+        :param host_limits: {host: (starting rate_per_s, burst)} overrides, defaults to None
+        :type host_limits: Dict[str, Tuple[float, int]] | None, optional
+        :param max_rate_per_s: highest rate for hosts not in $host_max_rates, defaults to MAX_RATE_PER_S
+        :type max_rate_per_s: float, optional
+        :param host_max_rates: {host: highest rate}, defaults to HOST_MAX_RATES
+        :type host_max_rates: Dict[str, float] | None, optional
+        :param clock: clock of the buckets, defaults to time.monotonic
+        :type clock: Callable[[], float], optional
+        """
+        super().__init__(rate_per_s, burst, host_limits, clock)
+        self.max_rate_per_s = max_rate_per_s
+        self.host_max_rates = host_max_rates if host_max_rates is not None else HOST_MAX_RATES
+
+    def make_bucket(self, host: str) -> TokenBucket:
+        rate_per_s, burst = self.host_limits.get(host, (self.rate_per_s, self.burst))
+        max_rate_per_s = self.host_max_rates.get(host, self.max_rate_per_s)
+        return AdaptiveBucket(rate_per_s, burst, max_rate_per_s=max_rate_per_s, clock=self.clock)
+
+
+# shared by every scraper in the process by default, so separate scraper objects still respect the host limits
+SHARED_LIMITER = AdaptiveRateLimiter()
@@ -1,5 +1,16 @@
-from os import getcwd, makedirs
-from os.path import join
+from os import getcwd, getenv, makedirs, listdir
+from os.path import join, exists, basename
+from json import load
+from io import BytesIO
+from base64 import b64decode
+from tempfile import TemporaryDirectory
+from shutil import rmtree
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import numpy as np
+from PIL import Image
+from skimage.measure import label
+import extract
 from extract import single_pdf_extract_process, CWD
 from analyze import single_regex_label
 import sys
@@ -12,7 +23,7 @@ try:
     from llm_operations.run_llm_with_abstract import assistant
     from llm_operations.gpt_utils import extract_json_from_response
 
-    llm_available = True
+    llm_available = getenv("OPENAI_API_KEY") is not None
 except:
     pass
 from labelling_app.app import load_json, save_json
@@ -56,6 +67,95 @@ suggested a graded distribution of the binder relative to the carbon additive. T
 commonly available in major research facilities and so we hope that this method will be rapidly adopted to improve the imaging of
 electrode materials and porous media in general."""
 
+# stand-in for the sbt shell driven by `ExtractionWorker`: a command prints a line then sbt's 'Total time:' marker,
+# [error] for pdfs named 'bad', and the first pdf named 'hang' hangs (argv[1] is a file marking it as done)
+STUB_SBT = """
+import os, sys, time
+for line in sys.stdin:
+    if line.strip() == "exit":
+        break
+    if "hang" in line and not os.path.exists(sys.argv[1]):
+        open(sys.argv[1], "w").close()
+        time.sleep(60)
+    time.sleep(0.01)
+    print("[info] running " + line.strip(), flush=True)
+    failed = "bad" in line or (line.strip() == "compile" and "broken" in sys.argv[2:])
+    print("[error] Total time: 0 s" if failed else "[success] Total time: 0 s", flush=True)
+"""
+
+
+def make_composite_figure(
+    micrograph_fnames: list, n_cols: int = 2, size: int = 300, gutter: int = 20
+) -> Image.Image:
+    """Tile micrographs onto a white canvas like a multi-panel figure."""
+    n_rows = (len(micrograph_fnames) + n_cols - 1) // n_cols
+    step = size + gutter
+    canvas = Image.new("RGB", (n_cols * step + gutter, n_rows * step + gutter), "white")
+    for i, fname in enumerate(micrograph_fnames):
+        micrograph = Image.open(join(CWD, "micrographs", fname)).convert("RGB").resize((size, size))
+        canvas.paste(micrograph, (gutter + (i % n_cols) * step, gutter + (i // n_cols) * step))
+    return canvas
+
+
+def serve_routes(routes: dict) -> ThreadingHTTPServer:
+    """Serve {path: (status, headers, body)} from a local keep-alive http server in a background thread. A
+    route can also be a list of responses, returned in order (the last one repeats). A 'Content-Length'
+    header is added if missing. The (path, client port) of each request is appended to .requests. Call
+    .shutdown() when done."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            server.requests.append((self.path, self.client_address[1]))  # type: ignore[attr-defined]
+            route = routes.get(self.path, (404, {}, b"not found"))
+            if isinstance(route, list):
+                route = route.pop(0) if len(route) > 1 else route[0]
+            status, headers, body = route
+            self.send_response(status)
+            headers = {"Content-Length": str(len(body)), **headers}
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"  # type: ignore[attr-defined]
+    server.requests = []  # type: ignore[attr-defined]
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_atom_feed(arxiv_ids: list, dates: list | None = None) -> bytes:
+    """arXiv API style Atom feed with an entry for each id (published on each date)."""
+    if dates is None:
+        dates = ["2024-01-01T00:00:00Z" for _ in arxiv_ids]
+    entries = "".join(
+        f"""<entry><id>http://arxiv.org/abs/{arxiv_id}</id><published>{date}</published>
+        <title>Paper {arxiv_id}</title><summary>SEM micrographs of {arxiv_id}</summary>
+        <author><name>A. Author</name></author></entry>"""
+        for arxiv_id, date in zip(arxiv_ids, dates)
+    )
+    return f'<feed xmlns="http://www.w3.org/2005/Atom">{entries}</feed>'.encode()
+
+
+def make_labelling_dataset(dataset_path: str, n_papers: int = 4) -> None:
+    """Paper folders with a captions.json (4 figures and a table) and paper_data.json (abstract) each."""
+    import json
+
+    captions = ["SEM micrograph of the cathode", "Voltage profiles", "TEM image of grains", "Cell schematic"]
+    for i in range(n_papers):
+        makedirs(f"{dataset_path}/paper_{i}")
+        captions_data = [{"name": str(n + 1), "figType": "Figure", "caption": c} for n, c in enumerate(captions)]
+        captions_data.insert(1, {"name": "1", "figType": "Table", "caption": "Sample compositions"})
+        with open(f"{dataset_path}/paper_{i}/captions.json", "w") as f:
+            json.dump(captions_data, f)
+        with open(f"{dataset_path}/paper_{i}/paper_data.json", "w") as f:
+            json.dump({"abstract": f"Abstract of paper {i}"}, f)
+
 
 class Tests(unittest.TestCase):
     # add scraping test?
@@ -80,6 +180,1007 @@ class Tests(unittest.TestCase):
         )
         assert len(captions) > 0, extract_fail_message
 
+    def test_extraction_worker(self):
+        """Drive `ExtractionWorker` against a stub sbt shell: it only starts on the first job, a job's exit code
+        comes from the marker line ending it, concurrent submits each get their own job's result, and a hung job
+        restarts the shell and is retried. A failing warm-up compile raises on start."""
+        import sys
+        from extract_worker import ExtractionWorker
+
+        with TemporaryDirectory() as tmp_dir:
+            command = [sys.executable, "-c", STUB_SBT, join(tmp_dir, "hung")]
+            worker = ExtractionWorker(job_timeout_s=2, command=command, cwd=tmp_dir)
+            try:
+                assert not worker.is_alive()
+                assert worker.submit("/papers/ok.pdf", "/imgs/", "/data/") == 0
+                assert worker.is_alive() and worker.startup_s > 0
+                assert worker.submit("/papers/bad.pdf", "/imgs/", "/data/") == 1
+
+                pdf_paths = [f"/papers/{'bad' if i % 2 else 'ok'}_{i}.pdf" for i in range(6)]
+                exit_codes: dict = {}
+
+                def submit(pdf_path: str) -> None:
+                    exit_codes[pdf_path] = worker.submit(pdf_path, "/imgs/", "/data/")
+
+                threads = [Thread(target=submit, args=(pdf_path,)) for pdf_path in pdf_paths]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                assert exit_codes == {pdf_path: int("bad" in pdf_path) for pdf_path in pdf_paths}
+
+                assert worker.submit("/papers/hang.pdf", "/imgs/", "/data/") == 0
+                stats = worker.stats()
+                assert (stats["n_jobs"], stats["n_failed"], stats["n_restarts"]) == (9, 4, 1)
+                assert stats["max_latency_s"] >= 2, "hung job's timeout not counted in its latency"
+            finally:
+                worker.stop()
+            assert not worker.is_alive()
+
+            # a failed warm-up compile raises once instead of failing every job
+            broken = ExtractionWorker(command=command + ["broken"], cwd=tmp_dir)
+            with self.assertRaises(RuntimeError):
+                broken.start()
+            assert not broken.is_alive() and broken.process is None
+
+    def test_batch_fan_out(self):
+        """Run `batch_pdf_extract_process` on a shard of 11 pdfs with a fake worker writing pdffigures2-style
+        output (p<i>-Figure<n>-1.png, p<i>.json) for each, and check every paper's folder gets its own captions
+        json and subfigures, including p1 vs p10, and a pdf pdffigures2 gave no output for gets nothing."""
+        from extract import batch_pdf_extract_process
+
+        fnames = sorted(listdir(join(CWD, "micrographs")))
+        n_figures = [i % 3 + 1 for i in range(11)]
+        n_figures[5] = 0  # no output
+
+        class FakeWorker:
+            def submit(self, pdf_dir: str, img_dir: str, data_dir: str, n_threads: int = 1) -> int:
+                for fname in listdir(pdf_dir):
+                    name = fname.split(".")[0]  # p<i>
+                    with open(f"{pdf_dir}{fname}", "rb") as f:
+                        paper = int(f.read().split(b" ")[-1])
+                    if n_figures[paper] == 0:
+                        continue
+                    captions_data = []
+                    for n in range(1, n_figures[paper] + 1):
+                        make_composite_figure(fnames[:2]).save(f"{img_dir}{name}-Figure{n}-1.png")
+                        captions_data.append({"figType": "Figure", "name": f"{n}", "caption": f"{paper}.{n}"})
+                    save_json(f"{data_dir}{name}.json", captions_data)
+                return 0
+
+        with TemporaryDirectory() as tmp_dir:
+            tmp_dir += "/"
+            pdf_paths, data_paths, processed_paths = [], [], []
+            for i in range(11):
+                pdf_paths.append(f"{tmp_dir}{i}.pdf")
+                with open(pdf_paths[i], "wb") as f:
+                    f.write(f"%PDF-1.4 paper {i}".encode())
+                data_paths.append(f"{tmp_dir}paper_{i}/")
+                processed_paths.append(f"{tmp_dir}paper_{i}/imgs/")
+                makedirs(processed_paths[i])
+
+            results = batch_pdf_extract_process(
+                pdf_paths,
+                data_paths,
+                processed_paths,
+                f"{tmp_dir}shard/",
+                out_names=["captions" for _ in pdf_paths],
+                save_original_figures=False,
+                worker=FakeWorker(),  # type: ignore[arg-type]
+            )
+            for i, (captions, img_paths) in enumerate(results):
+                if n_figures[i] == 0:
+                    assert (captions, img_paths) == ([], []) and listdir(data_paths[i]) == ["imgs"]
+                    continue
+                # 2 subfigures per figure, each with its own figure's caption
+                assert captions == [f"{i}.{n}" for n in range(1, n_figures[i] + 1) for _ in range(2)], captions
+                assert all(path.startswith(processed_paths[i]) for path in img_paths)
+                assert sorted(listdir(processed_paths[i])) == sorted(basename(path) for path in img_paths)
+                with open(f"{data_paths[i]}captions.json") as f:
+                    assert [item["caption"] for item in load(f)][0] == f"{i}.1"
+
+    def test_subimage_bboxes(self):
+        """Check the single-pass bbox engine in `get_subimage_bboxes` returns exactly the bboxes of the
+        per-label masking approach on the micrographs in `micrographs/`."""
+        micrograph_dir = join(CWD, "micrographs/")
+        for fname in sorted(listdir(micrograph_dir))[:50]:
+            arr = extract.img_to_arr(Image.open(join(micrograph_dir, fname)), "L")
+            labelled_arr = label(extract.binarize_img(arr, extract.WHITE_CUTOFF))
+            expected = []
+            for i in range(1, labelled_arr.max() + 1):
+                bbox = extract.get_bbox(np.where(labelled_arr == i, 1, 0), extract.OFFSETS)
+                if extract.check_area_from_bbox(bbox, extract.AREA_CUTOFF):
+                    expected.append(bbox)
+            assert extract.get_subimage_bboxes(arr) == expected, f"bboxes differ for {fname}"
+
+    def test_parallel_split(self):
+        """Split some composite figures serially and with the shared process pool, checking the returned captions
+        and paths (and saved subfigures) are identical and in figure order, and the pool is reused."""
+        fnames = sorted(listdir(join(CWD, "micrographs")))
+        captions_data = [
+            {"figType": "Figure", "name": f"{n}", "caption": f"caption {n}"} for n in range(1, 6)
+        ]
+        with TemporaryDirectory() as tmp_dir:
+            fig_paths = []
+            for n in range(1, 6):
+                fig_path = join(tmp_dir, f"p0-Figure{n}-1.png")
+                make_composite_figure(fnames[4 * n : 4 * n + n]).save(fig_path)
+                fig_paths.append(fig_path)
+            outputs, saved_imgs, pools = [], [], []
+            try:
+                for n_workers in [1, 3, 2]:
+                    out_dir = join(tmp_dir, f"out_{n_workers}/")
+                    makedirs(out_dir)
+                    captions, img_paths = extract.process_extracted_figures(
+                        fig_paths[::-1], captions_data, out_dir, "p0", n_workers=n_workers
+                    )
+                    outputs.append((captions, [p.replace(out_dir, "") for p in img_paths]))
+                    saved_imgs.append([np.array(Image.open(p)) for p in img_paths])
+                    pools.append(extract._split_pool)
+            finally:
+                extract.shutdown_split_pool()
+        # one pool for the run: a later call (with no more workers) reuses it rather than spawning its own
+        assert pools[0] is None and pools[1] is not None and pools[2] is pools[1]
+        assert extract._split_pool is None
+        assert outputs[0] == outputs[1] == outputs[2], "process pool changed the outputs"
+        assert all(np.array_equal(a, b) for a, b in zip(saved_imgs[0], saved_imgs[1]))
+        captions, img_names = outputs[0]
+        assert captions == [f"caption {n}" for n in range(1, 6) for _ in range(n)]
+        assert img_names[:3] == ["p0_fig_1_0.jpg", "p0_fig_2_0.jpg", "p0_fig_2_1.jpg"]
+
+    def test_downsampled_detection(self):
+        """Detect subfigures of a composite figure on a downsampled copy and check the boxes (mapped back to
+        full resolution) agree with full resolution detection to within a block."""
+        fnames = sorted(listdir(join(CWD, "micrographs")))
+        arr = extract.img_to_arr(make_composite_figure(fnames[:6], n_cols=3), "L")
+        full_res = extract.get_subimage_bboxes(arr)
+        assert len(full_res) == 6
+        for scale in [2, 3]:
+            downsampled = extract.get_subimage_bboxes(arr, scale)
+            assert len(downsampled) == len(full_res)
+            assert np.abs(np.array(downsampled) - np.array(full_res)).max() < scale
+
+    def test_xycut_engine(self):
+        """Split a grid-layout composite figure with the xycut engine and check it finds the same subfigures as
+        the connected-component engine, and that a single micrograph falls back to the cc engine."""
+        fnames = sorted(listdir(join(CWD, "micrographs")))
+        figure = make_composite_figure(fnames[:5], n_cols=3)
+        arr = extract.img_to_arr(figure, "L")
+        cc_bboxes = extract.get_subimage_bboxes(arr)
+        xy_bboxes = extract.get_subimage_bboxes_xycut(arr)
+        assert len(xy_bboxes) == len(cc_bboxes) == 5
+        assert np.abs(np.array(xy_bboxes) - np.array(cc_bboxes)).max() <= 2
+        assert len(extract.split_composite_figure(figure, engine="xycut")) == 5
+
+        single_arr = extract.img_to_arr(Image.open(join(CWD, "micrographs", fnames[0])), "L")
+        assert extract.get_subimage_bboxes_xycut(single_arr) == extract.get_subimage_bboxes(single_arr)
+
+    def test_lazy_subfigures(self):
+        """Process figures lazily and check the same subfigure paths are returned, only the figures + bbox
+        manifests are written and the subfigures cropped on demand match eager splitting exactly."""
+        fnames = sorted(listdir(join(CWD, "micrographs")))
+        captions_data = [
+            {"figType": "Figure", "name": f"{n}", "caption": f"caption {n}"} for n in range(1, 3)
+        ]
+        with TemporaryDirectory() as tmp_dir:
+            fig_paths = []
+            for n in range(1, 3):
+                fig_paths.append(join(tmp_dir, f"p0-Figure{n}-1.png"))
+                make_composite_figure(fnames[: n + 2]).save(fig_paths[-1])
+            outputs = []
+            for mode in ["eager", "lazy"]:
+                out_dir = join(tmp_dir, f"{mode}/")
+                makedirs(out_dir)
+                extract.LAZY_SUBFIGURES = mode == "lazy"
+                try:
+                    captions, img_paths = extract.process_extracted_figures(
+                        fig_paths, captions_data, out_dir, "p0"
+                    )
+                finally:
+                    extract.LAZY_SUBFIGURES = False
+                outputs.append((captions, [p.replace(out_dir, "") for p in img_paths]))
+            assert outputs[0] == outputs[1]
+            lazy_dir = join(tmp_dir, "lazy/")
+            assert sorted(listdir(lazy_dir)) == [
+                "p0_fig_1.json", "p0_fig_1.png", "p0_fig_2.json", "p0_fig_2.png"
+            ]
+
+            expected = extract.split_composite_figure(Image.open(fig_paths[1]))
+            for i, arr in enumerate(expected):
+                img_path = f"{lazy_dir}p0_fig_2_{i}.jpg"
+                assert np.array_equal(extract.load_subfigure(img_path), arr)
+            # downstream readers see the same files as in eager mode
+            eager_dir = join(tmp_dir, "eager/")
+            assert extract.list_imgs(lazy_dir) == sorted(listdir(eager_dir))
+            figure_arr = np.array(Image.open(fig_paths[1]).convert("RGB"))
+            assert np.array_equal(extract.load_subfigure(f"{lazy_dir}p0_fig_2.jpg"), figure_arr)
+            from llm_operations.run_vlm import encode_image
+
+            for name in ["p0_fig_2.jpg", "p0_fig_2_1.jpg"]:
+                img = Image.open(BytesIO(b64decode(encode_image(f"{lazy_dir}{name}"))))
+                assert img.format == "JPEG" and img.size == Image.open(f"{eager_dir}{name}").size
+
+            jpg_bytes = extract.load_subfigure_bytes(f"{lazy_dir}p0_fig_2_0.jpg", memoise=True)
+            assert jpg_bytes[:2] == b"\xff\xd8" and "p0_fig_2_0.jpg" in listdir(lazy_dir)
+            assert extract.load_subfigure_bytes(f"{lazy_dir}p0_fig_2_0.jpg") == jpg_bytes
+
+    def test_extraction_cache(self):
+        """Seed the extraction cache with fake pdffigures2 output, then check a split-level hit restores the
+        same results, changing a split parameter only reuses the pdffigures2 output and that the least
+        recently used entry is evicted once over the size limit."""
+        from extraction_cache import ExtractionCache
+
+        fnames = sorted(listdir(join(CWD, "micrographs")))
+        captions_data = [
+            {"figType": "Figure", "name": f"{n}", "caption": f"caption {n}"} for n in range(1, 3)
+        ]
+        with TemporaryDirectory() as tmp_dir:
+            tmp_dir += "/"
+            pdf_paths, fig_paths = [], []
+            for i in range(2):
+                pdf_paths.append(f"{tmp_dir}paper{i}.pdf")
+                with open(pdf_paths[i], "wb") as f:
+                    f.write(b"%PDF-1.4 fake paper " + bytes([i]))
+            for n in range(1, 3):
+                fig_paths.append(f"{tmp_dir}paper0-Figure{n}-1.png")
+                make_composite_figure(fnames[: n + 1]).save(fig_paths[-1])
+            save_json(f"{tmp_dir}paper0.json", captions_data)
+
+            cache = ExtractionCache(f"{tmp_dir}cache/")
+            pdf_key = cache.pdf_key(pdf_paths[0])
+            cache.put_extraction(pdf_key, fig_paths, f"{tmp_dir}paper0.json", "paper0")
+            for folder in ["imgs/", "data/", "out_1/", "out_2/", "out_3/"]:
+                makedirs(f"{tmp_dir}{folder}")
+
+            args = (pdf_paths[0], f"{tmp_dir}imgs/", f"{tmp_dir}data/")
+            # pdffigures2 output is cached so nothing is extracted, only split
+            first = single_pdf_extract_process(*args, f"{tmp_dir}out_1/", cache=cache)
+            second = single_pdf_extract_process(*args, f"{tmp_dir}out_2/", cache=cache)
+            assert (cache.extraction_hits, cache.hits) == (1, 1)
+            assert first[0] == second[0] == ["caption 1"] * 2 + ["caption 2"] * 3
+            assert [p.split("/")[-1] for p in first[1]] == [p.split("/")[-1] for p in second[1]]
+            assert sorted(listdir(f"{tmp_dir}out_1/")) == sorted(listdir(f"{tmp_dir}out_2/"))
+
+            prev_engine = extract.SPLIT_ENGINE
+            extract.SPLIT_ENGINE = "xycut"
+            try:
+                single_pdf_extract_process(*args, f"{tmp_dir}out_3/", cache=cache)
+            finally:
+                extract.SPLIT_ENGINE = prev_engine
+            assert (cache.extraction_hits, cache.hits) == (2, 1)
+
+            # a second paper pushes the cache over the limit and the first (least recently used) is evicted
+            cache.max_bytes = cache.size() + 1
+            other_key = cache.pdf_key(pdf_paths[1])
+            cache.put_extraction(other_key, fig_paths, f"{tmp_dir}paper0.json", "paper0")
+            assert cache.evictions == 1 and list(cache.sizes) == [other_key]
+            assert not cache.get_extraction(pdf_key, *args[1:], "paper0")
+
+    def test_stream_download(self):
+        """Stream pdfs from a local server and check valid ones are saved whole while truncated, oversized and
+        non-pdf downloads raise DownloadError without leaving a (partial) file behind."""
+        from scrapers.generic import stream_download, DownloadError
+
+        pdf = b"%PDF-1.4\n" + bytes(range(256)) * 4000
+        server = serve_routes(
+            {
+                "/ok.pdf": (200, {}, pdf),
+                "/truncated.pdf": (
+                    200,
+                    {"Content-Length": str(len(pdf) + 100), "Connection": "close"},
+                    pdf,
+                ),
+                "/page.pdf": (200, {}, b"<html>please log in</html>"),
+                "/big.pdf": (200, {}, pdf),
+                "/missing.pdf": (404, {}, b""),
+            }
+        )
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                save_path = join(tmp_dir, "paper.pdf")
+                assert stream_download(f"{server.base_url}/ok.pdf", save_path) == len(pdf)
+                with open(save_path, "rb") as f:
+                    assert f.read() == pdf
+                for name, max_bytes in [("truncated", None), ("page", None), ("big", 1000), ("missing", None)]:
+                    out_path = join(tmp_dir, f"{name}.pdf")
+                    kwargs = {} if max_bytes is None else {"max_bytes": max_bytes}
+                    with self.assertRaises(DownloadError):
+                        stream_download(f"{server.base_url}/{name}.pdf", out_path, **kwargs)
+                    assert not exists(out_path) and not exists(out_path + ".part")
+        finally:
+            server.shutdown()
+
+    def test_rate_limiter(self):
+        """Check the token bucket allows a burst then spaces requests at its rate (from threads and coroutines)
+        and that hosts are limited independently. The buckets run on a fake clock, so the waits they hand out
+        don't depend on how fast the machine runs the test."""
+        import asyncio
+        from scrapers.rate_limit import TokenBucket, RateLimiter
+
+        now = [0.0]
+        bucket = TokenBucket(rate_per_s=20, burst=2, clock=lambda: now[0])
+        waits = [bucket.reserve() for _ in range(6)]  # 2 free, then 4 at 50ms intervals
+        assert np.allclose(waits, [0, 0, 0.05, 0.1, 0.15, 0.2])
+        assert bucket.try_acquire() is False
+        now[0] = 0.25  # the 4 tokens owed are paid back and one more accrued
+        assert bucket.try_acquire() is True and bucket.try_acquire() is False
+        bucket.pause(1)
+        assert np.isclose(bucket.reserve(), 1) and np.isclose(bucket.waited_s, 1.5)
+
+        limiter = RateLimiter(rate_per_s=1, host_limits={"fast.org": (20, 1)}, clock=lambda: now[0])
+
+        async def fetch_all():
+            await asyncio.gather(*[limiter.acquire_async("http://fast.org/page") for _ in range(5)])
+
+        asyncio.run(fetch_all())  # (really) sleeps 0.05s, 0.1s, ... as the clock doesn't move
+        assert np.isclose(limiter.bucket("fast.org").waited_s, 0.05 + 0.1 + 0.15 + 0.2)
+        # first request to another host isn't held up by fast.org's bucket
+        limiter.acquire("https://slow.org/paper.pdf")
+        assert limiter.bucket("slow.org").waited_s == 0
+
+    def test_scraper_session(self):
+        """Check a scraper's requests reuse one keep-alive connection (pages and pdfs) and that 503s are
+        retried."""
+        from scrapers.generic import GenericScraper, stream_download
+        from scrapers.rate_limit import RateLimiter
+
+        pdf = b"%PDF-1.4\n" + bytes(1000)
+        server = serve_routes(
+            {
+                "/api": (200, {"Content-Type": "application/json"}, b"{}"),
+                "/paper.pdf": (200, {}, pdf),
+                "/flaky": [(503, {}, b"busy"), (503, {}, b"busy"), (200, {}, b"ok")],
+            }
+        )
+        scraper = GenericScraper(RateLimiter(rate_per_s=1000, burst=10))
+        scraper.session.adapters["http://"].max_retries.backoff_factor = 0
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                for _ in range(3):
+                    assert scraper.get(f"{server.base_url}/api").json() == {}
+                    stream_download(f"{server.base_url}/paper.pdf", join(tmp_dir, "p.pdf"), get=scraper.get)
+            assert len(set(port for _, port in server.requests)) == 1, "connection not reused"
+            response = scraper.get(f"{server.base_url}/flaky")
+            assert response.status_code == 200 and response.text == "ok"
+        finally:
+            scraper.close()
+            server.shutdown()
+
+    def test_adaptive_rate_limit(self):
+        """Check the AIMD bucket raises its rate additively on healthy responses and cuts it on 5xx/slow ones
+        within its bounds, that a scraper waits out a 429's Retry-After before retrying and that its 5xx retries
+        go through the limiter."""
+        from time import perf_counter, time
+        from email.utils import formatdate
+        from scrapers.generic import GenericScraper
+        from scrapers.rate_limit import AdaptiveBucket, AdaptiveRateLimiter, parse_retry_after
+
+        bucket = AdaptiveBucket(1, min_rate_per_s=0.3, max_rate_per_s=2, increase_per_s=0.5, slow_s=5)
+        for _ in range(3):
+            bucket.record(200, 0.1)
+        assert bucket.rate_per_s == 2, "healthy responses should raise the rate up to the max"
+        bucket.record(503, 0.1)
+        bucket.record(200, 6)
+        assert bucket.rate_per_s == 0.5
+        bucket.record(500, 0.1)
+        assert bucket.rate_per_s == 0.3, "rate should not drop below the min"
+        assert bucket.counts == {"n_ok": 3, "n_throttled": 0, "n_server_errors": 2, "n_slow": 1}
+
+        assert parse_retry_after("3") == 3
+        assert 8 < parse_retry_after(formatdate(time() + 10, usegmt=True)) <= 10  # type: ignore
+        assert parse_retry_after("soon") is None
+
+        server = serve_routes(
+            {
+                "/busy": [(429, {"Retry-After": "1"}, b"slow down"), (200, {}, b"ok")],
+                "/broken": [(500, {}, b"error"), (502, {}, b"error"), (200, {}, b"ok")],
+            }
+        )
+        limiter = AdaptiveRateLimiter(rate_per_s=50, burst=1, max_rate_per_s=100)
+        scraper = GenericScraper(limiter)
+        try:
+            start = perf_counter()
+            response = scraper.get(f"{server.base_url}/busy")
+            assert response.status_code == 200 and response.text == "ok"
+            assert perf_counter() - start >= 0.95, "retried before Retry-After"
+            (host_stats,) = limiter.stats().values()
+            assert host_stats["n_throttled"] == 1 and host_stats["n_ok"] == 1
+            assert host_stats["rate_per_s"] < 50
+            # 5xxs are retried by `get`, not the session, so each attempt is rate limited and cuts the rate
+            n_requests, rate_per_s = len(server.requests), host_stats["rate_per_s"]
+            assert scraper.get(f"{server.base_url}/broken").text == "ok"
+            (host_stats,) = limiter.stats().values()
+            assert len(server.requests) == n_requests + 3 and host_stats["n_server_errors"] == 2
+            assert host_stats["rate_per_s"] < rate_per_s
+        finally:
+            scraper.close()
+            server.shutdown()
+
+    def test_async_crawl(self):
+        """Crawl paged metadata and pdfs from a local server with the async crawler, checking every paper is
+        saved, paging stops at the first empty page and failed downloads are reported."""
+        from scrapers.arxiv import ArxivScraper
+        from scrapers.rate_limit import RateLimiter
+        from scrapers.async_crawl import crawl_metadata, download_pdfs
+
+        ids = [f"2401.{i:05d}v1" for i in range(25)]
+        routes = {f"/page{start}": (200, {}, make_atom_feed(ids[start : start + 10])) for start in [0, 10, 20]}
+        for start in range(30, 100, 10):  # past the last result the API returns empty pages
+            routes[f"/page{start}"] = (200, {}, make_atom_feed([]))
+        for arxiv_id in ids[:5]:
+            routes[f"/{arxiv_id}.pdf"] = (200, {}, b"%PDF-1.4 " + arxiv_id.encode())
+        # a throttled pdf is retried like the sync scrapers' `get` would
+        routes[f"/{ids[0]}.pdf"] = [(503, {"Retry-After": "0"}, b"busy"), routes[f"/{ids[0]}.pdf"]]
+        server = serve_routes(routes)
+
+        class LocalScraper(ArxivScraper):
+            def get_api_url(self, query_term, start=0, max_results=100, *args) -> str:
+                return f"{server.base_url}/page{start}"
+
+            def get_pdf_url(self, paper_id: str) -> str:
+                return f"{server.base_url}/{paper_id.split('/')[-1]}.pdf"
+
+        scraper = LocalScraper(RateLimiter(rate_per_s=200, burst=5))
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                n_papers = crawl_metadata(scraper, "all:microscopy", 100, 10, dataset_path=f"{tmp_dir}/")
+                assert n_papers == 25
+                assert sorted(listdir(tmp_dir)) == sorted(f"arxiv_{arxiv_id[:-2]}" for arxiv_id in ids)
+                assert len(server.requests) < 10, "kept paging after an empty page"
+
+                save_paths = [f"{tmp_dir}/{arxiv_id}.pdf" for arxiv_id in ids[:6]]
+                ok = download_pdfs(scraper, [f"http://arxiv.org/abs/{i}" for i in ids[:6]], save_paths)
+                assert ok == [True] * 5 + [False]
+                with open(save_paths[0], "rb") as f:
+                    assert f.read() == b"%PDF-1.4 " + ids[0].encode()
+                assert [path for path, _ in server.requests].count(f"/{ids[0]}.pdf") == 2
+        finally:
+            scraper.close()
+            server.shutdown()
+
+    def test_pipeline(self):
+        """Run the download -> extract pipeline with a fake scraper and 2 extraction threads. pdffigures2
+        output for the fake pdfs is seeded in the extraction cache, so only splitting runs. Checks every paper
+        ends up with its captions and subfigures and that neither a failed download nor the download stage
+        crashing stalls the pipeline."""
+        import sqlite3
+        from scrape import download_extract_pipeline
+        from extraction_cache import ExtractionCache
+        from scrapers.generic import GenericScraper
+        from scrapers.manifest import CrawlManifest
+
+        class FakeScraper(GenericScraper):
+            def download_pdf(self, paper_id: str, save_path: str) -> None:
+                if paper_id == "missing":
+                    raise ConnectionError("404")
+                with open(save_path, "wb") as f:
+                    f.write(b"%PDF-1.4 " + paper_id.encode())
+
+        fnames = sorted(listdir(join(CWD, "micrographs")))
+        captions_data = [{"figType": "Figure", "name": "1", "caption": "caption 1"}]
+        with TemporaryDirectory() as tmp_dir:
+            tmp_dir += "/"
+            makedirs(f"{tmp_dir}seed")
+            fig_path = f"{tmp_dir}seed/captions-Figure1-1.png"
+            make_composite_figure(fnames[:2]).save(fig_path)
+            save_json(f"{tmp_dir}seed/captions.json", captions_data)
+            cache = ExtractionCache(f"{tmp_dir}cache/")
+
+            paper_paths = [f"paper_{i}" for i in range(6)]
+            for i, paper_path in enumerate(paper_paths):
+                makedirs(f"{tmp_dir}dataset/{paper_path}")
+                url = "missing" if i == 3 else paper_path
+                save_json(f"{tmp_dir}dataset/{paper_path}/paper_data.json", {"url": url})
+                with open(f"{tmp_dir}seed/{i}.pdf", "wb") as f:
+                    f.write(b"%PDF-1.4 " + url.encode())
+                pdf_key = cache.pdf_key(f"{tmp_dir}seed/{i}.pdf")
+                cache.put_extraction(pdf_key, [fig_path], f"{tmp_dir}seed/captions.json", "captions")
+
+            stats = download_extract_pipeline(
+                FakeScraper(),
+                paper_paths,
+                f"{tmp_dir}dataset/",
+                n_extractors=2,
+                queue_size=2,
+                cache=cache,
+                scratch_path=f"{tmp_dir}scratch/",
+            )
+            assert (stats.n_downloaded, stats.n_extracted, stats.n_failed) == (5, 5, 1)
+            for i, paper_path in enumerate(paper_paths):
+                imgs_path = f"{tmp_dir}dataset/{paper_path}/imgs"
+                assert not exists(imgs_path) if i == 3 else len(listdir(imgs_path)) == 3
+            assert sorted(listdir(f"{tmp_dir}scratch/")) == ["downloads", "worker_0", "worker_1"]
+            assert listdir(f"{tmp_dir}scratch/downloads") == []
+
+            # the download stage dying outside its per-paper error handling still stops the extractors
+            class LockedManifest(CrawlManifest):
+                def mark_downloaded(self, *args) -> None:
+                    raise sqlite3.OperationalError("database is locked")
+
+            manifest = LockedManifest(f"{tmp_dir}manifest.db")
+            pipeline = Thread(
+                target=download_extract_pipeline,
+                args=(FakeScraper(), paper_paths, f"{tmp_dir}dataset/", 2, 2),
+                kwargs={"cache": cache, "scratch_path": f"{tmp_dir}scratch/", "manifest": manifest},
+            )
+            pipeline.start()
+            pipeline.join(timeout=30)
+            manifest.close()
+            assert not pipeline.is_alive(), "extraction threads left waiting for jobs"
+
+    def test_crawl_manifest(self):
+        """Record a crawl in the manifest and check finished papers are skipped on resume, failed ones are
+        retried until out of attempts and the stats add up."""
+        from scrapers.manifest import CrawlManifest, EXTRACTED, FAILED
+
+        with TemporaryDirectory() as tmp_dir:
+            pdf_path = join(tmp_dir, "captions.pdf")
+            with open(pdf_path, "wb") as f:
+                f.write(b"%PDF-1.4 fake")
+            manifest = CrawlManifest(join(tmp_dir, "manifest.db"))
+            paper_paths = [f"paper_{i}" for i in range(4)]
+            manifest.add_papers(paper_paths)
+            for paper_path in paper_paths[:2]:
+                manifest.mark_downloaded(paper_path, pdf_path, 0.5)
+                img_paths = [f"/imgs/captions_fig_{n}_{i}.jpg" for n in [1, 2] for i in range(n)]
+                manifest.mark_extracted(paper_path, img_paths, 1.5)
+            manifest.mark_downloaded("paper_2", pdf_path, 0.5)
+            manifest.mark_failed("paper_2", "extract", ValueError("bad pdf"))
+            for _ in range(3):
+                manifest.mark_failed("paper_3", "download", "HTTP 404")
+            manifest.close()
+
+            # reopen, as a restarted crawl would
+            manifest = CrawlManifest(join(tmp_dir, "manifest.db"))
+            manifest.add_papers(paper_paths)  # doesn't reset existing papers
+            assert manifest.pending(paper_paths[::-1]) == ["paper_2"]
+            row = manifest.get("paper_0")
+            assert row is not None and row["state"] == EXTRACTED and row["n_figures"] == 2
+            assert row["n_subfigures"] == 3 and row["pdf_bytes"] == 13
+            stats = manifest.stats()
+            assert stats["states"] == {EXTRACTED: 2, FAILED: 2}
+            assert stats["failures_by_stage"] == {"extract": 1, "download": 1}
+            assert stats["failure_rate"] == 0.5 and stats["n_subfigures"] == 6
+            manifest.close()
+
+    def test_incremental_harvest(self):
+        """Harvest a query twice from a local server, with new papers published in between. The second
+        harvest should only request the first page and save just the new papers (plus those sharing the
+        watermark's timestamp), moving the watermark forward."""
+        from scrapers.arxiv import ArxivScraper
+        from scrapers.rate_limit import RateLimiter
+        from scrapers.manifest import CrawlManifest
+        from scrape import harvest_since_watermark
+
+        def make_pages(ids: list, dates: list) -> dict:
+            return {
+                f"/page{start}": (200, {}, make_atom_feed(ids[start : start + 10], dates[start : start + 10]))
+                for start in range(0, len(ids) + 1, 10)
+            }
+
+        ids = [f"2401.{i:05d}v1" for i in range(25)]
+        dates = [f"2024-01-{25 - i:02d}T00:00:00Z" for i in range(25)]  # newest first
+        routes = make_pages(ids, dates)
+        server = serve_routes(routes)
+
+        class LocalScraper(ArxivScraper):
+            def get_api_url(self, query_term, start=0, max_results=100, *args) -> str:
+                return f"{server.base_url}/page{start}"
+
+        scraper = LocalScraper(RateLimiter(rate_per_s=200, burst=5))
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                manifest = CrawlManifest(join(tmp_dir, "manifest.db"))
+                dataset_path = join(tmp_dir, "papers/")
+                makedirs(dataset_path)
+                first = harvest_since_watermark(scraper, "all:sem", dataset_path, 1000, manifest, 10)
+                assert len(first) == 25 and len(listdir(dataset_path)) == 25
+                assert manifest.get_watermark("LocalScraper:all:sem") == dates[0]
+
+                new_ids = [f"2402.{i:05d}v1" for i in range(3)]
+                new_dates = [f"2024-02-0{3 - i}T00:00:00Z" for i in range(3)]
+                routes.update(make_pages(new_ids + ids, new_dates + dates))
+                n_requests = len(server.requests)
+                second = harvest_since_watermark(scraper, "all:sem", dataset_path, 1000, manifest, 10)
+                assert second == [f"arxiv_{i[:-2]}" for i in new_ids + ids[:1]]
+                assert len(server.requests) - n_requests == 1, "paged past the watermark"
+                assert manifest.get_watermark("LocalScraper:all:sem") == new_dates[0]
+                assert len(manifest.pending()) == 28
+                manifest.close()
+        finally:
+            scraper.close()
+            server.shutdown()
+
+    def test_stream_atom_feed(self):
+        """Scrape a max size (2000 entry) Atom page from a local server. Entries are parsed as the body
+        streams in, so peak memory while scraping should be well under the size of the page."""
+        import tracemalloc
+        from json import load
+        from scrapers.arxiv import ArxivScraper, MAX_PAGE_SIZE
+        from scrapers.rate_limit import RateLimiter
+
+        ids = [f"2401.{i:05d}v1" for i in range(MAX_PAGE_SIZE)]
+        long_abstract = "SEM micrographs " + 100 * "of grains and pores "
+        body = make_atom_feed(ids).replace(b"SEM micrographs ", long_abstract.encode())  # ~4 MB
+        server = serve_routes({"/page": (200, {}, body)})
+
+        class LocalScraper(ArxivScraper):
+            def get_api_url(self, query_term, start=0, max_results=100, *args) -> str:
+                return f"{server.base_url}/page"
+
+        scraper = LocalScraper(RateLimiter(rate_per_s=200, burst=5))
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                tracemalloc.start()
+                n_papers = scraper.handle_entries(scraper.make_api_request("all:sem"), tmp_dir + "/")
+                _, peak_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                assert n_papers == MAX_PAGE_SIZE
+                with open(join(tmp_dir, "arxiv_2401.01999", "paper_data.json")) as f:
+                    paper_data = load(f)
+                assert paper_data["authors"] == ["A. Author"]
+                assert paper_data["abstract"] == f"{long_abstract}of 2401.01999v1"
+                assert peak_bytes < len(body) / 4, f"peak {peak_bytes} bytes for a {len(body)} byte page"
+        finally:
+            scraper.close()
+            server.shutdown()
+
+    def test_paper_catalog(self):
+        """Scrape a page from a local server into a paper catalog, then look papers up by folder, DOI, date and
+        source, record a train/test split in it and backfill a second catalog from the exported paper_data.json
+        files."""
+        from scrapers.arxiv import ArxivScraper
+        from scrapers.rate_limit import RateLimiter
+        from scrapers.catalog import PaperCatalog, load_paper_data
+        from analyze import train_test_split
+        from scrape import catalog_folders
+
+        ids = [f"2401.{i:05d}v1" for i in range(20)]
+        dates = [f"2024-01-{20 - i:02d}T00:00:00Z" for i in range(20)]
+        server = serve_routes({"/page": (200, {}, make_atom_feed(ids, dates))})
+
+        class LocalScraper(ArxivScraper):
+            def get_api_url(self, query_term, start=0, max_results=100, *args) -> str:
+                return f"{server.base_url}/page"
+
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                dataset_path = join(tmp_dir, "papers/")
+                makedirs(dataset_path)
+                catalog = PaperCatalog(join(tmp_dir, "catalog.db"))
+                scraper = LocalScraper(RateLimiter(rate_per_s=200, burst=5), catalog=catalog)
+                assert scraper.handle_entries(scraper.make_api_request("all:sem"), dataset_path) == 20
+                scraper.close()
+
+                assert catalog.stats()["sources"] == {"arxiv": 20}
+                paper_entry = catalog.get("arxiv_2401.00003")
+                assert paper_entry is not None and paper_entry.date == "2024-01-17T00:00:00Z"
+                assert paper_entry.authors == ["A. Author"]
+                assert catalog.get_by_doi("arXiv:2401.00003") == paper_entry
+                assert catalog.folders(since="2024-01-18", until="2024-01-20") == [
+                    "arxiv_2401.00001",
+                    "arxiv_2401.00002",
+                ]
+                assert catalog.folders(source="chemrxiv") == []
+                # the per-folder json is still exported and matches what the catalog returns
+                data = load_paper_data("arxiv_2401.00003", dataset_path, catalog)
+                assert data == load_paper_data("arxiv_2401.00003", dataset_path)
+
+                catalog.set_split(["arxiv_2401.00004"], "train")
+                assert catalog.folders(split="train") == ["arxiv_2401.00004"]
+
+                # a split only draws catalogued papers that are on disk, and replaces the splits of earlier ones
+                rmtree(join(dataset_path, "arxiv_2401.00019"))
+                makedirs(join(dataset_path, "uncatalogued"))
+                catalog.set_split(["arxiv_2401.00019"], "test")
+                np.random.seed(0)
+                train_test_split(tmp_dir, n_train=3, n_test=16, catalog=catalog)
+                train, test = catalog.folders(split="train"), catalog.folders(split="test")
+                assert len(train) == 3 and len(test) == 16 and "arxiv_2401.00019" not in train + test
+                assert catalog_folders(catalog, join(tmp_dir, "train")) == train
+                # sampling covers every paper on disk, catalogued or not
+                assert "uncatalogued" in catalog_folders(catalog, dataset_path)
+                assert catalog_folders(catalog, dataset_path) == sorted(listdir(dataset_path))
+                assert sorted(listdir(join(tmp_dir, "train"))) == train
+                assert sorted(listdir(join(tmp_dir, "test"))) == test
+                catalog.close()
+
+                backfilled = PaperCatalog(join(tmp_dir, "backfilled.db"))
+                assert backfilled.import_folders(dataset_path, "arxiv") == 19  # one folder was removed above
+                assert backfilled.import_folders(dataset_path, "arxiv") == 0
+                assert backfilled.get("arxiv_2401.00003") == paper_entry
+                backfilled.close()
+        finally:
+            server.shutdown()
+
+    def test_oai_harvest(self):
+        """Harvest recorded arXiv OAI-PMH responses (`test_data/oai/`) from a local server, following the
+        resumption token to a gzipped second page. Deleted records are skipped and only the microscopy papers
+        saved; a date range with no records harvests nothing."""
+        import gzip
+        from json import load
+        from urllib.parse import quote
+        from scrapers.arxiv_oai import ArxivOAIHarvester
+        from scrapers.rate_limit import RateLimiter
+
+        def read(name: str) -> bytes:
+            with open(join(CWD, "test_data/oai/", name), "rb") as f:
+                return f.read()
+
+        routes = {
+            "/oai2?verb=ListRecords&metadataPrefix=arXiv&set=physics%3Acond-mat&from=2024-01-01": (
+                200, {}, read("page1.xml")
+            ),
+            f"/oai2?verb=ListRecords&resumptionToken={quote('6961524|1001', safe='')}": (
+                200, {"Content-Encoding": "gzip"}, gzip.compress(read("page2.xml"))
+            ),
+            "/oai2?verb=ListRecords&metadataPrefix=arXiv&set=physics%3Acond-mat&from=2030-01-01": (
+                200, {}, read("no_records.xml")
+            ),
+        }
+        server = serve_routes(routes)
+        harvester = ArxivOAIHarvester(RateLimiter(rate_per_s=200, burst=5), base_url=f"{server.base_url}/oai2")
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                saved, n_seen = harvester.harvest("physics:cond-mat", "2024-01-01", dataset_path=tmp_dir + "/")
+                assert n_seen == 5, f"expected 5 non-deleted records, got {n_seen}"
+                assert saved == ["arxiv_2401.00001", "arxiv_2401.00004", "arxiv_2401.00006"], saved
+                with open(join(tmp_dir, "arxiv_2401.00001", "paper_data.json")) as f:
+                    paper_data = load(f)
+                assert paper_data["title"] == "Grain boundaries in steel by scanning electron microscopy"
+                assert paper_data["authors"] == ["A. Author", "B. C. Writer"]
+                assert paper_data["date"] == "2024-01-02T00:00:00Z"
+                assert paper_data["url"] == "http://arxiv.org/abs/2401.00001"
+                # the search API's versioned ids map to the same folder, so a paper isn't saved twice
+                assert harvester.doi_to_folder_name(harvester.url_to_doi("http://arxiv.org/abs/2401.00001v2")) == (
+                    "arxiv_2401.00001"
+                )
+                assert harvester.harvest("physics:cond-mat", "2030-01-01", dataset_path=tmp_dir + "/") == ([], 0)
+            assert len(server.requests) == 3
+        finally:
+            harvester.close()
+            server.shutdown()
+
+    def test_mock_server(self):
+        """Scrape both archives' metadata and pdfs from the mock preprint server through `server_url`: the arXiv
+        scraper sequentially past the server's rate limit (its 429s are retried after the Retry-After) and the
+        ChemRxiv scraper with the async crawler."""
+        from scrapers.arxiv import ArxivScraper
+        from scrapers.chemrxiv import ChemrxivScraper
+        from scrapers.rate_limit import RateLimiter
+        from scrapers.async_crawl import crawl_metadata, download_pdfs
+        from scrapers.mock_server import MockPreprintServer
+
+        throttled_server = MockPreprintServer(n_papers=25, rate_limit_per_s=5)
+        server = MockPreprintServer(n_papers=25)
+        arxiv = ArxivScraper(RateLimiter(rate_per_s=200, burst=5), server_url=throttled_server.url)
+        chemrxiv = ChemrxivScraper(RateLimiter(rate_per_s=200, burst=5), server_url=server.url)
+        ids = [paper["id"] for paper in server.papers]
+        try:
+            with TemporaryDirectory() as tmp_dir:
+                makedirs(f"{tmp_dir}/arxiv")
+                for start in range(0, 30, 10):
+                    entries = arxiv.make_api_request("all:microscopy", start, 10)
+                    arxiv.handle_entries(entries, f"{tmp_dir}/arxiv/")
+                assert sorted(listdir(f"{tmp_dir}/arxiv")) == [f"arxiv_{i[:-2]}" for i in ids]
+                assert throttled_server.counts["n_throttled"] > 0, "rate limit never hit"
+                arxiv.download_pdf(f"http://arxiv.org/abs/{ids[0]}", f"{tmp_dir}/arxiv.pdf")
+
+                makedirs(f"{tmp_dir}/chemrxiv")
+                assert crawl_metadata(chemrxiv, "microscopy", 50, 10, dataset_path=f"{tmp_dir}/chemrxiv/") == 25
+                assert len(listdir(f"{tmp_dir}/chemrxiv")) == 25
+                save_paths = [f"{tmp_dir}/{i}.pdf" for i in ids[:3]]
+                assert download_pdfs(chemrxiv, ids[:3], save_paths) == [True] * 3
+                with open(join(CWD, "test_data/tmp.pdf"), "rb") as f, open(save_paths[0], "rb") as g:
+                    assert f.read() == g.read()
+            assert server.counts["n_errors"] == 0
+        finally:
+            arxiv.close()
+            chemrxiv.close()
+            throttled_server.shutdown()
+            server.shutdown()
+
+    def test_concurrent_labelling(self):
+        """Label the captions of a folder of papers concurrently against a local OpenAI stand-in that fails 20% of
+        requests: every paper gets its labels in figure order (tables skipped), at most $max_concurrency requests
+        are in flight and failed requests are retried."""
+        import json
+        import openai
+        from llm_operations.concurrent_labelling import LabellingEngine, process_folder_concurrent
+        from llm_operations.llm_cache import LLMCache
+        from llm_operations.mock_openai import MockOpenAIServer
+
+        server = MockOpenAIServer(latency_s=0.05, error_rate=0.2, seed=1)
+        client = openai.OpenAI(api_key="test", base_url=server.url)
+        try:
+            with TemporaryDirectory() as tmp_dir, TemporaryDirectory() as cache_dir:
+                engine = LabellingEngine(
+                    client, 3, 6000, 10**7, n_retries=8, backoff_s=0.01, cache=LLMCache(f"{cache_dir}/llm_cache.db")
+                )
+                make_labelling_dataset(tmp_dir)
+                assert process_folder_concurrent(tmp_dir, engine=engine) == 4
+                for i in range(4):
+                    with open(f"{tmp_dir}/paper_{i}/labels_gpt4_with_abstract.json") as f:
+                        labels = json.load(f)
+                    assert [label["figure"] for label in labels] == ["1", "2", "3", "4"]
+                    assert [label["isMicrograph"] for label in labels] == ["true", "false", "true", "false"]
+                engine.cache.close()
+            assert server.counts["n_errors"] > 0 and engine.stats["n_retries"] == server.counts["n_errors"]
+            assert len(server.requests) == 16
+            assert 1 < server.max_in_flight <= 3, server.max_in_flight
+        finally:
+            server.shutdown()
+
+    def test_llm_cache(self):
+        """Cache completions by request (images by digest): repeats are hits, the least recently used responses are
+        evicted past the size limit, replay mode raises on a miss, and re-labelling an unchanged folder makes no
+        requests."""
+        import openai
+        from llm_operations.llm_cache import LLMCache, CacheMiss, make_key
+        from llm_operations.concurrent_labelling import LabellingEngine, process_folder_concurrent
+        from llm_operations.mock_openai import MockOpenAIServer
+
+        def image_message(url: str) -> list:
+            return [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": url}}]}]
+
+        jpeg, png = image_message("data:image/jpeg;base64,AAAA"), image_message("data:image/png;base64,AAAA")
+        assert make_key("gpt", jpeg, 0, 10) == make_key("gpt", image_message("data:image/jpeg;base64,AAAA"), 0, 10)
+        assert make_key("gpt", jpeg, 0, 10) != make_key("gpt", png, 0, 10)
+        assert make_key("gpt", jpeg, 0, 10) != make_key("gpt", jpeg, 0.5, 10)
+
+        calls = []
+
+        def create(reply: str):
+            def fn() -> str:
+                calls.append(reply)
+                return reply
+
+            return fn
+
+        server = MockOpenAIServer()
+        client = openai.OpenAI(api_key="test", base_url=server.url)
+        try:
+            with TemporaryDirectory() as cache_dir:
+                cache = LLMCache(f"{cache_dir}/llm_cache.db", max_bytes=10)
+                messages = [[{"role": "user", "content": f"caption {i}"}] for i in range(3)]
+                assert cache.completion(create("aaaa"), "gpt", messages[0], 0, 10) == "aaaa"
+                assert cache.completion(create("bbbb"), "gpt", messages[0], 0, 10) == "aaaa"
+                assert calls == ["aaaa"] and cache.stats()["hit_rate"] == 0.5
+                cache.completion(create("cccc"), "gpt", messages[1], 0, 10)
+                cache.completion(create("dddd"), "gpt", messages[2], 0, 10)  # 12 bytes > 10: drop the oldest
+                assert cache.stats()["evictions"] == 1 and cache.stats()["n_entries"] == 2
+                cache.put(make_key("gpt", messages[1], 0, 10), "gpt", "cc")  # replacing adjusts the running size
+                assert cache.size() == 6
+                cache.close()
+
+                replay = LLMCache(f"{cache_dir}/llm_cache.db", replay=True)
+                assert replay.size() == 6
+                assert replay.completion(create("eeee"), "gpt", messages[2], 0, 10) == "dddd"
+                with self.assertRaises(CacheMiss):
+                    replay.completion(create("ffff"), "gpt", messages[0], 0, 10)
+                assert calls == ["aaaa", "cccc", "dddd"]
+                replay.close()
+
+                with TemporaryDirectory() as tmp_dir:
+                    make_labelling_dataset(tmp_dir)
+                    for _ in range(2):
+                        cache = LLMCache(f"{cache_dir}/labels.db")
+                        engine = LabellingEngine(client, tokens_per_min=10**7, cache=cache)
+                        assert process_folder_concurrent(tmp_dir, engine=engine) == 4
+                        n_hits = cache.stats()["hits"]
+                        cache.close()
+                    assert len(server.requests) == 16, "re-run of unchanged inputs called the API"
+                    assert n_hits == 16
+        finally:
+            server.shutdown()
+
+    def test_batch_labelling(self):
+        """Compile the captions of unlabelled papers into Batch API files (a paper's requests never split across
+        files), ingest hand-written results offline (a paper with a failed request stays pending), then run the
+        whole submit/poll/ingest loop against the local OpenAI stand-in, resuming a batch submitted by an
+        interrupted run alongside a new one for the other pending paper."""
+        import json
+        import openai
+        from llm_operations.batch_labelling import compile_batches, ingest_results, run_batch_labelling, submit_batch
+        from llm_operations.mock_openai import MockOpenAIServer, keyword_label
+
+        server = MockOpenAIServer(respond=lambda messages: f"```json\n{keyword_label(messages)}\n```")
+        client = openai.OpenAI(api_key="test", base_url=server.url)
+        try:
+            with TemporaryDirectory() as tmp_dir, TemporaryDirectory() as batch_dir:
+                make_labelling_dataset(tmp_dir)
+                with open(f"{tmp_dir}/paper_3/labels_gpt4_with_abstract.json", "w") as f:
+                    json.dump([], f)  # already labelled
+
+                paths = compile_batches(tmp_dir, batch_dir, max_requests=6)
+                requests = []
+                for path in paths:
+                    with open(path) as f:
+                        requests.append([json.loads(line) for line in f])
+                assert [[r["custom_id"] for r in file_requests] for file_requests in requests] == [
+                    [f"paper_{i}/{n - 1}/{n}" for n in range(1, 5)] for i in range(3)
+                ]
+                assert requests[0][0]["body"]["messages"][1]["content"].startswith(" The abstract is: 'Abstract of")
+
+                def result(custom_id: str, content: str | None) -> dict:
+                    if content is None:
+                        return {"custom_id": custom_id, "response": None, "error": {"code": "server_error"}}
+                    body = {"choices": [{"message": {"content": content}}]}
+                    return {"custom_id": custom_id, "response": {"status_code": 200, "body": body}, "error": None}
+
+                results = [result(f"paper_0/{n - 1}/{n}", '{"isMicrograph": "false"}') for n in range(4, 0, -1)]
+                results += [result("paper_1/0/1", '{"isMicrograph": "true"}'), result("paper_1/1/2", None)]
+                labelled, failed = ingest_results(tmp_dir, results)
+                assert labelled == ["paper_0"] and failed == ["paper_1/1/2", "paper_1/2/3", "paper_1/3/4"]
+                with open(f"{tmp_dir}/paper_0/labels_gpt4_with_abstract.json") as f:
+                    assert [label["figure"] for label in json.load(f)] == ["1", "2", "3", "4"]
+
+                # pdffigures2 can repeat a figure name, which must still give unique custom_ids
+                with open(f"{tmp_dir}/paper_2/captions.json") as f:
+                    captions_data = json.load(f)
+                captions_data[3]["name"] = "2"
+                with open(f"{tmp_dir}/paper_2/captions.json", "w") as f:
+                    json.dump(captions_data, f)
+                # an interrupted run left paper_1's batch in flight, paper_2 became pending afterwards
+                run_dir = f"{batch_dir}/run/"
+                (path,) = compile_batches(tmp_dir, run_dir, exclude={"paper_2"})
+                with open(f"{run_dir}submitted.json", "w") as f:
+                    json.dump({"batch_0000.jsonl": submit_batch(client, path)}, f)
+
+                labelled, failed = run_batch_labelling(tmp_dir, client, batch_dir=run_dir, poll_s=0)
+                assert labelled == ["paper_1", "paper_2"] and failed == []
+                with open(f"{tmp_dir}/paper_2/labels_gpt4_with_abstract.json") as f:
+                    labels = json.load(f)
+                assert [label["isMicrograph"] for label in labels] == ["true", "false", "true", "false"]
+                assert [label["figure"] for label in labels] == ["1", "2", "2", "4"]
+                assert len(server.requests) == 8 and len(server.batches) == 2
+                with open(f"{run_dir}submitted.json") as f:
+                    assert json.load(f) == {}
+        finally:
+            server.shutdown()
+
+    def test_paper_prompts(self):
+        """Label a paper's figures with one paper-level prompt (abstract sent once) against the local OpenAI stand-in
+        replying with one figure malformed, one missing and one unknown: those two figures fall back to per-caption
+        calls and the labels come back complete and in figure order."""
+        import json
+        import openai
+        import llm_operations.run_llm_with_abstract as llm
+        from llm_operations.llm_cache import LLMCache
+        from llm_operations.mock_openai import MockOpenAIServer, keyword_label
+
+        def respond(messages: list) -> str:
+            if messages[0]["content"] != llm.PAPER_SYSTEM_MESSAGE:
+                return keyword_label(messages)
+            entries = [
+                {"figure": "1", "isMicrograph": "true", "instrument": "SEM"},
+                {"figure": "2", "instrument": "none"},  # malformed: no isMicrograph
+                {"figure": "4", "isMicrograph": "false"},
+                {"figure": "9", "isMicrograph": "false"},  # not a figure of the paper
+            ]
+            return f"Here are the labels:\n{json.dumps(entries)}"
+
+        server = MockOpenAIServer(respond=respond)
+        client, llm.client = llm.client, openai.OpenAI(api_key="test", base_url=server.url)
+        captions = ["SEM micrograph of the cathode", "Voltage profiles", "TEM image of grains", "Cell schematic"]
+        captions_data = [{"name": str(n + 1), "figType": "Figure", "caption": c} for n, c in enumerate(captions)]
+        captions_data.insert(1, {"name": "1", "figType": "Table", "caption": "Sample compositions"})
+        paper_abstract = "We make and test battery cathodes."
+        try:
+            with TemporaryDirectory() as cache_dir:
+                cache = LLMCache(f"{cache_dir}/llm_cache.db")
+                labels, n_fallbacks = llm.label_paper(paper_abstract, captions_data, cache)
+                cache.close()
+            assert n_fallbacks == 2
+            assert [label["figure"] for label in labels] == ["1", "2", "3", "4"]
+            assert [label["isMicrograph"] for label in labels] == ["true", "false", "true", "false"]
+            assert len(server.requests) == 3
+            paper_prompt = server.requests[0]["messages"][1]["content"]
+            assert paper_prompt.count(repr(paper_abstract)) == 1 and all(repr(c) in paper_prompt for c in captions)
+        finally:
+            llm.client = client
+            server.shutdown()
+
     def test_regex(self):
         """Run basic string matching caption/instrument analysis on the captions of the pdf."""
         labels_path = join(CWD, "test_data/analyze/labels.json")